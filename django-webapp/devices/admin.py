@@ -1,14 +1,27 @@
 from django.contrib import admin
 from .models import Device, DeviceCapture, SIM, PushSubscription, Capture, CaptureAnalysis
-from .subscription_models import SubscriptionPlan, CustomerSubscription, DataUsage, PaymentHistory
+from .subscription_models import SubscriptionPlan, CustomerSubscription, DataUsage, PaymentHistory, StripeEvent
+from .device_auth import invalidate_device_keys
 
 
 @admin.register(Device)
 class DeviceAdmin(admin.ModelAdmin):
-    list_display = ('serial_number', 'status', 'connection_type', 'power_state', 'owner', 'last_seen', 'created_at')
+    list_display = ('serial_number', 'status', 'connection_type', 'power_state', 'owner', 'has_api_key', 'last_seen', 'created_at')
     list_filter = ('status', 'connection_type', 'power_state', 'lifecycle_state', 'created_at')
     search_fields = ('serial_number', 'owner__username')
     readonly_fields = ('created_at',)
+    actions = ['revoke_api_keys']
+    
+    @admin.display(boolean=True, description='API key')
+    def has_api_key(self, obj):
+        return bool(obj.api_key_hash)
+    
+    @admin.action(description='Revoke API keys of selected devices')
+    def revoke_api_keys(self, request, queryset):
+        # Keys are issued with: python manage.py issue_device_keys <serial> ...
+        count = queryset.exclude(api_key_hash='').update(api_key_hash='')
+        invalidate_device_keys()
+        self.message_user(request, f'Revoked API keys of {count} device(s)')
 
 
 @admin.register(SIM)
@@ -122,3 +135,12 @@ class PaymentHistoryAdmin(admin.ModelAdmin):
     search_fields = ('subscription__user__username', 'stripe_payment_intent_id', 'stripe_invoice_id')
     readonly_fields = ('created_at',)
     date_hierarchy = 'created_at'
+
+
+@admin.register(StripeEvent)
+class StripeEventAdmin(admin.ModelAdmin):
+    list_display = ('event_id', 'event_type', 'stripe_subscription_id', 'status', 'attempts', 'stripe_created', 'processed_at')
+    list_filter = ('status', 'event_type')
+    search_fields = ('event_id', 'stripe_subscription_id')
+    readonly_fields = ('received_at', 'processed_at')
+    date_hierarchy = 'stripe_created'
@@ -0,0 +1,125 @@
+"""
+ASGI admission for the device API.
+Django's ASGI handler reads the whole request body into a spooled file
+before any middleware or view runs, so under Daphne the rate limits and
+the upload size ceiling would only apply once an upload had been received.
+DeviceApiAdmission wraps the Django application in iot_platform/asgi.py
+and applies both from the scope headers: a throttled (429) or oversized
+(413) request is answered without reading its body.
+
+Uploads without a Content-Length (chunked) are read up to the device's
+ceiling and replayed to Django, or refused as soon as they pass it.
+"""
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from .device_auth import parse_authorization, verify_device_key
+from .ingest_guard import UPLOAD_ENDPOINTS, UploadRejected, check_content_length, reject_too_large
+from .rate_limit import ADMITTED_SCOPE_KEY, DEVICE_API_PREFIX, check_limits, device_endpoint, throttled_response
+
+def scope_meta(scope):
+    """request.META equivalent of an HTTP scope's client address and headers"""
+    client = scope.get('client')
+    meta = {'REMOTE_ADDR': client[0] if client else ''}
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        key = name if name in ('CONTENT_LENGTH', 'CONTENT_TYPE') else f'HTTP_{name}'
+        value = value.decode('latin1')
+        meta[key] = f"{meta[key]},{value}" if key in meta else value
+    return meta
+
+
+def path_info(scope):
+    """Path below the application's root_path, as Django resolves it"""
+    path = scope['path']
+    root_path = scope.get('root_path', '')
+    if root_path and path.startswith(root_path):
+        return path[len(root_path):]
+    return path
+
+
+def admit(scope):
+    """
+    Check a device API request from its scope.
+
+    Returns:
+        (rejection response or None, body ceiling in bytes if the upload
+        has no Content-Length and must be counted as it is read, else None)
+    """
+    endpoint = device_endpoint(path_info(scope))
+    if endpoint is None:
+        return None, None
+
+    meta = scope_meta(scope)
+    retry_after = check_limits(endpoint, meta)
+    if retry_after is not None:
+        return throttled_response(retry_after), None
+    if endpoint not in UPLOAD_ENDPOINTS:
+        return None, None
+
+    credentials = parse_authorization(meta.get('HTTP_AUTHORIZATION', ''))
+    serial_number = credentials[0] if credentials and verify_device_key(*credentials) is not None else None
+    try:
+        limit = check_content_length(meta, serial_number)
+    except UploadRejected as e:
+        return JsonResponse({'error': e.reason}, status=e.status_code), None
+    return None, (None if meta.get('CONTENT_LENGTH') else limit)
+
+
+async def send_response(send, response):
+    """Send a Django response over ASGI"""
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [
+            (name.encode('latin1'), value.encode('latin1')) for name, value in response.items()
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': response.content})
+
+
+class DeviceApiAdmission:
+    """
+    ASGI middleware applying the device API rate limits and upload ceiling
+    before Django reads the body. Other paths pass straight through.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not path_info(scope).startswith(DEVICE_API_PREFIX):
+            return await self.app(scope, receive, send)
+
+        # Cache/Redis round trips (and a rare key or tier reload) are blocking
+        response, limit = await sync_to_async(admit, thread_sensitive=False)(scope)
+        if response is not None:
+            return await send_response(send, response)
+
+        if limit is not None:
+            messages = []
+            received = 0
+            while True:
+                message = await receive()
+                messages.append(message)
+                if message['type'] != 'http.request':
+                    break  # Disconnected; Django sees it on replay
+                received += len(message.get('body', b''))
+                if received > limit:
+                    rejected = await sync_to_async(reject_too_large, thread_sensitive=False)(received, limit)
+                    return await send_response(send, JsonResponse({'error': rejected.reason}, status=413))
+                if not message.get('more_body', False):
+                    break
+            receive = self._replay(messages, receive)
+
+        await self.app(dict(scope, **{ADMITTED_SCOPE_KEY: True}), receive, send)
+
+    @staticmethod
+    def _replay(messages, receive):
+        """receive() that returns the buffered messages first"""
+        pending = list(messages)
+
+        async def replay():
+            if pending:
+                return pending.pop(0)
+            return await receive()
+        return replay
@@ -0,0 +1,197 @@
+"""
+Content-hash keyed cache for Firebase Vision analysis results.
+Identical image bytes (firmware retries, email/manual reprocessing) are
+analyzed once and the stored result is reused.
+"""
+import base64
+import binascii
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+def compute_image_hash(base64_image: str) -> Optional[str]:
+    """
+    Compute the SHA-256 hex digest of the decoded JPEG bytes.
+
+    Args:
+        base64_image: Base64 encoded image string
+
+    Returns:
+        64 character hex digest, or None if the image can't be decoded
+    """
+    if not base64_image:
+        return None
+    try:
+        image_data = base64.b64decode(base64_image)
+    except (binascii.Error, ValueError) as e:
+        logger.warning(f"Could not decode image for hashing: {str(e)}")
+        return None
+    return hashlib.sha256(image_data).hexdigest()
+
+
+class AnalysisCache:
+    """In-process LRU cache of analysis results with a per-entry TTL"""
+
+    def __init__(self, max_entries=1024, ttl_seconds=86400):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, image_hash: str) -> Optional[Dict]:
+        """Return cached analysis data for a hash, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(image_hash)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            stored_at, analysis_data = entry
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self._entries[image_hash]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(image_hash)
+            self.hits += 1
+            return dict(analysis_data)
+
+    def set(self, image_hash: str, analysis_data: Dict):
+        """Store analysis data, evicting the least recently used entries if full"""
+        with self._lock:
+            self._entries[image_hash] = (time.monotonic(), dict(analysis_data))
+            self._entries.move_to_end(image_hash)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drop all cached entries and reset counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict:
+        """Get cache size and hit/miss counters"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+# Singleton instance
+_analysis_cache = None
+
+def get_analysis_cache() -> AnalysisCache:
+    """Get or create the singleton analysis cache instance"""
+    global _analysis_cache
+    if _analysis_cache is None:
+        _analysis_cache = AnalysisCache(
+            max_entries=getattr(settings, 'ANALYSIS_CACHE_MAX_ENTRIES', 1024),
+            ttl_seconds=getattr(settings, 'ANALYSIS_CACHE_TTL_SECONDS', 86400),
+        )
+    return _analysis_cache
+
+
+def analysis_data_from_record(analysis) -> Dict:
+    """
+    Rebuild the analyze_mail() result structure from a stored CaptureAnalysis.
+    """
+    if analysis.package_detected:
+        mail_type = 'package'
+    elif analysis.letter_detected:
+        mail_type = 'letter'
+    elif analysis.envelope_detected:
+        mail_type = 'envelope'
+    else:
+        mail_type = 'unknown'
+
+    carriers = [logo.get('description') for logo in analysis.logos_detected if logo.get('description')]
+
+    return {
+        "type": mail_type,
+        "size": (analysis.estimated_size or 'unknown').lower(),
+        "carrier": carriers[0] if carriers else None,
+        "confidence": analysis.confidence_score or 0.0,
+        "text": analysis.detected_text,
+        "carriers": carriers,
+    }
+
+
+def _find_stored_analysis(image_hash: str, exclude_capture_id=None):
+    """
+    Find a recent CaptureAnalysis for a capture with the same image hash.
+    Failed analyses (no mail type detected, "unknown") are stored too but
+    aren't reused, so the image gets analyzed again.
+    """
+    from .models import CaptureAnalysis
+
+    ttl_seconds = getattr(settings, 'ANALYSIS_CACHE_TTL_SECONDS', 86400)
+    analyses = CaptureAnalysis.objects.filter(
+        Q(package_detected=True) | Q(letter_detected=True) | Q(envelope_detected=True),
+        capture__image_sha256=image_hash,
+        analysis_timestamp__gte=timezone.now() - timezone.timedelta(seconds=ttl_seconds)
+    )
+    if exclude_capture_id:
+        analyses = analyses.exclude(capture_id=exclude_capture_id)
+    return analyses.order_by('-analysis_timestamp').first()
+
+
+def analyze_mail_cached(base64_image: str, image_hash: Optional[str] = None,
+                        exclude_capture_id=None) -> Tuple[Dict, bool]:
+    """
+    Analyze an image, reusing the result of a previous analysis of identical bytes.
+
+    Lookup order: in-process cache, stored CaptureAnalysis rows (shared
+    between workers), then the Vision API. Failed analyses ("unknown" type)
+    are not cached so they get retried.
+
+    Args:
+        base64_image: Base64 encoded image string
+        image_hash: Precomputed SHA-256 of the decoded image (optional)
+        exclude_capture_id: Capture ID to ignore when searching stored analyses
+
+    Returns:
+        Tuple of (analysis_data, cache_hit)
+    """
+    from .firebase_vision import get_vision_service
+
+    if image_hash is None:
+        image_hash = compute_image_hash(base64_image)
+
+    cache = get_analysis_cache()
+
+    if image_hash:
+        analysis_data = cache.get(image_hash)
+        if analysis_data is not None:
+            logger.info(f"Analysis cache hit (memory) for image {image_hash[:12]}")
+            return analysis_data, True
+
+        stored = _find_stored_analysis(image_hash, exclude_capture_id)
+        if stored is not None:
+            analysis_data = analysis_data_from_record(stored)
+            cache.set(image_hash, analysis_data)
+            logger.info(f"Analysis cache hit (database) for image {image_hash[:12]}")
+            return analysis_data, True
+
+    analysis_data = get_vision_service().analyze_mail(base64_image)
+
+    if image_hash and analysis_data.get('type') != 'unknown':
+        cache.set(image_hash, analysis_data)
+
+    return analysis_data, False
@@ -1,14 +1,20 @@
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
 from django.utils import timezone
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from django.conf import settings
 from django.db import transaction
 from .models import Device, Capture, CaptureAnalysis, PushSubscription
-from .firebase_vision import get_vision_service
-from .email_service import send_mail_notification
+from .analysis_cache import analyze_mail_cached, compute_image_hash
+from .firebase_vision import VisionUnavailable
+from .image_processing import normalize_base64_image
+from .email_service import send_mail_notification, select_event_photo_ids
+from .realtime import broadcast_device_event
+from .plan_catalogue import get_subscription_plan
+from .wake_schedule import next_wake_seconds
+from .device_auth import DeviceKeyAuthentication, IsDevice, device_serial
+from .ingest_guard import UploadRejected, check_upload, check_image_header
 import logging
 import json
 
@@ -16,16 +22,26 @@ logger = logging.getLogger(__name__)
 
 
 @api_view(['POST'])
-@permission_classes([AllowAny])  # Allow unauthenticated requests from ESP32
+@authentication_classes([DeviceKeyAuthentication])
+@permission_classes([IsDevice])
 def capture_upload(request):
     """
     Handle device photo capture POST requests.
-    Accepts JSON: {"serial": "ESP-12345", "image": "base64string"}
-    Saves to database and returns capture_id.
+    Requires "Authorization: Device <serial>:<api key>".
+    Accepts JSON: {"image": "base64string"} ("serial" is only needed without
+    device credentials, i.e. DEVICE_AUTH_REQUIRED=False).
+    Saves to database and returns capture_id and next_wake_seconds (sleep
+    until the device's fleet wake slot).
+    Oversized or non-JPEG uploads are rejected before the body is parsed.
     """
     try:
-        # Get data from request (accept both 'serial' and 'serial_number' for compatibility)
-        serial_number = request.data.get('serial') or request.data.get('serial_number')
+        header_checked = check_upload(request, device_serial(request, None))
+    except UploadRejected as e:
+        return Response({'error': e.reason}, status=e.status_code)
+    
+    # Get data from request (accept both 'serial' and 'serial_number' for compatibility)
+    serial_number = device_serial(request, request.data.get('serial') or request.data.get('serial_number'))
+    try:
         image_base64 = request.data.get('image')
         
         # Validate required fields
@@ -41,6 +57,12 @@ def capture_upload(request):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
+        if not header_checked:
+            try:
+                check_image_header(image_base64)
+            except UploadRejected as e:
+                return Response({'error': e.reason}, status=e.status_code)
+        
         # Get or create device (auto-create if doesn't exist)
         device, created = Device.objects.get_or_create(
             serial_number=serial_number,
@@ -86,6 +108,11 @@ def capture_upload(request):
         device.connection_type = connection_type
         device.save()
         
+        # Hash the bytes as uploaded (identical retries share a hash), then
+        # downscale/re-encode into a storage image and a smaller analysis image
+        image_sha256 = compute_image_hash(image_base64) or ''
+        image_base64, analysis_image_base64, _ = normalize_base64_image(image_base64)
+        
         # Create capture record
         capture = Capture.objects.create(
             device=device,
@@ -93,54 +120,46 @@ def capture_upload(request):
             trigger_type=trigger_type,
             door_open=door_open,
             battery_voltage=battery_voltage,
-            solar_charging=solar_charging
+            solar_charging=solar_charging,
+            image_sha256=image_sha256
         )
         
         logger.info(f"Capture saved: ID={capture.id}, Device={serial_number}, Trigger={trigger_type}, Door={door_open}")
         
         # Record notification usage
         if usage_record:
-            record_notification(device, image_size_bytes)
+            record_notification(device, image_size_bytes, usage=usage_record)
         
         # Analyze image with Firebase Vision API (async in background)
         try:
-            analysis_result = analyze_capture_async(capture)
+            analysis_result = analyze_capture_async(capture, analysis_image_base64)
             if analysis_result:
                 logger.info(f"Analysis completed for capture {capture.id}: {analysis_result.get('summary', 'N/A')}")
         except Exception as analysis_error:
             logger.error(f"Failed to analyze capture {capture.id}: {str(analysis_error)}", exc_info=True)
         
-        # Send WebSocket notification to device feed subscribers (allows multiple clients per device)
+        # Send WebSocket notification to device and owner feed subscribers
         try:
-            channel_layer = get_channel_layer()
-            if channel_layer:
-                group_name = f'device_{serial_number}'
-                
-                async_to_sync(channel_layer.group_send)(
-                    group_name,
-                    {
-                        'type': 'new_capture',
-                        'capture_id': capture.id,
-                        'image': image_base64,
-                        'captured_at': capture.timestamp.isoformat(),
-                        'trigger_type': trigger_type,
-                        'door_open': door_open,
-                        'battery_voltage': battery_voltage,
-                        'solar_charging': solar_charging,
-                        'device_status': device.status,
-                        'serial_number': serial_number,
-                    }
-                )
-                logger.info(f"WebSocket message sent for capture {capture.id} to device {serial_number} (group: {group_name})")
-            else:
-                logger.warning("Channel layer not configured, skipping WebSocket notification")
+            if broadcast_device_event(serial_number, device.owner_id, {
+                'type': 'new_capture',
+                'capture_id': capture.id,
+                'image': image_base64,
+                'captured_at': capture.timestamp.isoformat(),
+                'trigger_type': trigger_type,
+                'door_open': door_open,
+                'battery_voltage': battery_voltage,
+                'solar_charging': solar_charging,
+                'device_status': device.status,
+            }):
+                logger.info(f"WebSocket message sent for capture {capture.id} to device {serial_number}")
         except Exception as ws_error:
             # Log error but don't fail the request
             logger.error(f"WebSocket error for device {serial_number}: {str(ws_error)}", exc_info=True)
         
         return Response({
             'status': 'saved',
-            'capture_id': capture.id
+            'capture_id': capture.id,
+            'next_wake_seconds': next_wake_seconds(device),
         }, status=status.HTTP_201_CREATED)
     
     except Exception as e:
@@ -151,17 +170,29 @@ def capture_upload(request):
         )
 
 
-def analyze_capture_async(capture: Capture):
+def analyze_capture_async(capture: Capture, analysis_image_base64=None):
     """
     Analyze a capture using Firebase Vision API and send notifications.
     This function is called asynchronously after capture is saved.
+    analysis_image_base64 is the downscaled analysis image produced at
+    upload; the stored image is used when it isn't given.
+    If the Vision API is unavailable the capture is marked as pending and
+    picked up later by the reanalyze_pending_captures command.
     """
     try:
-        # Get Vision service
-        vision_service = get_vision_service()
-        
-        # Analyze image using structured analysis
-        analysis_data = vision_service.analyze_mail(capture.image_base64)
+        # Analyze image using structured analysis (reuses results for identical image bytes)
+        try:
+            analysis_data, cache_hit = analyze_mail_cached(
+                analysis_image_base64 or capture.image_base64,
+                image_hash=capture.image_sha256 or None,
+                exclude_capture_id=capture.id
+            )
+        except VisionUnavailable as vision_error:
+            logger.warning(f"Vision API unavailable, capture {capture.id} queued for later analysis: {str(vision_error)}")
+            if not capture.analysis_pending:
+                capture.analysis_pending = True
+                capture.save(update_fields=['analysis_pending'])
+            return None
         
         # Generate summary from structured data
         summary_parts = []
@@ -193,15 +224,14 @@ def analyze_capture_async(capture: Capture):
                 processing_time_ms=None  # Can be added if needed
             )
             
-            logger.info(f"Analysis saved for capture {capture.id}: {analysis.summary}")
+            logger.info(f"Analysis saved for capture {capture.id}: {analysis.summary} (cache_hit={cache_hit})")
+            
+            if capture.analysis_pending:
+                capture.analysis_pending = False
+                capture.save(update_fields=['analysis_pending'])
         
-        # Get related captures (for 3 photos in email)
-        # Find captures from same device within 10 seconds (same trigger event)
-        related_captures = Capture.objects.filter(
-            device=capture.device,
-            timestamp__gte=capture.timestamp - timezone.timedelta(seconds=10),
-            timestamp__lte=capture.timestamp + timezone.timedelta(seconds=10)
-        ).exclude(id=capture.id).order_by('timestamp')[:2]  # Get 2 more for total of 3
+        # Get other photos from the same trigger event (IDs only, for 3 photos in email)
+        related_capture_ids = select_event_photo_ids(capture)
         
         # Send notifications based on preferences
         from .notification_preferences import should_send_notification, get_notification_preferences
@@ -212,12 +242,12 @@ def analyze_capture_async(capture: Capture):
         # Send email notification with 3 photos (thumbnails)
         if should_send_notification(capture.device.owner, 'email'):
             try:
-                email_sent = send_mail_notification(capture, analysis, related_captures)
+                email_sent = send_mail_notification(capture, analysis, related_capture_ids)
                 if email_sent:
                     analysis.email_sent = True
                     analysis.email_sent_at = timezone.now()
                     analysis.save(update_fields=['email_sent', 'email_sent_at'])
-                    logger.info(f"Email notification sent for capture {capture.id} with {len(related_captures) + 1} photos")
+                    logger.info(f"Email notification sent for capture {capture.id} with {len(related_capture_ids) + 1} photos")
             except Exception as email_error:
                 logger.error(f"Failed to send email for capture {capture.id}: {str(email_error)}")
         
@@ -242,18 +272,12 @@ def analyze_capture_async(capture: Capture):
         
         # Update WebSocket with analysis results
         try:
-            channel_layer = get_channel_layer()
-            if channel_layer:
-                group_name = f'device_{capture.device.serial_number}'
-                async_to_sync(channel_layer.group_send)(
-                    group_name,
-                    {
-                        'type': 'analysis_complete',
-                        'capture_id': capture.id,
-                        'analysis_summary': analysis.summary,
-                        'analysis_id': analysis.id,
-                    }
-                )
+            broadcast_device_event(capture.device.serial_number, capture.device.owner_id, {
+                'type': 'analysis_complete',
+                'capture_id': capture.id,
+                'analysis_summary': analysis.summary,
+                'analysis_id': analysis.id,
+            })
         except Exception as ws_error:
             logger.error(f"WebSocket error for analysis: {str(ws_error)}")
         
@@ -377,7 +401,8 @@ def manual_trigger(request):
             subscription = user.subscription
             if subscription and subscription.is_active:
                 # Premium users get 10 clicks per day
-                is_premium = subscription.plan.tier == 'premium' or subscription.plan.notification_limit == 0
+                plan = get_subscription_plan(subscription)
+                is_premium = plan.tier == 'premium' or plan.notification_limit == 0
                 if is_premium:
                     click_limit = 10  # Premium users get 10 clicks per day
         except:
@@ -464,7 +489,8 @@ def click_status(request):
     try:
         subscription = user.subscription
         if subscription and subscription.is_active:
-            is_premium = subscription.plan.tier == 'premium' or subscription.plan.notification_limit == 0
+            plan = get_subscription_plan(subscription)
+            is_premium = plan.tier == 'premium' or plan.notification_limit == 0
             if is_premium:
                 click_limit = 10  # Premium users get 10 clicks per day
     except:
@@ -506,8 +532,10 @@ def click_status(request):
 def stripe_webhook(request):
     """
     Handle Stripe webhook events for subscription management.
+    Events are recorded in the StripeEvent ledger and applied asynchronously.
     """
-    from .stripe_service import handle_stripe_webhook, get_stripe_client
+    from .stripe_service import get_stripe_client
+    from .stripe_events import record_event, schedule_processing
     
     stripe = get_stripe_client()
     if not stripe:
@@ -544,15 +572,16 @@ def stripe_webhook(request):
             status=status.HTTP_400_BAD_REQUEST
         )
     
-    # Handle the event
+    # Record the event and acknowledge at once; it is applied asynchronously
     try:
-        handle_stripe_webhook(event)
-        logger.info(f"Stripe webhook processed: {event['type']}")
-        return Response({'status': 'success'})
+        subscription_id = record_event(payload)
     except Exception as e:
-        logger.error(f"Error processing Stripe webhook: {str(e)}", exc_info=True)
+        logger.error(f"Error recording Stripe webhook: {str(e)}", exc_info=True)
         return Response(
-            {'error': str(e)},
+            {'error': 'Could not record event'},
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
+    schedule_processing(subscription_id)
+    logger.info(f"Stripe webhook recorded: {event['type']}")
+    return Response({'status': 'success'})
 
@@ -6,6 +6,8 @@ from decimal import Decimal
 from django.utils import timezone
 from datetime import timedelta
 from django.conf import settings
+from django.db import connection, transaction
+from .plan_catalogue import get_plan, get_plan_by_tier, get_subscription_plan
 
 logger = logging.getLogger(__name__)
 
@@ -56,12 +58,13 @@ def create_trial_subscription(user, plan_tier='basic'):
     """Create a free trial subscription for new customer"""
     from .subscription_models import SubscriptionPlan, CustomerSubscription
     
-    try:
-        plan = SubscriptionPlan.objects.get(tier=plan_tier, is_active=True)
-    except SubscriptionPlan.DoesNotExist:
+    plan = get_plan_by_tier(plan_tier)
+    if plan is None:
         # Create plans if they don't exist
         create_subscription_plans()
-        plan = SubscriptionPlan.objects.get(tier=plan_tier, is_active=True)
+        plan = get_plan_by_tier(plan_tier)
+        if plan is None:
+            raise SubscriptionPlan.DoesNotExist(f"No active plan for tier {plan_tier}")
     
     # Check if subscription already exists
     if hasattr(user, 'subscription'):
@@ -85,12 +88,87 @@ def create_trial_subscription(user, plan_tier='basic'):
     return subscription
 
 
+def get_current_usage(device, subscription):
+    """
+    Get this month's DataUsage row for a device.
+
+    Rows are pre-created by the rollover_usage job, so this is normally a
+    plain read. Devices activated after the job ran get their row created
+    here (the rare path).
+    """
+    from .subscription_models import DataUsage
+    
+    now = timezone.now()
+    year, month = now.year, now.month
+    usage = DataUsage.objects.filter(device=device, year=year, month=month).first()
+    if usage is None:
+        plan = get_subscription_plan(subscription)
+        usage, created = DataUsage.objects.get_or_create(
+            device=device,
+            year=year,
+            month=month,
+            defaults={
+                'subscription': subscription,
+                'notification_limit': plan.notification_limit,
+                'data_limit_mb': plan.data_limit_mb
+            }
+        )
+        if created:
+            logger.info(f"Created {year}/{month:02d} usage record for {device.serial_number} outside the rollover job")
+    if usage.subscription_id == subscription.id:
+        # Reuse the loaded subscription so overage pricing doesn't refetch it
+        usage.subscription = subscription
+    return usage
+
+
+def precreate_usage_records(year, month, batch_size=1000):
+    """
+    Create a month's DataUsage rows for every active device ahead of time,
+    so the ingest path never inserts (no first-of-the-month insert storm or
+    unique-constraint races). Existing rows are left untouched, so the job
+    can run repeatedly.
+
+    Returns:
+        Number of devices covered (rows created or already present)
+    """
+    from .models import Device
+    from .subscription_models import DataUsage
+    
+    devices = Device.objects.filter(
+        lifecycle_state='active_subscription',
+        owner__subscription__status__in=['active', 'trial', 'suspended']
+    ).values_list('id', 'owner__subscription__id', 'owner__subscription__plan_id').order_by('id')
+    
+    covered = 0
+    batch = []
+    for device_id, subscription_id, plan_id in devices.iterator(chunk_size=batch_size):
+        plan = get_plan(plan_id)
+        batch.append(DataUsage(
+            device_id=device_id,
+            subscription_id=subscription_id,
+            year=year,
+            month=month,
+            notification_limit=plan.notification_limit,
+            data_limit_mb=plan.data_limit_mb
+        ))
+        if len(batch) >= batch_size:
+            DataUsage.objects.bulk_create(batch, ignore_conflicts=True)
+            covered += len(batch)
+            batch = []
+    if batch:
+        DataUsage.objects.bulk_create(batch, ignore_conflicts=True)
+        covered += len(batch)
+    
+    logger.info(f"Usage records for {year}/{month:02d} ready for {covered} device(s)")
+    return covered
+
+
 def check_usage_limits(device, notification_data_bytes=0):
     """
     Check if device can send notification based on subscription limits.
     Returns (can_send, reason, usage_record)
     """
-    from .subscription_models import DataUsage
+    from .subscription_models import CustomerSubscription
     
     if not device.owner:
         return False, "Device not activated", None
@@ -102,57 +180,41 @@ def check_usage_limits(device, notification_data_bytes=0):
         subscription = device.owner.subscription
     except CustomerSubscription.DoesNotExist:
         return False, "No subscription found", None
+    plan = get_subscription_plan(subscription)
     
-    # Get or create current month usage
-    now = timezone.now()
-    usage, created = DataUsage.objects.get_or_create(
-        device=device,
-        subscription=subscription,
-        year=now.year,
-        month=now.month,
-        defaults={
-            'notification_limit': subscription.plan.notification_limit,
-            'data_limit_mb': subscription.plan.data_limit_mb
-        }
-    )
+    usage = get_current_usage(device, subscription)
     
     # Check notification limit
-    if subscription.plan.notification_limit > 0:
-        if usage.notification_count >= subscription.plan.notification_limit:
+    if plan.notification_limit > 0:
+        if usage.notification_count >= plan.notification_limit:
             return False, "Notification limit reached", usage
     
     # Check data limit
-    if subscription.plan.data_limit_mb > 0:
+    if plan.data_limit_mb > 0:
         data_mb = Decimal(notification_data_bytes) / Decimal(1024 * 1024)
-        if float(usage.data_used_mb) + float(data_mb) > subscription.plan.data_limit_mb:
+        if float(usage.data_used_mb) + float(data_mb) > plan.data_limit_mb:
             return False, "Data limit reached", usage
     
     return True, "OK", usage
 
 
-def record_notification(device, data_bytes=0):
-    """Record a notification and data usage"""
-    from .subscription_models import DataUsage
-    
-    if not device.owner:
-        return None
-    
-    try:
-        subscription = device.owner.subscription
-    except CustomerSubscription.DoesNotExist:
-        return None
+def record_notification(device, data_bytes=0, usage=None):
+    """
+    Record a notification and data usage.
+    Pass the usage record returned by check_usage_limits to skip looking it
+    up again; recording is then a single UPDATE.
+    """
+    from .subscription_models import CustomerSubscription
     
-    now = timezone.now()
-    usage, created = DataUsage.objects.get_or_create(
-        device=device,
-        subscription=subscription,
-        year=now.year,
-        month=now.month,
-        defaults={
-            'notification_limit': subscription.plan.notification_limit,
-            'data_limit_mb': subscription.plan.data_limit_mb
-        }
-    )
+    if usage is None:
+        if not device.owner:
+            return None
+        
+        try:
+            subscription = device.owner.subscription
+        except CustomerSubscription.DoesNotExist:
+            return None
+        usage = get_current_usage(device, subscription)
     
     usage.add_notification(data_bytes)
     
@@ -164,8 +226,68 @@ def record_notification(device, data_bytes=0):
     return usage
 
 
+def _grace_expired_devices(now):
+    """Active devices whose owner's subscription grace period has ended"""
+    from .models import Device
+    from .subscription_models import CustomerSubscription
+
+    expired_owners = CustomerSubscription.objects.filter(
+        status='suspended',
+        grace_period_end__lte=now
+    ).values('user_id')
+    return Device.objects.filter(lifecycle_state='active_subscription', owner_id__in=expired_owners)
 
 
+def suspend_devices_past_grace(now=None, chunk_size=None, dry_run=False):
+    """
+    Suspend every device whose owner's grace period has expired, in set-based
+    chunks: one UPDATE ... WHERE owner_id IN (subquery) RETURNING per chunk
+    instead of a save() per device. Suspension is not a sighting, so
+    last_seen is left alone.
+
+    Args:
+        now: Cut-off time (default now)
+        chunk_size: Devices per UPDATE (default DEVICE_SUSPEND_CHUNK_SIZE, 1000)
+        dry_run: Only report the devices that would be suspended
+
+    Returns:
+        List of (device_id, serial_number, owner_id) suspended (or that
+        would be, for a dry run)
+    """
+    from .models import Device
+    from .ownership import invalidate_user_device_lists
+
+    now = now or timezone.now()
+    chunk_size = chunk_size or getattr(settings, 'DEVICE_SUSPEND_CHUNK_SIZE', 1000)
+    candidates = _grace_expired_devices(now).order_by('id')
 
+    if dry_run:
+        return list(candidates.values_list('id', 'serial_number', 'owner_id'))
 
+    suspended = []
+    while True:
+        batch_query = candidates.values('id')[:chunk_size]
+        if connection.vendor in ('postgresql', 'sqlite'):
+            subquery, params = batch_query.query.sql_with_params()
+            table = Device._meta.db_table
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(
+                    f'UPDATE {table} SET lifecycle_state = %s WHERE id IN ({subquery}) '
+                    f'RETURNING id, serial_number, owner_id',
+                    ['suspended', *params]
+                )
+                rows = cursor.fetchall()
+        else:
+            # No UPDATE ... RETURNING: lock the chunk, then update it by ID
+            with transaction.atomic():
+                rows = list(
+                    candidates.select_for_update().values_list('id', 'serial_number', 'owner_id')[:chunk_size]
+                )
+                Device.objects.filter(id__in=[row[0] for row in rows]).update(lifecycle_state='suspended')
 
+        suspended.extend(rows)
+        invalidate_user_device_lists({owner_id for _, _, owner_id in rows})
+        for device_id, serial_number, owner_id in rows:
+            logger.info(f"Suspended device {serial_number} (owner {owner_id}) after grace period")
+        if len(rows) < chunk_size:
+            return suspended
@@ -0,0 +1,237 @@
+"""
+Batch billing engine for process_billing.
+Due subscriptions are streamed in batches; each batch's Stripe calls run on
+a bounded thread pool (threads only talk to Stripe, never the database) and
+the results are written back with one bulk update and one bulk insert per
+batch.
+
+Runs are safe to repeat after a crash: each invoice carries its billing
+period in its metadata, and a run first looks for the period's invoice at
+Stripe (Invoice.list) before creating one, so a rerun - even days later -
+picks up the invoice an interrupted run created or paid instead of
+charging twice. Payments that already have a PaymentHistory row are not
+recorded again. Idempotency keys only cover retries within a run: Stripe
+prunes them after 24 hours and replays a stored 5xx for the same key, so
+every run uses fresh ones.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .plan_catalogue import get_plan
+
+logger = logging.getLogger(__name__)
+
+# Outcomes
+PAID = 'paid'
+PAYMENT_FAILED = 'payment_failed'
+NO_PAYMENT_METHOD = 'no_payment_method'
+ERROR = 'error'
+
+GRACE_PERIOD_DAYS = 3
+BILLING_PERIOD_DAYS = 30
+
+
+def billing_period(subscription):
+    """Identity of a subscription's ended billing period (kept in the invoice's metadata)"""
+    return f"{subscription.id}-{int(subscription.current_period_end.timestamp())}"
+
+
+def idempotency_key(subscription, action, run_started):
+    """Stripe idempotency key for one call of one billing run"""
+    return f"billing-{billing_period(subscription)}-{int(run_started.timestamp())}-{action}"
+
+
+def find_period_invoice(stripe, subscription):
+    """
+    The invoice an earlier run created for the subscription's ended period.
+
+    Returns:
+        Stripe invoice, or None if there is none (or only voided ones)
+    """
+    period = billing_period(subscription)
+    invoices = stripe.Invoice.list(
+        subscription=subscription.stripe_subscription_id,
+        created={'gte': int(subscription.current_period_end.timestamp())},
+    )
+    for invoice in invoices.auto_paging_iter():
+        if (invoice.metadata or {}).get('billing_period') == period and invoice.status != 'void':
+            return invoice
+    return None
+
+
+def due_subscriptions(now=None):
+    """Subscriptions whose billing period has ended"""
+    from .subscription_models import CustomerSubscription
+
+    now = now or timezone.now()
+    return CustomerSubscription.objects.filter(
+        status__in=['active', 'trial'],
+        current_period_end__lte=now
+    ).select_related('user').order_by('id')
+
+
+def charge_subscription(stripe, subscription, run_started):
+    """
+    Create (unless an earlier run did) and pay the invoice for a
+    subscription's ended period.
+    Runs in a worker thread: only Stripe calls, no database access.
+
+    Returns:
+        Dict with 'outcome' and, for PAID/PAYMENT_FAILED, the invoice fields
+    """
+    try:
+        invoice = find_period_invoice(stripe, subscription)
+        if invoice is None:
+            invoice = stripe.Invoice.create(
+                customer=subscription.stripe_customer_id,
+                subscription=subscription.stripe_subscription_id,
+                auto_advance=True,
+                metadata={'billing_period': billing_period(subscription)},
+                idempotency_key=idempotency_key(subscription, 'create', run_started)
+            )
+        if invoice.status != 'paid':
+            try:
+                invoice = stripe.Invoice.pay(
+                    invoice.id, idempotency_key=idempotency_key(subscription, 'pay', run_started)
+                )
+            except stripe.CardError as e:
+                # Declines are raised (402) and leave the invoice open
+                return _payment_failed(invoice, e.user_message or str(e))
+    except Exception as e:
+        # Anything else raised here is transient: the next run finds the
+        # period's invoice (if one was created) and retries with fresh keys
+        logger.error(f"Error processing billing for {subscription.user.username}: {str(e)}", exc_info=True)
+        return {'outcome': ERROR, 'error': str(e)}
+
+    if invoice.status == 'paid':
+        return {
+            'outcome': PAID,
+            'invoice_id': invoice.id,
+            'payment_intent': invoice.payment_intent,
+            'amount': Decimal(invoice.amount_paid) / 100,
+        }
+
+    last_error = invoice.last_payment_error
+    return _payment_failed(invoice, last_error.get('message', 'Payment failed') if last_error else 'Payment failed')
+
+
+def _payment_failed(invoice, reason):
+    return {
+        'outcome': PAYMENT_FAILED,
+        'invoice_id': invoice.id,
+        'amount': Decimal(invoice.amount_due) / 100,
+        'failure_reason': reason,
+    }
+
+
+def _apply_results(batch, results, now):
+    """Write a batch's outcomes: one bulk subscription update and one bulk payment insert"""
+    from .subscription_models import CustomerSubscription, PaymentHistory
+
+    updated = []
+    payments = []
+    for subscription, result in zip(batch, results):
+        outcome = result['outcome']
+        if outcome == ERROR:
+            continue  # Still due; retried next run
+
+        if outcome == PAID:
+            subscription.status = 'active'
+            subscription.grace_period_end = None
+            subscription.current_period_start = now
+            subscription.current_period_end = now + timedelta(days=BILLING_PERIOD_DAYS)
+        else:
+            subscription.status = 'suspended'
+            subscription.grace_period_end = now + timedelta(days=GRACE_PERIOD_DAYS)
+        subscription.updated_at = now
+        updated.append(subscription)
+
+        plan_name = get_plan(subscription.plan_id).name
+        if outcome == PAID:
+            payments.append(PaymentHistory(
+                subscription=subscription,
+                amount=result['amount'],
+                status='succeeded',
+                stripe_invoice_id=result['invoice_id'],
+                stripe_payment_intent_id=result['payment_intent'],
+                paid_at=now,
+                description=f"Monthly subscription - {plan_name}"
+            ))
+        elif outcome == PAYMENT_FAILED:
+            payments.append(PaymentHistory(
+                subscription=subscription,
+                amount=result['amount'],
+                status='failed',
+                stripe_invoice_id=result['invoice_id'],
+                failure_reason=result['failure_reason'],
+                description=f"Failed payment - {plan_name}"
+            ))
+
+    # Payments recorded by an interrupted run (or a webhook) are not recorded
+    # twice; a failed attempt and a later success of one invoice are both kept
+    recorded = set(PaymentHistory.objects.filter(
+        stripe_invoice_id__in=[payment.stripe_invoice_id for payment in payments]
+    ).values_list('stripe_invoice_id', 'status'))
+    payments = [payment for payment in payments if (payment.stripe_invoice_id, payment.status) not in recorded]
+
+    with transaction.atomic():
+        CustomerSubscription.objects.bulk_update(
+            updated,
+            ['status', 'grace_period_end', 'current_period_start', 'current_period_end', 'updated_at']
+        )
+        PaymentHistory.objects.bulk_create(payments, ignore_conflicts=True)
+
+
+def run_billing(stripe, workers=None, batch_size=None, now=None, on_result=None):
+    """
+    Bill every due subscription.
+
+    Args:
+        stripe: Stripe module (or a compatible stub)
+        workers: Concurrent Stripe calls (default BILLING_WORKERS, 8)
+        batch_size: Subscriptions per batch (default BILLING_BATCH_SIZE, 100)
+        now: Billing time (default now)
+        on_result: Optional callback(subscription, result) for progress output
+
+    Returns:
+        Dict of outcome -> count, plus 'processed'
+    """
+    workers = workers or getattr(settings, 'BILLING_WORKERS', 8)
+    batch_size = batch_size or getattr(settings, 'BILLING_BATCH_SIZE', 100)
+    now = now or timezone.now()
+    summary = {'processed': 0, PAID: 0, PAYMENT_FAILED: 0, NO_PAYMENT_METHOD: 0, ERROR: 0}
+
+    def process(batch, pool):
+        # Trials that ended without a payment method are suspended without calling Stripe
+        futures = []
+        for subscription in batch:
+            if (subscription.status == 'trial' and subscription.trial_end and now >= subscription.trial_end
+                    and not subscription.stripe_payment_method_id):
+                futures.append(None)
+            else:
+                futures.append(pool.submit(charge_subscription, stripe, subscription, now))
+        results = [future.result() if future else {'outcome': NO_PAYMENT_METHOD} for future in futures]
+
+        _apply_results(batch, results, now)
+        for subscription, result in zip(batch, results):
+            summary['processed'] += 1
+            summary[result['outcome']] += 1
+            if on_result:
+                on_result(subscription, result)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        batch = []
+        for subscription in due_subscriptions(now).iterator(chunk_size=batch_size):
+            batch.append(subscription)
+            if len(batch) >= batch_size:
+                process(batch, pool)
+                batch = []
+        if batch:
+            process(batch, pool)
+
+    logger.info(f"Billing run complete: {summary}")
+    return summary
@@ -0,0 +1,111 @@
+"""
+Versioned, namespaced caching on top of the Django cache (Redis in production).
+Keys embed a per-namespace version number, so a whole namespace (e.g. every
+cached plan list or one user's device list) is invalidated by bumping the
+version instead of finding and deleting keys. Hits and misses are counted
+per namespace for the cache stats endpoint.
+"""
+import logging
+from django.core.cache import cache
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Namespaces used by the cached read paths
+NAMESPACE_DEVICES = 'devices'
+NAMESPACE_PLANS = 'plans'
+NAMESPACE_FIRMWARE = 'firmware'
+NAMESPACE_DASHBOARD = 'dashboard'
+
+NAMESPACES = (NAMESPACE_DEVICES, NAMESPACE_PLANS, NAMESPACE_FIRMWARE, NAMESPACE_DASHBOARD)
+
+
+def _version_key(namespace):
+    return f"ns:{namespace}:version"
+
+
+def namespace_version(namespace):
+    """Current version of a namespace (1 if never invalidated or cache unavailable)"""
+    try:
+        return cache.get(_version_key(namespace)) or 1
+    except Exception as e:
+        logger.debug(f"Cache unavailable reading version of {namespace}: {str(e)}")
+        return 1
+
+
+def versioned_key(namespace, *parts):
+    """Build a cache key that changes whenever the namespace is invalidated"""
+    suffix = ':'.join(str(part) for part in parts)
+    return f"{namespace}:v{namespace_version(namespace)}:{suffix}"
+
+
+def invalidate_namespace(namespace):
+    """Invalidate every key built with versioned_key(namespace, ...)"""
+    key = _version_key(namespace)
+    try:
+        cache.add(key, 1, timeout=None)
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 2, timeout=None)
+    except Exception as e:
+        logger.warning(f"Could not invalidate cache namespace {namespace}: {str(e)}")
+
+
+def get_or_load(namespace, parts, loader, timeout=300):
+    """
+    Read a value from the cache, calling loader() and storing its result on a miss.
+
+    Args:
+        namespace: Namespace for versioning and hit/miss counters. A
+            'devices:<user_id>' style namespace counts under its prefix.
+        parts: Key parts (tuple) identifying the value within the namespace
+        loader: Callable producing the value (must be picklable, not None)
+        timeout: Cache TTL in seconds
+
+    Returns:
+        The cached or freshly loaded value
+    """
+    stats_name = namespace.split(':', 1)[0]
+    key = versioned_key(namespace, *parts)
+    try:
+        value = cache.get(key)
+    except Exception as e:
+        logger.debug(f"Cache unavailable for {key}: {str(e)}")
+        value = None
+
+    if value is not None:
+        metrics.increment(f"cache.{stats_name}.hits")
+        return value
+
+    metrics.increment(f"cache.{stats_name}.misses")
+    value = loader()
+    try:
+        cache.set(key, value, timeout=timeout)
+    except Exception as e:
+        logger.debug(f"Could not cache {key}: {str(e)}")
+    return value
+
+
+def get_cache_stats(namespaces=NAMESPACES):
+    """
+    Hit/miss counters per namespace.
+
+    Returns:
+        Dict of namespace -> {'hits', 'misses', 'hit_rate'}
+    """
+    names = []
+    for namespace in namespaces:
+        names += [f"cache.{namespace}.hits", f"cache.{namespace}.misses"]
+    counters = metrics.get_counters(names)
+
+    stats = {}
+    for namespace in namespaces:
+        hits = counters[f"cache.{namespace}.hits"]
+        misses = counters[f"cache.{namespace}.misses"]
+        total = hits + misses
+        stats[namespace] = {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / total, 3) if total else None,
+        }
+    return stats
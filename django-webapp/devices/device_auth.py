@@ -0,0 +1,179 @@
+"""
+Per-device API key authentication for the ESP32 endpoints.
+Devices send "Authorization: Device <serial>:<api key>". Only a SHA-256 of
+each key is stored (Device.api_key_hash). Verification runs against an
+in-process serial -> (device_id, key hash) map loaded once per process, so
+authenticating adds no database query, and unknown serials or bad keys are
+rejected before the view runs (before any ORM work or body parsing).
+
+Issuing or revoking a key (Device.save) or deleting a device bumps the
+shared 'device_keys' cache namespace, so every worker reloads the map on
+its next request.
+"""
+import hashlib
+import hmac
+import logging
+import secrets
+import threading
+import time
+from django.conf import settings
+from rest_framework import authentication, exceptions, permissions
+from . import metrics
+from .caching import namespace_version, invalidate_namespace
+
+logger = logging.getLogger(__name__)
+
+NAMESPACE_DEVICE_KEYS = 'device_keys'
+AUTH_SCHEME = 'Device'
+
+METRIC_AUTH_REJECTED = 'device_auth.rejected'
+
+_lock = threading.Lock()
+_keys = None  # (generation, loaded_at, {serial_number: (device_id, api_key_hash)})
+
+
+def generate_api_key():
+    """New random device API key (shown once; only its hash is stored)"""
+    return secrets.token_urlsafe(32)
+
+
+def hash_api_key(api_key):
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+def invalidate_device_keys():
+    """Reload device keys in this process and tell other workers to reload"""
+    global _keys
+    with _lock:
+        _keys = None
+    invalidate_namespace(NAMESPACE_DEVICE_KEYS)
+
+
+def _get_keys():
+    global _keys
+    ttl = getattr(settings, 'DEVICE_KEY_CACHE_SECONDS', 300)
+    generation = namespace_version(NAMESPACE_DEVICE_KEYS)
+    now = time.monotonic()
+
+    entry = _keys
+    if entry and entry[0] == generation and now - entry[1] < ttl:
+        return entry[2]
+
+    from .models import Device
+    keys = {
+        serial_number: (device_id, api_key_hash)
+        for device_id, serial_number, api_key_hash in Device.objects.exclude(api_key_hash='').values_list(
+            'id', 'serial_number', 'api_key_hash'
+        ).iterator(chunk_size=2000)
+    }
+    with _lock:
+        _keys = (generation, now, keys)
+    logger.debug(f"Loaded API keys for {len(keys)} device(s)")
+    return keys
+
+
+def verify_device_key(serial_number, api_key):
+    """
+    Check a device's API key.
+
+    Returns:
+        Device ID, or None if the serial is unknown, has no key or the key is wrong
+    """
+    entry = _get_keys().get(serial_number)
+    if entry is None:
+        return None
+    device_id, api_key_hash = entry
+    if not hmac.compare_digest(api_key_hash, hash_api_key(api_key)):
+        return None
+    return device_id
+
+
+def parse_authorization(header):
+    """
+    Split a 'Device <serial>:<key>' Authorization header.
+
+    Returns:
+        (serial_number, api_key), or None for other schemes
+    """
+    scheme, _, credentials = header.partition(' ')
+    if scheme != AUTH_SCHEME:
+        return None
+    serial_number, _, api_key = credentials.strip().partition(':')
+    return serial_number, api_key
+
+
+class AuthenticatedDevice:
+    """request.user for device-authenticated requests"""
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, serial_number, device_id):
+        self.serial_number = serial_number
+        self.device_id = device_id
+
+    def __str__(self):
+        return self.serial_number
+
+
+def authenticate_device(request):
+    """
+    Check a request's device credentials (Django or DRF request, headers only).
+
+    Returns:
+        AuthenticatedDevice, or None if the request has no 'Device' credentials
+
+    Raises:
+        AuthenticationFailed: Unknown serial or wrong key
+    """
+    credentials = parse_authorization(authentication.get_authorization_header(request).decode('latin-1'))
+    if credentials is None:
+        return None
+
+    serial_number, api_key = credentials
+    device_id = verify_device_key(serial_number, api_key) if serial_number and api_key else None
+    if device_id is None:
+        metrics.increment(METRIC_AUTH_REJECTED)
+        logger.warning(f"Rejected device credentials for serial {serial_number[:100]!r}")
+        raise exceptions.AuthenticationFailed('Invalid device credentials')
+    return AuthenticatedDevice(serial_number, device_id)
+
+
+class DeviceKeyAuthentication(authentication.BaseAuthentication):
+    """DRF authentication for 'Authorization: Device <serial>:<key>'"""
+
+    def authenticate(self, request):
+        device = authenticate_device(request)
+        return (device, None) if device else None
+
+    def authenticate_header(self, request):
+        return AUTH_SCHEME
+
+
+class IsDevice(permissions.BasePermission):
+    """
+    Require device credentials. With DEVICE_AUTH_REQUIRED=False (the
+    default until a fleet has its keys) unauthenticated requests are let
+    through and views fall back to the serial in the request.
+    """
+
+    def has_permission(self, request, view):
+        if isinstance(request.user, AuthenticatedDevice):
+            return True
+        return not getattr(settings, 'DEVICE_AUTH_REQUIRED', False)
+
+
+def device_serial(request, claimed_serial):
+    """
+    Serial number a device request acts for.
+
+    Args:
+        claimed_serial: Serial from the query string or body (legacy clients)
+
+    Raises:
+        PermissionDenied: If an authenticated device claims another serial
+    """
+    if isinstance(request.user, AuthenticatedDevice):
+        if claimed_serial and claimed_serial != request.user.serial_number:
+            raise exceptions.PermissionDenied('Serial number does not match device credentials')
+        return request.user.serial_number
+    return claimed_serial
@@ -4,9 +4,7 @@ Supports SendGrid, SMTP, and AWS SES.
 Includes thumbnail generation for data optimization.
 """
 import base64
-import io
 import logging
-from PIL import Image
 from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -15,18 +13,19 @@ from django.conf import settings
 from django.template.loader import render_to_string
 from django.utils.html import strip_tags
 from django.utils import timezone
+from . import image_processing
 
 logger = logging.getLogger(__name__)
 
 
-def send_mail_notification(capture, analysis, related_captures=None, thumbnail_size_kb=100):
+def send_mail_notification(capture, analysis, related_capture_ids=None, thumbnail_size_kb=100):
     """
     Send email notification when mail is detected with 3 photos attached.
     
     Args:
         capture: Capture model instance (primary capture)
         analysis: CaptureAnalysis model instance
-        related_captures: List of related Capture instances (for 3 photos total)
+        related_capture_ids: IDs of other captures from the same event (see select_event_photo_ids)
         thumbnail_size_kb: Maximum size per thumbnail in KB (default 100KB)
     """
     try:
@@ -78,7 +77,7 @@ def send_mail_notification(capture, analysis, related_captures=None, thumbnail_s
         plain_message = strip_tags(html_message)
         
         # Get 3 photos to attach (as thumbnails)
-        photos_to_attach = get_photos_for_email(capture, related_captures, thumbnail_size_kb)
+        photos_to_attach = get_photos_for_email(capture, related_capture_ids, thumbnail_size_kb)
         
         # Send email based on backend
         email_backend = getattr(settings, 'EMAIL_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
@@ -111,105 +110,71 @@ def create_thumbnail(image_data, max_size_kb=100, quality=80):
     Returns:
         bytes: Thumbnail image data
     """
-    try:
-        # Open image from bytes
-        image = Image.open(io.BytesIO(image_data))
-        
-        # Calculate target size to keep under max_size_kb
-        original_size = len(image_data) / 1024  # KB
-        target_size_kb = max_size_kb
-        
-        if original_size <= target_size_kb:
-            # Image is already small enough, just re-encode with quality
-            output = io.BytesIO()
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            image.save(output, format='JPEG', quality=quality, optimize=True)
-            return output.getvalue()
-        
-        # Calculate scale factor to achieve target size
-        # Size reduction is roughly quadratic with dimension reduction
-        scale_factor = (target_size_kb / original_size) ** 0.5
-        scale_factor = max(0.1, min(0.9, scale_factor))  # Limit between 10% and 90%
-        
-        # Calculate new dimensions
-        new_width = int(image.width * scale_factor)
-        new_height = int(image.height * scale_factor)
-        
-        # Resize image
-        image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        
-        # Convert to RGB if needed
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        # Save with compression
-        output = io.BytesIO()
-        image.save(output, format='JPEG', quality=quality, optimize=True)
-        thumbnail_data = output.getvalue()
-        
-        # If still too large, reduce quality further
-        while len(thumbnail_data) / 1024 > target_size_kb and quality > 30:
-            quality -= 10
-            output = io.BytesIO()
-            image.save(output, format='JPEG', quality=quality, optimize=True)
-            thumbnail_data = output.getvalue()
-        
-        logger.info(f"Thumbnail created: {len(image_data)/1024:.1f}KB -> {len(thumbnail_data)/1024:.1f}KB")
-        return thumbnail_data
-        
-    except Exception as e:
-        logger.error(f"Failed to create thumbnail: {str(e)}", exc_info=True)
-        # Return original if thumbnail creation fails
-        return image_data
+    return image_processing.create_thumbnail(image_data, max_size_kb=max_size_kb, quality=quality)
+
+
+def select_event_photo_ids(capture, max_photos=3, window_seconds=10):
+    """
+    Select the other captures that belong to the same trigger event.
+    Only IDs are fetched; images are never loaded here.
+    
+    Args:
+        capture: Primary Capture instance
+        max_photos: Total photos wanted including the primary capture
+        window_seconds: Captures from the same device within this many seconds
+            of the primary capture belong to the same event
+    
+    Returns:
+        List of Capture IDs (oldest first), at most max_photos - 1
+    """
+    from .models import Capture
+    
+    window = timezone.timedelta(seconds=window_seconds)
+    return list(
+        Capture.objects.filter(
+            device_id=capture.device_id,
+            timestamp__gte=capture.timestamp - window,
+            timestamp__lte=capture.timestamp + window
+        ).exclude(id=capture.id).order_by('timestamp').values_list('id', flat=True)[:max_photos - 1]
+    )
+
+
+def _load_capture_image(capture_id):
+    """Load a single capture's base64 image without fetching the rest of the row"""
+    from .models import Capture
+    
+    return Capture.objects.filter(id=capture_id).values_list('image_base64', flat=True).first()
 
 
-def get_photos_for_email(primary_capture, related_captures=None, thumbnail_size_kb=100):
+def get_photos_for_email(primary_capture, related_capture_ids=None, thumbnail_size_kb=100):
     """
-    Get up to 3 photos for email attachment with thumbnails.
+    Get up to 3 photos of the event for email attachment as thumbnails.
     Returns list of tuples: (image_data_bytes, filename, is_thumbnail)
     
+    Thumbnails come from the per-capture thumbnail cache; a related capture's
+    image is only read from the database on a cache miss, one at a time.
+    
     Args:
         primary_capture: Primary Capture instance
-        related_captures: List of related Capture instances
+        related_capture_ids: IDs of other captures from the same event
         thumbnail_size_kb: Maximum size per thumbnail in KB (default 100KB)
     """
     photos = []
     
-    # Add primary capture
-    try:
-        image_data = base64.b64decode(primary_capture.image_base64)
-        thumbnail = create_thumbnail(image_data, max_size_kb=thumbnail_size_kb)
+    # Add primary capture (its image is already in memory)
+    thumbnail = image_processing.get_capture_thumbnail(primary_capture.id, primary_capture.image_base64, thumbnail_size_kb)
+    if thumbnail:
         photos.append((thumbnail, f"mailbox_photo_1_{primary_capture.id}.jpg", True))
-    except Exception as e:
-        logger.error(f"Failed to decode primary capture image: {str(e)}")
     
-    # Add related captures if provided
-    if related_captures:
-        for idx, related_capture in enumerate(related_captures[:2], start=2):  # Max 2 more (total 3)
-            try:
-                image_data = base64.b64decode(related_capture.image_base64)
-                thumbnail = create_thumbnail(image_data, max_size_kb=thumbnail_size_kb)
-                photos.append((thumbnail, f"mailbox_photo_{idx}_{related_capture.id}.jpg", True))
-            except Exception as e:
-                logger.error(f"Failed to decode related capture image: {str(e)}")
-    
-    # If we don't have 3 photos yet, try to get recent captures from same device
-    if len(photos) < 3:
-        from .models import Capture
-        recent_captures = Capture.objects.filter(
-            device=primary_capture.device
-        ).exclude(id=primary_capture.id).order_by('-timestamp')[:3-len(photos)]
-        
-        for idx, recent_capture in enumerate(recent_captures, start=len(photos)+1):
-            try:
-                image_data = base64.b64decode(recent_capture.image_base64)
-                thumbnail = create_thumbnail(image_data, max_size_kb=thumbnail_size_kb)
-                photos.append((thumbnail, f"mailbox_photo_{idx}_{recent_capture.id}.jpg", True))
-                if len(photos) >= 3:
-                    break
-            except Exception as e:
-                logger.error(f"Failed to decode recent capture image: {str(e)}")
+    # Add related captures from the same event
+    for idx, capture_id in enumerate((related_capture_ids or [])[:2], start=2):  # Max 2 more (total 3)
+        thumbnail = image_processing.get_capture_thumbnail(
+            capture_id,
+            lambda capture_id=capture_id: _load_capture_image(capture_id),
+            thumbnail_size_kb
+        )
+        if thumbnail:
+            photos.append((thumbnail, f"mailbox_photo_{idx}_{capture_id}.jpg", True))
     
     return photos
 
@@ -267,7 +232,7 @@ def send_via_sendgrid(recipient_email, subject, html_message, plain_message, pho
             message.reply_to = reply_to
         
         # Attach photos
-        for photo_data, filename in photos:
+        for photo_data, filename, _ in photos:
             encoded_photo = base64.b64encode(photo_data).decode()
             attachment = Attachment()
             attachment.file_content = encoded_photo
@@ -312,7 +277,7 @@ def send_via_smtp(recipient_email, subject, html_message, plain_message, photos,
         email.attach_alternative(html_message, "text/html")
         
         # Attach photos
-        for photo_data, filename in photos:
+        for photo_data, filename, _ in photos:
             email.attach(filename, photo_data, 'image/jpeg')
         
         # Send email
@@ -0,0 +1,134 @@
+"""
+Per-device event log for WebSocket resume.
+Every feed event is appended to a capped Redis stream per device
+(XADD MAXLEN ~). The stream entry ID becomes the event_id sent to
+browsers, so a reconnecting client passes its last event_id and is replayed
+only the events it missed instead of reloading the page.
+
+Logged events never carry the base64 image; replayed new_capture events
+point at the capture download URL instead.
+"""
+import json
+import logging
+from django.conf import settings
+from django.urls import reverse
+
+logger = logging.getLogger(__name__)
+
+# Resume point for a device with nothing logged: every later event is newer.
+# Replaying from it is complete as long as the log hasn't been trimmed since,
+# which needs more than the replay limit of events (< DEVICE_EVENT_LOG_MAX_LEN).
+EMPTY_LOG_EVENT_ID = '0-0'
+
+_client = None
+
+
+def get_redis_client():
+    """Shared Redis client (the same Redis that backs the channel layer)"""
+    global _client
+    if _client is None:
+        import redis
+        _client = redis.Redis(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            socket_timeout=getattr(settings, 'DEVICE_EVENT_LOG_TIMEOUT_SECONDS', 0.5),
+            socket_connect_timeout=getattr(settings, 'DEVICE_EVENT_LOG_TIMEOUT_SECONDS', 0.5),
+        )
+    return _client
+
+
+def _stream_key(serial_number):
+    return f"events:device:{serial_number}"
+
+
+def _loggable(event):
+    """Strip large fields before an event is stored"""
+    entry = {key: value for key, value in event.items() if key != 'image'}
+    if event.get('type') == 'new_capture' and event.get('capture_id'):
+        entry['image_url'] = reverse('web:download_capture', args=[event['capture_id']])
+    return entry
+
+
+def append_event(serial_number, event):
+    """
+    Append an event to a device's log.
+
+    Settings:
+        DEVICE_EVENT_LOG_MAX_LEN: Events kept per device (default 200, approximate)
+        DEVICE_EVENT_LOG_TTL_SECONDS: Idle devices' logs expire after this (default 1 day)
+
+    Returns:
+        Event ID string, or None if the log is unavailable (the event is still
+        delivered live, just not replayable)
+    """
+    key = _stream_key(serial_number)
+    try:
+        client = get_redis_client()
+        pipe = client.pipeline()
+        pipe.xadd(
+            key,
+            {'data': json.dumps(_loggable(event))},
+            maxlen=getattr(settings, 'DEVICE_EVENT_LOG_MAX_LEN', 200),
+            approximate=True
+        )
+        pipe.expire(key, getattr(settings, 'DEVICE_EVENT_LOG_TTL_SECONDS', 24 * 3600))
+        event_id, _ = pipe.execute()
+        return event_id.decode() if isinstance(event_id, bytes) else event_id
+    except Exception as e:
+        logger.warning(f"Could not log event for device {serial_number}: {str(e)}")
+        return None
+
+
+def latest_event_id(serial_number):
+    """
+    ID of a device's newest logged event, for pages to resume from.
+
+    Returns:
+        Event ID string, EMPTY_LOG_EVENT_ID if nothing is logged, or None if
+        the log is unavailable
+    """
+    try:
+        entries = get_redis_client().xrevrange(_stream_key(serial_number), max='+', min='-', count=1)
+    except Exception as e:
+        logger.warning(f"Could not read event log for device {serial_number}: {str(e)}")
+        return None
+    if not entries:
+        return EMPTY_LOG_EVENT_ID
+    entry_id = entries[0][0]
+    return entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+
+
+def events_since(serial_number, last_event_id, limit=100):
+    """
+    Get the events a client missed after last_event_id.
+
+    Returns:
+        Tuple of (events, complete). events are dicts with 'event_id' set,
+        oldest first. complete is True only when the log provably covers the
+        gap: last_event_id is still logged (or is EMPTY_LOG_EVENT_ID and no
+        more than limit events were logged since). Otherwise (trimmed past
+        MAXLEN, expired, unknown ID or more than limit events missed) the
+        client should reload instead of applying a partial delta.
+    """
+    key = _stream_key(serial_number)
+    try:
+        # XRANGE start is inclusive: a retained last_event_id comes back first
+        entries = get_redis_client().xrange(key, min=last_event_id, max='+', count=limit + 1)
+    except Exception as e:
+        logger.warning(f"Could not read event log for device {serial_number}: {str(e)}")
+        return [], False
+
+    events = []
+    found = last_event_id == EMPTY_LOG_EVENT_ID
+    for entry_id, fields in entries:
+        entry_id = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+        if entry_id == last_event_id:
+            found = True
+            continue
+        data = fields.get(b'data') or fields.get('data')
+        event = json.loads(data)
+        event['event_id'] = entry_id
+        events.append(event)
+
+    complete = found and len(events) <= limit
+    return events[:limit], complete
@@ -4,14 +4,131 @@ Provides structured analysis functions for mail detection.
 """
 import base64
 import logging
+import random
+import threading
 import time
 from typing import Dict, Optional
+from google.api_core import exceptions as google_exceptions
 from google.cloud import vision
 from google.oauth2 import service_account
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
+# Errors that indicate the Vision API is degraded and the call may succeed later
+RETRYABLE_ERRORS = (
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.TooManyRequests,
+    google_exceptions.InternalServerError,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.RetryError,
+    TimeoutError,
+    ConnectionError,
+)
+
+
+class VisionUnavailable(Exception):
+    """Raised when the Vision API can't be reached in time; the capture should be analyzed later"""
+    pass
+
+
+class CircuitBreaker:
+    """
+    Process-wide circuit breaker for Vision API calls.
+
+    closed: calls go through; consecutive failures are counted.
+    open: calls are rejected immediately until reset_timeout has passed.
+    half_open: a single trial call is allowed; success closes, failure re-opens.
+    """
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+    
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+    
+    def allow_request(self) -> bool:
+        """Check whether a call may be attempted right now"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+                self._trial_in_flight = False
+            # Half-open: let exactly one trial call through
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+    
+    def cancel_trial(self):
+        """Give back a half-open trial slot without recording an outcome"""
+        with self._lock:
+            self._trial_in_flight = False
+    
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info("Vision API circuit breaker closed")
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+    
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.warning(f"Vision API circuit breaker opened after {self._failures} failure(s)")
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+# Shared by every FirebaseVisionService instance in this process
+_concurrency_semaphore = None
+_circuit_breaker = None
+_resilience_lock = threading.Lock()
+
+def get_concurrency_semaphore() -> threading.BoundedSemaphore:
+    """Get the process-wide semaphore limiting in-flight Vision API calls"""
+    global _concurrency_semaphore
+    with _resilience_lock:
+        if _concurrency_semaphore is None:
+            _concurrency_semaphore = threading.BoundedSemaphore(
+                getattr(settings, 'VISION_MAX_CONCURRENCY', 4)
+            )
+        return _concurrency_semaphore
+
+
+def get_circuit_breaker() -> CircuitBreaker:
+    """Get the process-wide Vision API circuit breaker"""
+    global _circuit_breaker
+    with _resilience_lock:
+        if _circuit_breaker is None:
+            _circuit_breaker = CircuitBreaker(
+                failure_threshold=getattr(settings, 'VISION_BREAKER_FAILURE_THRESHOLD', 5),
+                reset_timeout=getattr(settings, 'VISION_BREAKER_RESET_SECONDS', 60),
+            )
+        return _circuit_breaker
+
 
 class FirebaseVisionService:
     """Service for analyzing mailbox images using Google Cloud Vision API"""
@@ -19,6 +136,12 @@ class FirebaseVisionService:
     def __init__(self):
         """Initialize the Vision API client"""
         self.client = None
+        self.call_timeout = getattr(settings, 'VISION_CALL_TIMEOUT_SECONDS', 10.0)
+        self.max_retries = getattr(settings, 'VISION_MAX_RETRIES', 2)
+        self.retry_base_delay = getattr(settings, 'VISION_RETRY_BASE_DELAY_SECONDS', 0.5)
+        self.concurrency_wait = getattr(settings, 'VISION_CONCURRENCY_WAIT_SECONDS', 5.0)
+        self.semaphore = get_concurrency_semaphore()
+        self.breaker = get_circuit_breaker()
         self._initialize_client()
     
     def _initialize_client(self):
@@ -48,6 +171,54 @@ class FirebaseVisionService:
             logger.error(f"Error initializing Firebase Vision client: {str(e)}")
             self.client = None
     
+    def _call(self, method_name: str, **kwargs):
+        """
+        Call a Vision API client method with a deadline, bounded retries,
+        the process-wide concurrency limit and the circuit breaker.
+        
+        Raises:
+            VisionUnavailable: circuit open, no concurrency slot free in time,
+                or retries exhausted on timeouts/5xx errors
+        """
+        if not self.breaker.allow_request():
+            raise VisionUnavailable("Vision API circuit breaker is open")
+        
+        if not self.semaphore.acquire(timeout=self.concurrency_wait):
+            # Saturation isn't an API failure; just give back a half-open trial slot
+            self.breaker.cancel_trial()
+            raise VisionUnavailable("Vision API concurrency limit reached")
+        
+        try:
+            method = getattr(self.client, method_name)
+            attempt = 0
+            while True:
+                try:
+                    response = method(timeout=self.call_timeout, **kwargs)
+                    self.breaker.record_success()
+                    return response
+                except RETRYABLE_ERRORS as e:
+                    if attempt >= self.max_retries:
+                        self.breaker.record_failure()
+                        raise VisionUnavailable(
+                            f"Vision API {method_name} failed after {attempt + 1} attempt(s): {str(e)}"
+                        ) from e
+                    # Exponential backoff with full jitter
+                    delay = random.uniform(0, self.retry_base_delay * (2 ** attempt))
+                    logger.warning(f"Vision API {method_name} attempt {attempt + 1} failed ({str(e)}), retrying in {delay:.2f}s")
+                    time.sleep(delay)
+                    attempt += 1
+                except google_exceptions.ServerError:
+                    # Other 5xx (e.g. 501): the API is at fault, but retrying won't help
+                    self.breaker.record_failure()
+                    raise
+                except Exception:
+                    # Rejected request (4xx) or client bug: says nothing about the
+                    # API's health, but a half-open trial slot must be given back
+                    self.breaker.cancel_trial()
+                    raise
+        finally:
+            self.semaphore.release()
+    
     def detect_mail_type(self, image: str) -> str:
         """
         Detect mail type from image.
@@ -71,7 +242,7 @@ class FirebaseVisionService:
                 vision_image = image
             
             # Use object localization to detect mail-related objects
-            response = self.client.object_localization(image=vision_image)
+            response = self._call('object_localization', image=vision_image)
             
             # Check detected objects for mail types
             package_score = 0.0
@@ -105,6 +276,8 @@ class FirebaseVisionService:
                 # Default to package if no clear match
                 return "package"
                 
+        except VisionUnavailable:
+            raise
         except Exception as e:
             logger.error(f"Error detecting mail type: {str(e)}", exc_info=True)
             return "unknown"
@@ -132,7 +305,7 @@ class FirebaseVisionService:
                 vision_image = image
             
             # Perform text detection
-            response = self.client.text_detection(image=vision_image)
+            response = self._call('text_detection', image=vision_image)
             
             if response.text_annotations:
                 # First annotation contains all detected text
@@ -140,6 +313,8 @@ class FirebaseVisionService:
             else:
                 return ""
                 
+        except VisionUnavailable:
+            raise
         except Exception as e:
             logger.error(f"Error reading text: {str(e)}", exc_info=True)
             return ""
@@ -167,7 +342,7 @@ class FirebaseVisionService:
                 vision_image = image
             
             # Detect logos
-            response = self.client.logo_detection(image=vision_image)
+            response = self._call('logo_detection', image=vision_image)
             
             carriers = []
             known_carriers = ['Amazon', 'FedEx', 'UPS', 'USPS', 'DHL', 'OnTrac', 'Lasership']
@@ -188,6 +363,8 @@ class FirebaseVisionService:
             
             return carriers
             
+        except VisionUnavailable:
+            raise
         except Exception as e:
             logger.error(f"Error detecting logos: {str(e)}", exc_info=True)
             return []
@@ -215,7 +392,7 @@ class FirebaseVisionService:
                 vision_image = image
             
             # Use object localization to get bounding boxes
-            response = self.client.object_localization(image=vision_image)
+            response = self._call('object_localization', image=vision_image)
             
             if not response.localized_object_annotations:
                 return "unknown"
@@ -249,6 +426,8 @@ class FirebaseVisionService:
             else:
                 return "small"  # Default to small
                 
+        except VisionUnavailable:
+            raise
         except Exception as e:
             logger.error(f"Error estimating size: {str(e)}", exc_info=True)
             return "unknown"
@@ -270,6 +449,9 @@ class FirebaseVisionService:
                 "text": "extracted text",
                 "carriers": ["Amazon", "FedEx"]  # All detected carriers
             }
+            
+        Raises:
+            VisionUnavailable: the API is degraded; retry the analysis later
         """
         if not self.client:
             logger.error("Vision API client not initialized")
@@ -300,7 +482,7 @@ class FirebaseVisionService:
             
             # Calculate overall confidence
             # Use object detection confidence as base
-            response = self.client.object_localization(image=vision_image)
+            response = self._call('object_localization', image=vision_image)
             max_confidence = 0.0
             if response.localized_object_annotations:
                 max_confidence = max(obj.score for obj in response.localized_object_annotations)
@@ -322,6 +504,8 @@ class FirebaseVisionService:
                 "carriers": carriers
             }
             
+        except VisionUnavailable:
+            raise
         except Exception as e:
             logger.error(f"Error analyzing mail: {str(e)}", exc_info=True)
             return {
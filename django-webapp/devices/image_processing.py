@@ -0,0 +1,344 @@
+"""
+Image processing for uploaded captures.
+Normalizes incoming ESP32 frames (downscale, re-encode, strip EXIF) so that
+full-size UXGA frames are never stored or sent to the Vision API, and builds
+size-bounded email thumbnails.
+"""
+import base64
+import io
+import logging
+from collections import namedtuple
+from PIL import Image, ImageOps
+from django.conf import settings
+from django.core.cache import cache
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Metric names
+METRIC_IMAGES_NORMALIZED = 'ingest.images_normalized'
+METRIC_BYTES_RECEIVED = 'ingest.bytes_received'
+METRIC_BYTES_STORED = 'ingest.bytes_stored'
+METRIC_BYTES_SAVED = 'ingest.bytes_saved'
+
+INGEST_METRICS = (
+    METRIC_IMAGES_NORMALIZED,
+    METRIC_BYTES_RECEIVED,
+    METRIC_BYTES_STORED,
+    METRIC_BYTES_SAVED,
+)
+
+NormalizedImage = namedtuple('NormalizedImage', [
+    'storage_data',    # JPEG bytes to persist
+    'analysis_data',   # Smaller JPEG bytes for the Vision API
+    'original_size',   # Size of the uploaded image in bytes
+    'width',           # Storage image width
+    'height',          # Storage image height
+])
+
+
+def _encode_jpeg(image, quality, exif=None):
+    """Encode a PIL image as baseline JPEG bytes"""
+    output = io.BytesIO()
+    save_kwargs = {'format': 'JPEG', 'quality': quality, 'optimize': True}
+    if exif:
+        save_kwargs['exif'] = exif
+    image.save(output, **save_kwargs)
+    return output.getvalue()
+
+
+# Start-of-frame markers (SOF0-SOF15, except DHT, JPG and DAC)
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def jpeg_dimensions(data):
+    """
+    Read a JPEG's size from its header by walking the marker segments, so
+    only the first bytes of an upload are needed (no decoding).
+
+    Args:
+        data: JPEG bytes, or a prefix of them
+
+    Returns:
+        (width, height), or None if the frame header lies beyond data
+
+    Raises:
+        ValueError: If data isn't a well-formed JPEG header
+    """
+    if data[:2] != b'\xff\xd8':
+        raise ValueError('Not a JPEG (missing SOI marker)')
+
+    position = 2
+    while position + 4 <= len(data):
+        if data[position] != 0xFF:
+            raise ValueError(f'Invalid JPEG marker at offset {position}')
+        marker = data[position + 1]
+        if marker == 0xFF:
+            position += 1  # Fill byte
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            position += 2  # Standalone marker
+            continue
+        if marker in (0xD9, 0xDA):
+            raise ValueError('JPEG has no frame header')
+
+        length = int.from_bytes(data[position + 2:position + 4], 'big')
+        if length < 2:
+            raise ValueError(f'Invalid JPEG segment length at offset {position}')
+        if marker in JPEG_SOF_MARKERS:
+            if position + 9 > len(data):
+                return None
+            height = int.from_bytes(data[position + 5:position + 7], 'big')
+            width = int.from_bytes(data[position + 7:position + 9], 'big')
+            if not width or not height:
+                raise ValueError('JPEG has zero width or height')
+            return width, height
+        position += 2 + length
+    return None
+
+
+def normalize_image(image_data):
+    """
+    Produce a storage-sized and an analysis-sized JPEG from uploaded image bytes.
+
+    The image is decoded once. For JPEGs, Image.draft() lets libjpeg decode
+    directly at 1/2, 1/4 or 1/8 scale, so a UXGA frame is never fully
+    decompressed when the configured maximum is much smaller.
+
+    Settings:
+        INGEST_NORMALIZE_ENABLED: Turn normalization on/off (default True)
+        INGEST_MAX_DIMENSION: Longest side of the stored image in px (default 1280)
+        INGEST_ANALYSIS_MAX_DIMENSION: Longest side of the analysis image in px (default 1024)
+        INGEST_JPEG_QUALITY: JPEG quality for re-encoding (default 80)
+        INGEST_STRIP_EXIF: Drop EXIF metadata (default True)
+
+    Args:
+        image_data: Uploaded image bytes
+
+    Returns:
+        NormalizedImage. If the image can't be decoded, or re-encoding would
+        not make it smaller, the original bytes are kept.
+    """
+    original_size = len(image_data)
+    unchanged = NormalizedImage(image_data, image_data, original_size, None, None)
+
+    if not getattr(settings, 'INGEST_NORMALIZE_ENABLED', True):
+        return unchanged
+
+    max_dimension = getattr(settings, 'INGEST_MAX_DIMENSION', 1280)
+    analysis_max_dimension = min(
+        getattr(settings, 'INGEST_ANALYSIS_MAX_DIMENSION', 1024),
+        max_dimension
+    )
+    quality = getattr(settings, 'INGEST_JPEG_QUALITY', 80)
+    strip_exif = getattr(settings, 'INGEST_STRIP_EXIF', True)
+
+    try:
+        image = Image.open(io.BytesIO(image_data))
+        has_exif = 'exif' in image.info
+        exif = None if strip_exif else image.info.get('exif')
+
+        # Reduced-scale JPEG decode; draft() never goes below the requested size
+        if image.format == 'JPEG':
+            image.draft('RGB', (max_dimension, max_dimension))
+        image.load()
+
+        if strip_exif:
+            # Bake orientation into the pixels before the EXIF tag is dropped
+            image = ImageOps.exif_transpose(image)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+        storage_data = _encode_jpeg(image, quality, exif)
+
+        # Never store something bigger than what the device sent
+        if len(storage_data) >= original_size and not (strip_exif and has_exif):
+            storage_data = image_data
+
+        if max(image.size) > analysis_max_dimension:
+            analysis_image = image.copy()
+            analysis_image.thumbnail((analysis_max_dimension, analysis_max_dimension), Image.Resampling.LANCZOS)
+            analysis_data = _encode_jpeg(analysis_image, quality)
+        else:
+            analysis_data = storage_data
+
+        normalized = NormalizedImage(storage_data, analysis_data, original_size, image.width, image.height)
+
+    except Exception as e:
+        logger.warning(f"Image normalization failed, storing original: {str(e)}")
+        return unchanged
+
+    bytes_saved = original_size - len(normalized.storage_data)
+    metrics.increment(METRIC_IMAGES_NORMALIZED)
+    metrics.increment(METRIC_BYTES_RECEIVED, original_size)
+    metrics.increment(METRIC_BYTES_STORED, len(normalized.storage_data))
+    metrics.increment(METRIC_BYTES_SAVED, bytes_saved)
+
+    logger.info(
+        f"Image normalized: {original_size/1024:.1f}KB -> {len(normalized.storage_data)/1024:.1f}KB "
+        f"({normalized.width}x{normalized.height}, saved {bytes_saved/1024:.1f}KB, "
+        f"analysis {len(normalized.analysis_data)/1024:.1f}KB)"
+    )
+    return normalized
+
+
+def normalize_base64_image(base64_image):
+    """
+    Normalize a base64 encoded upload.
+
+    Returns:
+        Tuple of (storage_base64, analysis_base64, original_size_bytes).
+        If the payload isn't valid base64 it is returned unchanged.
+    """
+    try:
+        image_data = base64.b64decode(base64_image)
+    except Exception as e:
+        logger.warning(f"Could not decode uploaded image: {str(e)}")
+        return base64_image, base64_image, len(base64_image) * 3 // 4
+
+    normalized = normalize_image(image_data)
+    if normalized.storage_data is image_data:
+        storage_base64 = base64_image
+    else:
+        storage_base64 = base64.b64encode(normalized.storage_data).decode()
+
+    if normalized.analysis_data is normalized.storage_data:
+        analysis_base64 = storage_base64
+    else:
+        analysis_base64 = base64.b64encode(normalized.analysis_data).decode()
+
+    return storage_base64, analysis_base64, normalized.original_size
+
+
+def create_thumbnail(image_data, max_size_kb=100, quality=80, min_quality=30):
+    """
+    Create a JPEG thumbnail that fits in max_size_kb.
+
+    Dimensions are predicted from the size ratio (JPEG size scales roughly
+    with pixel count), the JPEG is decoded at reduced scale with
+    Image.draft(), and the quality is binary-searched on a 5-step ladder,
+    so at most a handful of small encodes are needed.
+
+    Args:
+        image_data: Original image bytes
+        max_size_kb: Maximum size in KB (default 100KB)
+        quality: Highest JPEG quality to use (default 80)
+        min_quality: Lowest JPEG quality to fall back to (default 30)
+
+    Returns:
+        bytes: Thumbnail image data (the original bytes if it can't be decoded)
+    """
+    target_bytes = max_size_kb * 1024
+    original_size = len(image_data)
+
+    try:
+        image = Image.open(io.BytesIO(image_data))
+
+        # Already small enough: reuse as-is instead of re-encoding
+        if original_size <= target_bytes and image.format == 'JPEG':
+            return image_data
+
+        scale = 1.0
+        if original_size > target_bytes:
+            scale = max(0.1, min(0.9, (target_bytes / original_size) ** 0.5))
+        target_size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+
+        if image.format == 'JPEG':
+            image.draft('RGB', target_size)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        if image.size != target_size:
+            image = image.resize(target_size, Image.Resampling.LANCZOS)
+
+        thumbnail_data = _encode_jpeg(image, quality)
+        if len(thumbnail_data) > target_bytes:
+            thumbnail_data = _fit_quality(image, target_bytes, quality, min_quality)
+
+        if len(thumbnail_data) > target_bytes:
+            # Even min_quality is too big: shrink once more using the observed ratio
+            shrink = max(0.1, (target_bytes / len(thumbnail_data)) ** 0.5 * 0.95)
+            smaller_size = (max(1, int(image.width * shrink)), max(1, int(image.height * shrink)))
+            image = image.resize(smaller_size, Image.Resampling.LANCZOS)
+            thumbnail_data = _encode_jpeg(image, min_quality)
+
+        logger.info(f"Thumbnail created: {original_size/1024:.1f}KB -> {len(thumbnail_data)/1024:.1f}KB")
+        return thumbnail_data
+
+    except Exception as e:
+        logger.error(f"Failed to create thumbnail: {str(e)}", exc_info=True)
+        return image_data
+
+
+def _fit_quality(image, target_bytes, max_quality, min_quality, step=5):
+    """
+    Binary-search the highest quality on a step ladder whose encoding fits
+    target_bytes. Returns the min_quality encoding if nothing fits.
+    """
+    ladder = list(range(min_quality, max_quality, step))
+    if not ladder:
+        return _encode_jpeg(image, min_quality)
+
+    best = None
+    smallest = None
+    lo, hi = 0, len(ladder) - 1
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        candidate = _encode_jpeg(image, ladder[mid])
+        if len(candidate) <= target_bytes:
+            best = candidate
+            lo = mid + 1
+        else:
+            hi = mid - 1
+            if mid == 0:
+                smallest = candidate
+    return best or smallest
+
+
+def get_capture_thumbnail(capture_id, image_base64, max_size_kb=100):
+    """
+    Get the email thumbnail for a capture, generating and caching it on first use.
+
+    Thumbnails are cached per capture and size for THUMBNAIL_CACHE_TTL_SECONDS
+    (default 7 days), so repeat emails never decode the full image again.
+
+    Args:
+        capture_id: Capture ID (cache key)
+        image_base64: Base64 encoded image, or a callable returning it
+            (only evaluated on a cache miss)
+        max_size_kb: Maximum thumbnail size in KB
+
+    Returns:
+        bytes: Thumbnail image data, or None if the image can't be decoded
+    """
+    cache_key = thumbnail_cache_key(capture_id, max_size_kb)
+    try:
+        thumbnail = cache.get(cache_key)
+    except Exception as e:
+        logger.debug(f"Thumbnail cache unavailable: {str(e)}")
+        thumbnail = None
+    if thumbnail is not None:
+        return thumbnail
+
+    if callable(image_base64):
+        image_base64 = image_base64()
+    if not image_base64:
+        return None
+
+    try:
+        image_data = base64.b64decode(image_base64)
+    except Exception as e:
+        logger.error(f"Failed to decode capture {capture_id} image: {str(e)}")
+        return None
+
+    thumbnail = create_thumbnail(image_data, max_size_kb=max_size_kb)
+    try:
+        cache.set(cache_key, thumbnail, timeout=getattr(settings, 'THUMBNAIL_CACHE_TTL_SECONDS', 7 * 24 * 3600))
+    except Exception as e:
+        logger.debug(f"Could not cache thumbnail for capture {capture_id}: {str(e)}")
+    return thumbnail
+
+
+def thumbnail_cache_key(capture_id, max_size_kb):
+    """Cache key for a capture thumbnail of a given size"""
+    return f"thumbnail:{capture_id}:{max_size_kb}"
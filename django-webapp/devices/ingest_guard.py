@@ -0,0 +1,178 @@
+"""
+Upload guard for capture ingest.
+Runs before DRF parses the request: the Content-Length is checked against
+the device's plan ceiling (INGEST_MAX_IMAGE_KB), and the JPEG header (SOI
+marker and frame dimensions) is read from the first base64 bytes of the
+"image" field in the raw body. Oversized or malformed uploads are rejected
+without JSON parsing, base64 decoding of the image or any database write.
+
+Under ASGI the Content-Length check also runs in devices.admission, ahead
+of Django, which otherwise reads the whole body before any view runs.
+"""
+import base64
+import binascii
+import logging
+from django.conf import settings
+from django.core.exceptions import RequestDataTooBig
+from . import metrics
+from .image_processing import jpeg_dimensions
+from .plan_catalogue import get_device_tier
+
+logger = logging.getLogger(__name__)
+
+METRIC_REJECTED_TOO_LARGE = 'ingest.rejected.too_large'
+METRIC_REJECTED_INVALID_IMAGE = 'ingest.rejected.invalid_image'
+
+# JSON fields around the image (serial, trigger type, battery, ...)
+BODY_OVERHEAD_BYTES = 4096
+
+# How far into the body the "image" field and the JPEG frame header are looked for
+HEADER_SCAN_BYTES = 64 * 1024
+
+IMAGE_FIELD = b'"image"'
+
+# Device API endpoints (URL names) that take a capture upload
+UPLOAD_ENDPOINTS = frozenset({'capture_upload', 'capture_upload_sync'})
+
+
+class UploadRejected(Exception):
+    """Upload refused by the guard; carries the HTTP status and reason"""
+
+    def __init__(self, status_code, reason):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+
+
+def max_image_bytes(serial_number=None):
+    """Largest accepted image for a device, by its owner's plan tier"""
+    limits = getattr(settings, 'INGEST_MAX_IMAGE_KB', {})
+    tier = get_device_tier(serial_number) if serial_number else ''
+    return limits.get(tier, limits.get('default', 512)) * 1024
+
+
+def max_body_bytes(serial_number=None):
+    """Largest accepted JSON body: the base64 image plus the other fields"""
+    return max_image_bytes(serial_number) * 4 // 3 + BODY_OVERHEAD_BYTES
+
+
+def _reject(metric, status_code, reason):
+    metrics.increment(metric)
+    logger.warning(f"Upload rejected ({status_code}): {reason}")
+    return UploadRejected(status_code, reason)
+
+
+def reject_too_large(size, limit):
+    """UploadRejected (413) for a body of size bytes over limit"""
+    return _reject(METRIC_REJECTED_TOO_LARGE, 413, f'Upload of {size} bytes exceeds {limit} bytes')
+
+
+def check_content_length(meta, serial_number=None):
+    """
+    Check the declared Content-Length against the device's body ceiling.
+
+    Args:
+        meta: request.META, or the equivalent built from ASGI scope headers
+        serial_number: Authenticated device, for its plan's size limit
+
+    Returns:
+        The body ceiling in bytes, for uploads without a Content-Length
+
+    Raises:
+        UploadRejected: Invalid or oversized Content-Length
+    """
+    limit = max_body_bytes(serial_number)
+    try:
+        content_length = int(meta.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        raise _reject(METRIC_REJECTED_INVALID_IMAGE, 400, 'Invalid Content-Length')
+    if content_length > limit:
+        raise reject_too_large(content_length, limit)
+    return limit
+
+
+def image_base64_prefix(body):
+    """
+    Leading base64 characters of the "image" string in a raw JSON body.
+
+    Returns:
+        bytes, or None if the field isn't near the start of the body
+    """
+    window = body[:HEADER_SCAN_BYTES]
+    start = window.find(IMAGE_FIELD)
+    if start < 0:
+        return None
+    position = start + len(IMAGE_FIELD)
+    while position < len(window) and window[position] in b' \t\r\n:':
+        position += 1
+    if window[position:position + 1] != b'"':
+        return None
+    end = window.find(b'"', position + 1)
+    value = window[position + 1:end if end >= 0 else len(window)]
+    # JSON encoders may escape '/' and keep MIME line breaks
+    return value.replace(b'\\/', b'/').replace(b'\\n', b'').replace(b'\\r', b'')
+
+
+def check_image_header(base64_prefix):
+    """
+    Validate the JPEG header from the start of a base64 image.
+
+    Only the segments within the first HEADER_SCAN_BYTES are walked; if the
+    frame header isn't among them the dimensions are left to the decoder.
+
+    Raises:
+        UploadRejected: Not a JPEG (missing SOI, malformed marker), or larger
+            than INGEST_MAX_IMAGE_DIMENSION
+    """
+    if isinstance(base64_prefix, str):
+        base64_prefix = base64_prefix.encode('ascii', 'replace')
+    chunk = base64_prefix[:HEADER_SCAN_BYTES]
+    try:
+        header = base64.b64decode(chunk[:len(chunk) // 4 * 4], validate=True)
+        dimensions = jpeg_dimensions(header)
+    except (binascii.Error, ValueError) as e:
+        raise _reject(METRIC_REJECTED_INVALID_IMAGE, 400, f'Invalid image: {str(e)}')
+
+    if dimensions is None:
+        # Large APP/COM segments (EXIF, ICC profiles) can push the frame
+        # header past the scan window; the image is decoded at normalization
+        logger.debug("JPEG frame header beyond the scan window; dimensions not checked")
+        return
+    max_dimension = getattr(settings, 'INGEST_MAX_IMAGE_DIMENSION', 2592)
+    if max(dimensions) > max_dimension:
+        raise _reject(
+            METRIC_REJECTED_TOO_LARGE, 413,
+            f'Image is {dimensions[0]}x{dimensions[1]}, limit is {max_dimension}px'
+        )
+
+
+def check_upload(request, serial_number=None):
+    """
+    Check a capture upload before its body is parsed.
+
+    Args:
+        request: Django (or DRF) request whose data has not been accessed yet
+        serial_number: Authenticated device, for its plan's size limit
+
+    Returns:
+        True if the image header was checked here; False if no image was
+        found near the start of the body, in which case the view must call
+        check_image_header() after parsing
+
+    Raises:
+        UploadRejected: Oversized body or image, or not a JPEG
+    """
+    limit = check_content_length(request.META, serial_number)
+    try:
+        body = request.body
+    except RequestDataTooBig:
+        raise _reject(METRIC_REJECTED_TOO_LARGE, 413, 'Upload exceeds DATA_UPLOAD_MAX_MEMORY_SIZE')
+    if len(body) > limit:
+        # Chunked uploads carry no Content-Length
+        raise reject_too_large(len(body), limit)
+
+    prefix = image_base64_prefix(body)
+    if not prefix:
+        return False  # Missing or empty image is reported by the view
+    check_image_header(prefix)
+    return True
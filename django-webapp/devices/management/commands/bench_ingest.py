@@ -0,0 +1,372 @@
+"""
+Management command to benchmark the device ingest endpoints.
+Simulates N ESP32 devices, each sending a sequence of requests (JPEG
+uploads or heartbeats) with its own API key, through the full Django
+request handler against the configured database. Reports latency
+percentiles, throughput and database queries per request for each
+endpoint, and the peak RSS of the whole run (the process peak only ever
+grows, so it can't be split by endpoint; bench one endpoint per run with
+--endpoints to attribute memory).
+
+Runs are repeatable: devices (BENCH-00000...), keys and JPEG payloads are
+derived from --seed, bench devices are deleted before and after the run,
+and the Vision API, channel layer and event log are replaced by in-process
+stand-ins (a fixed --vision-ms delay, the in-memory layer and a no-op).
+Save a run with --output and compare a later release with --compare:
+
+    python manage.py bench_ingest --devices 50 --requests 10 --output before.json
+    python manage.py bench_ingest --devices 50 --requests 10 --compare before.json
+
+Bench devices and the bench user are deleted and recreated in the
+configured database, so the command refuses to run with DEBUG off unless
+--force is given.
+
+Bench devices belong to a "bench-ingest" user on an active --plan
+subscription, so uploads take the billing path of a paying customer.
+device_capture has no URL route, so it is called directly without
+middleware (and is opt-in, see DEFAULT_ENDPOINTS). Query counts are for the request itself; analysis of async
+uploads finishes in the background and is only waited for.
+"""
+import base64
+import io
+import json
+import logging
+import random
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+from devices.device_auth import hash_api_key, invalidate_device_keys
+from devices.models import Device, Capture
+from devices.plan_catalogue import get_plan_by_tier
+from devices.subscription_models import CustomerSubscription
+from devices.views import device_capture
+
+SERIAL_PREFIX = 'BENCH-'
+BENCH_USERNAME = 'bench-ingest'
+
+# name -> URL name, or None for views without a route
+ENDPOINTS = {
+    'capture_upload': 'devices:capture_upload',
+    'capture_upload_sync': 'devices:capture_upload_sync',
+    'device_capture': None,
+    'device_heartbeat': 'devices:device_heartbeat',
+}
+UPLOAD_ENDPOINTS = {'capture_upload', 'capture_upload_sync', 'device_capture'}
+# device_capture is opt-in: it still calls Device methods that no longer exist and fails with 500
+DEFAULT_ENDPOINTS = ['capture_upload', 'capture_upload_sync', 'device_heartbeat']
+
+IN_MEMORY_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+# Compared fields and the relative change reported as a regression
+REGRESSION_THRESHOLD = 0.10
+
+
+class SimulatedVisionService:
+    """Vision stand-in with a fixed round-trip time"""
+
+    def __init__(self, delay_seconds):
+        self.delay_seconds = delay_seconds
+
+    def analyze_mail(self, base64_image):
+        time.sleep(self.delay_seconds)
+        return {'type': 'letter', 'size': 'small', 'carrier': None, 'confidence': 0.9}
+
+
+def make_frame(rng, width, height, quality):
+    """Deterministic JPEG (smooth shapes plus sensor grain) that compresses roughly like a camera frame"""
+    shapes = Image.frombytes('L', (width // 16, height // 16), rng.randbytes((width // 16) * (height // 16)))
+    grain = Image.frombytes('L', (width, height), rng.randbytes(width * height))
+    frame = Image.blend(shapes.resize((width, height), Image.Resampling.BICUBIC), grain, 0.03).convert('RGB')
+    output = io.BytesIO()
+    frame.save(output, format='JPEG', quality=quality)
+    return output.getvalue()
+
+
+def with_comment(jpeg, comment):
+    """Insert a COM segment after SOI so every upload has distinct bytes (no analysis cache hits)"""
+    comment = comment.encode()
+    return jpeg[:2] + b'\xff\xfe' + (len(comment) + 2).to_bytes(2, 'big') + comment + jpeg[2:]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process, or None where unsupported"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class Command(BaseCommand):
+    help = 'Benchmark device ingest endpoints with simulated devices'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--devices', type=int, default=20, help='Simulated devices (default: 20)')
+        parser.add_argument('--requests', type=int, default=5, help='Requests per device and endpoint (default: 5)')
+        parser.add_argument('--concurrency', type=int, default=4, help='Devices sending at once (default: 4)')
+        parser.add_argument(
+            '--endpoints', nargs='*', choices=list(ENDPOINTS), default=DEFAULT_ENDPOINTS,
+            help=f'Endpoints to benchmark (default: {" ".join(DEFAULT_ENDPOINTS)})'
+        )
+        parser.add_argument('--image-size', default='800x600', help='JPEG frame size (default: 800x600)')
+        parser.add_argument('--quality', type=int, default=80, help='JPEG quality (default: 80)')
+        parser.add_argument('--vision-ms', type=int, default=300, help='Simulated Vision API time (default: 300)')
+        parser.add_argument('--plan', default='premium', help='Plan tier of the bench devices\' owner (default: premium)')
+        parser.add_argument('--seed', type=int, default=42, help='Seed for payloads and keys (default: 42)')
+        parser.add_argument('--output', help='Write results as JSON to this file')
+        parser.add_argument('--compare', help='JSON results of a previous run to compare against')
+        parser.add_argument('--keep', action='store_true', help='Keep the bench devices and captures afterwards')
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Run with DEBUG off (deletes and recreates the bench user and devices in the configured database)'
+        )
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options['force']:
+            raise CommandError(
+                'DEBUG is off: this may be a production database. bench_ingest deletes and recreates '
+                f'the "{BENCH_USERNAME}" user and {SERIAL_PREFIX}* devices; pass --force to run anyway'
+            )
+        try:
+            width, height = (int(value) for value in options['image_size'].lower().split('x'))
+        except ValueError:
+            raise CommandError('--image-size must look like 800x600')
+        if options['devices'] < 1 or options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--devices, --requests and --concurrency must be at least 1')
+        baseline = None
+        if options['compare']:
+            try:
+                with open(options['compare']) as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f'Could not read {options["compare"]}: {e}')
+
+        plan = get_plan_by_tier(options['plan'])
+        if plan is None:
+            raise CommandError(f'No active "{options["plan"]}" plan (run create_subscription_plans first)')
+
+        rng = random.Random(options['seed'])
+        frames = [make_frame(rng, width, height, options['quality']) for _ in range(4)]
+
+        vision = SimulatedVisionService(options['vision_ms'] / 1000)
+        if options['verbosity'] < 2:
+            logging.disable(logging.WARNING)
+        try:
+            with override_settings(
+                CHANNEL_LAYERS=IN_MEMORY_LAYERS,
+                DEVICE_RATE_LIMITS={},
+                ALLOWED_HOSTS=['testserver'],
+            ), mock.patch('devices.firebase_vision.get_vision_service', return_value=vision), \
+                    mock.patch('devices.realtime.append_event', return_value=None):
+                self._delete_bench_devices()
+                credentials = self._create_devices(options['devices'], plan, rng)
+                try:
+                    results = self._run(credentials, frames, options)
+                finally:
+                    if not options['keep']:
+                        self._delete_bench_devices()
+        finally:
+            logging.disable(logging.NOTSET)
+
+        report = {
+            'config': {
+                key: options[key] for key in
+                ('devices', 'requests', 'concurrency', 'image_size', 'quality', 'vision_ms', 'plan', 'seed')
+            },
+            'database': connection.vendor,
+            'frame_kb': round(statistics.mean(len(frame) for frame in frames) / 1024, 1),
+            'peak_rss_mb': round(peak_rss_mb() or 0, 1),
+            'endpoints': results,
+        }
+        self._print_report(report, baseline)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f'Results written to {options["output"]}')
+        self.stdout.write(self.style.SUCCESS('\nBenchmark complete'))
+
+    def _delete_bench_devices(self):
+        Device.objects.filter(serial_number__startswith=SERIAL_PREFIX).delete()
+        User.objects.filter(username=BENCH_USERNAME).delete()
+
+    def _create_devices(self, count, plan, rng):
+        """
+        Register bench devices, owned by a user on an active subscription,
+        with seeded API keys.
+
+        Returns:
+            [(serial number, API key)]
+        """
+        owner = User.objects.create_user(username=BENCH_USERNAME)
+        now = timezone.now()
+        CustomerSubscription.objects.create(
+            user=owner, plan=plan, status='active',
+            current_period_start=now, current_period_end=now + timedelta(days=30)
+        )
+        credentials = [(f'{SERIAL_PREFIX}{index:05d}', rng.randbytes(32).hex()) for index in range(count)]
+        Device.objects.bulk_create([
+            Device(
+                serial_number=serial_number, owner=owner, status='offline',
+                lifecycle_state='active_subscription', api_key_hash=hash_api_key(api_key)
+            )
+            for serial_number, api_key in credentials
+        ])
+        invalidate_device_keys()
+        return credentials
+
+    def _run(self, credentials, frames, options):
+        results = {}
+        for name in options['endpoints']:
+            self.stdout.write(f'Running {name}: {len(credentials)} devices x {options["requests"]} requests...')
+            samples = []
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+                for device_samples in pool.map(
+                    lambda item: self._simulate_device(name, item[0], item[1], frames, options['requests']),
+                    enumerate(credentials)
+                ):
+                    samples.extend(device_samples)
+            wall_seconds = time.perf_counter() - start
+            if name == 'capture_upload':
+                self._wait_for_background_analysis()
+            results[name] = self._summarize(samples, wall_seconds)
+        return results
+
+    def _simulate_device(self, name, index, credential, frames, count):
+        """Send count requests as one device; returns [(ms, queries, status)]"""
+        serial_number, api_key = credential
+        headers = {'HTTP_AUTHORIZATION': f'Device {serial_number}:{api_key}'}
+        client = Client()
+        factory = RequestFactory()
+        samples = []
+        try:
+            for n in range(count):
+                if name in UPLOAD_ENDPOINTS:
+                    jpeg = with_comment(frames[(index + n) % len(frames)], f'{serial_number}/{name}/{n}')
+                    body = {
+                        'image': base64.b64encode(jpeg).decode(),
+                        'trigger_type': 'automatic',
+                        'door_open': False,
+                        'battery_voltage': 3.9,
+                        'solar_charging': False,
+                        'connection_type': 'wifi',
+                    }
+                else:
+                    body = {'connection_type': 'wifi'}
+                payload = json.dumps(body)
+
+                with CaptureQueriesContext(connection) as queries:
+                    start = time.perf_counter()
+                    if ENDPOINTS[name]:
+                        response = client.post(
+                            reverse(ENDPOINTS[name]), payload, content_type='application/json', **headers
+                        )
+                    else:
+                        request = factory.post('/', payload, content_type='application/json', **headers)
+                        response = device_capture(request)
+                        response.render()
+                    elapsed_ms = (time.perf_counter() - start) * 1000
+                samples.append((elapsed_ms, len(queries), response.status_code))
+        finally:
+            connection.close()
+        return samples
+
+    def _wait_for_background_analysis(self, timeout_seconds=120):
+        """Async uploads are analyzed after the response; wait so phases don't overlap"""
+        pending = Capture.objects.filter(device__serial_number__startswith=SERIAL_PREFIX, analysis_pending=True)
+        deadline = time.monotonic() + timeout_seconds
+        while pending.exists() and time.monotonic() < deadline:
+            time.sleep(0.2)
+
+    def _summarize(self, samples, wall_seconds):
+        latencies = sorted(sample[0] for sample in samples)
+        queries = [sample[1] for sample in samples]
+        statuses = {}
+        for _, _, status_code in samples:
+            statuses[str(status_code)] = statuses.get(str(status_code), 0) + 1
+        return {
+            'requests': len(samples),
+            'throughput_rps': round(len(samples) / max(wall_seconds, 1e-6), 1),
+            'p50_ms': round(percentile(latencies, 0.50), 1),
+            'p95_ms': round(percentile(latencies, 0.95), 1),
+            'p99_ms': round(percentile(latencies, 0.99), 1),
+            'queries_mean': round(statistics.mean(queries), 1),
+            'queries_max': max(queries),
+            'statuses': statuses,
+        }
+
+    def _print_report(self, report, baseline):
+        config = report['config']
+        self.stdout.write(
+            f'\nIngest benchmark: {config["devices"]} devices x {config["requests"]} requests, '
+            f'concurrency {config["concurrency"]}, {config["image_size"]} frames ({report["frame_kb"]}KB), '
+            f'Vision {config["vision_ms"]}ms, {report["database"]}\n'
+        )
+        self.stdout.write(
+            f'{"endpoint":<21}{"req/s":>8}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}'
+            f'{"queries":>9}{"max q":>7}  statuses'
+        )
+        for name, result in report['endpoints'].items():
+            self.stdout.write(
+                f'{name:<21}{result["throughput_rps"]:>8.1f}{result["p50_ms"]:>9.1f}{result["p95_ms"]:>9.1f}'
+                f'{result["p99_ms"]:>9.1f}{result["queries_mean"]:>9.1f}{result["queries_max"]:>7}'
+                f'  {result["statuses"]}'
+            )
+        self.stdout.write(f'\nPeak RSS (whole run): {report["peak_rss_mb"]:.1f} MB')
+
+        if baseline is None:
+            return
+        if baseline.get('config') != config:
+            self.stdout.write(self.style.WARNING('\nBaseline was run with different options; deltas are indicative only'))
+        self.stdout.write('\nChange against baseline:')
+        regressions = 0
+        for name, result in report['endpoints'].items():
+            previous = baseline.get('endpoints', {}).get(name)
+            if not previous:
+                continue
+            deltas = []
+            # (field, higher is worse)
+            for field, worse_if_higher in (
+                ('throughput_rps', False), ('p50_ms', True), ('p95_ms', True),
+                ('p99_ms', True), ('queries_mean', True),
+            ):
+                before, after = previous.get(field), result[field]
+                if not before:
+                    continue
+                change = (after - before) / before
+                regressed = (change if worse_if_higher else -change) > REGRESSION_THRESHOLD
+                regressions += regressed
+                text = f'{field} {change:+.0%}'
+                deltas.append(self.style.ERROR(text) if regressed else text)
+            self.stdout.write(f'  {name:<21}' + ', '.join(deltas))
+        before, after = baseline.get('peak_rss_mb'), report['peak_rss_mb']
+        if before and after:
+            change = (after - before) / before
+            regressed = change > REGRESSION_THRESHOLD
+            regressions += regressed
+            text = f'peak_rss_mb {change:+.0%}'
+            self.stdout.write(f'  {"whole run":<21}' + (self.style.ERROR(text) if regressed else text))
+        if regressions:
+            self.stdout.write(self.style.ERROR(
+                f'{regressions} metric(s) regressed by more than {REGRESSION_THRESHOLD:.0%}'
+            ))
@@ -0,0 +1,110 @@
+"""
+Management command to benchmark email thumbnail generation.
+Compares the previous resize-then-lower-quality loop with the draft-decode
+engine in devices.image_processing.
+
+Run: python manage.py bench_thumbnails
+     python manage.py bench_thumbnails --images a.jpg b.jpg --size-kb 50 --repeat 20
+"""
+import io
+import statistics
+import time
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image
+from devices.image_processing import create_thumbnail
+
+# (label, width, height, quality) of synthetic ESP32-like frames
+SAMPLE_FRAMES = [
+    ('UXGA q90', 1600, 1200, 90),
+    ('SXGA q85', 1280, 1024, 85),
+    ('SVGA q80', 800, 600, 80),
+]
+
+
+def legacy_create_thumbnail(image_data, max_size_kb=100, quality=80):
+    """Reference copy of the previous email_service.create_thumbnail algorithm"""
+    image = Image.open(io.BytesIO(image_data))
+    original_size = len(image_data) / 1024
+    target_size_kb = max_size_kb
+
+    if original_size <= target_size_kb:
+        output = io.BytesIO()
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.save(output, format='JPEG', quality=quality, optimize=True)
+        return output.getvalue()
+
+    scale_factor = (target_size_kb / original_size) ** 0.5
+    scale_factor = max(0.1, min(0.9, scale_factor))
+    new_width = int(image.width * scale_factor)
+    new_height = int(image.height * scale_factor)
+    image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=quality, optimize=True)
+    thumbnail_data = output.getvalue()
+
+    while len(thumbnail_data) / 1024 > target_size_kb and quality > 30:
+        quality -= 10
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=quality, optimize=True)
+        thumbnail_data = output.getvalue()
+
+    return thumbnail_data
+
+
+def make_sample_jpeg(width, height, quality):
+    """Build a noisy gradient JPEG that compresses roughly like a camera frame"""
+    noise = Image.effect_noise((width, height), 40).convert('RGB')
+    gradient = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    frame = Image.blend(noise, gradient, 0.6)
+    output = io.BytesIO()
+    frame.save(output, format='JPEG', quality=quality)
+    return output.getvalue()
+
+
+class Command(BaseCommand):
+    help = 'Benchmark legacy vs draft-decode thumbnail generation on sample JPEGs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', nargs='*', default=[], help='JPEG files to use instead of synthetic frames')
+        parser.add_argument('--size-kb', type=int, default=100, help='Thumbnail size target in KB (default: 100)')
+        parser.add_argument('--repeat', type=int, default=10, help='Runs per image and path (default: 10)')
+
+    def handle(self, *args, **options):
+        samples = []
+        for path in options['images']:
+            try:
+                with open(path, 'rb') as f:
+                    samples.append((path, f.read()))
+            except OSError as e:
+                raise CommandError(f'Could not read {path}: {e}')
+        if not samples:
+            samples = [(label, make_sample_jpeg(w, h, q)) for label, w, h, q in SAMPLE_FRAMES]
+
+        size_kb = options['size_kb']
+        repeat = options['repeat']
+
+        self.stdout.write(f'Thumbnail benchmark: target {size_kb}KB, {repeat} runs per path\n')
+        self.stdout.write(f'{"image":<14}{"input":>10}{"legacy ms":>12}{"new ms":>10}{"speedup":>9}{"legacy KB":>11}{"new KB":>9}')
+
+        for label, image_data in samples:
+            legacy_ms, legacy_out = self._time(legacy_create_thumbnail, image_data, size_kb, repeat)
+            new_ms, new_out = self._time(create_thumbnail, image_data, size_kb, repeat)
+            self.stdout.write(
+                f'{label[:13]:<14}{len(image_data)/1024:>8.0f}KB'
+                f'{legacy_ms:>12.1f}{new_ms:>10.1f}{legacy_ms / max(new_ms, 1e-6):>8.1f}x'
+                f'{len(legacy_out)/1024:>11.1f}{len(new_out)/1024:>9.1f}'
+            )
+
+    def _time(self, func, image_data, size_kb, repeat):
+        """Return (median milliseconds, last output) for func over repeat runs"""
+        timings = []
+        output = b''
+        for _ in range(repeat):
+            start = time.perf_counter()
+            output = func(image_data, max_size_kb=size_kb)
+            timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings), output
@@ -2,10 +2,10 @@
 Management command to check and suspend devices after grace period.
 Run daily via cron: python manage.py check_suspended_devices
 """
+from collections import Counter
 from django.core.management.base import BaseCommand
-from django.utils import timezone
-from devices.models import Device
-from devices.subscription_models import CustomerSubscription
+from django.contrib.auth.models import User
+from devices.billing import suspend_devices_past_grace
 import logging
 
 logger = logging.getLogger(__name__)
@@ -14,37 +14,26 @@ logger = logging.getLogger(__name__)
 class Command(BaseCommand):
     help = 'Check suspended subscriptions and suspend devices after grace period'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report the devices that would be suspended without changing them')
+        parser.add_argument('--chunk-size', type=int, help='Devices per UPDATE (default: DEVICE_SUSPEND_CHUNK_SIZE)')
+
     def handle(self, *args, **options):
         self.stdout.write('Checking suspended subscriptions...')
         
-        now = timezone.now()
-        
-        # Find subscriptions in grace period that have expired
-        expired_subscriptions = CustomerSubscription.objects.filter(
-            status='suspended',
-            grace_period_end__lte=now
-        )
-        
-        suspended_count = 0
+        dry_run = options['dry_run']
+        devices = suspend_devices_past_grace(chunk_size=options['chunk_size'], dry_run=dry_run)
         
-        for subscription in expired_subscriptions:
-            # Suspend all devices for this user
-            devices = Device.objects.filter(owner=subscription.user, lifecycle_state='active_subscription')
-            
-            for device in devices:
-                device.suspend()
-                suspended_count += 1
-                self.stdout.write(
-                    self.style.WARNING(f'Suspended device {device.serial_number} for {subscription.user.username}')
-                )
+        # Per-owner summary (one query for the usernames)
+        per_owner = Counter(owner_id for _, _, owner_id in devices)
+        usernames = dict(User.objects.filter(id__in=per_owner).values_list('id', 'username'))
+        verb = 'Would suspend' if dry_run else 'Suspended'
+        for owner_id, count in per_owner.most_common():
+            self.stdout.write(
+                self.style.WARNING(f'{verb} {count} device(s) for {usernames.get(owner_id, owner_id)}')
+            )
         
-        self.stdout.write(
-            self.style.SUCCESS(f'\nSuspended {suspended_count} device(s) after grace period')
-        )
-
-
-
-
-
-
-
+        if dry_run:
+            self.stdout.write(self.style.SUCCESS(f'\nDry run: {len(devices)} device(s) would be suspended after grace period'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'\nSuspended {len(devices)} device(s) after grace period'))
@@ -0,0 +1,41 @@
+"""
+Management command to issue per-device API keys.
+Keys are printed once (only a hash is stored); flash them into the
+device configuration. Unknown serials are registered with --create.
+
+    python manage.py issue_device_keys ESP-A1B2C3 ESP-D4E5F6 --create
+    python manage.py issue_device_keys --missing   # every device without a key
+
+Set DEVICE_AUTH_REQUIRED=True only once every fielded device has been
+flashed with its key; until then keyless devices would get 401.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from devices.models import Device
+
+
+class Command(BaseCommand):
+    help = 'Issue (or rotate) API keys for devices'
+
+    def add_arguments(self, parser):
+        parser.add_argument('serials', nargs='*', help='Device serial numbers')
+        parser.add_argument('--create', action='store_true', help='Register serials that do not exist yet')
+        parser.add_argument('--missing', action='store_true', help='Issue keys to every device without one')
+
+    def handle(self, *args, **options):
+        if not options['serials'] and not options['missing']:
+            raise CommandError('Pass serial numbers or --missing')
+
+        devices = list(Device.objects.filter(serial_number__in=options['serials']))
+        unknown = set(options['serials']) - {device.serial_number for device in devices}
+        if unknown and not options['create']:
+            raise CommandError(f'Unknown serial(s): {", ".join(sorted(unknown))} (use --create to register them)')
+        for serial_number in sorted(unknown):
+            devices.append(Device(serial_number=serial_number, status='offline', lifecycle_state='pre_activation'))
+        if options['missing']:
+            devices += list(Device.objects.filter(api_key_hash='').exclude(serial_number__in=options['serials']))
+
+        for device in devices:
+            api_key = device.issue_api_key()
+            self.stdout.write(f'{device.serial_number}:{api_key}')
+
+        self.stdout.write(self.style.SUCCESS(f'\nIssued {len(devices)} key(s); they are not stored and cannot be shown again'))
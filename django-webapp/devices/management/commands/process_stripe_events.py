@@ -0,0 +1,25 @@
+"""
+Management command to apply pending Stripe webhook events from the ledger.
+Events are normally applied in the background right after the webhook
+returns; this sweeps up anything left behind (worker restarts, retries).
+Run every minute via cron: python manage.py process_stripe_events
+"""
+from django.core.management.base import BaseCommand
+from devices.stripe_events import process_pending_events
+from devices.subscription_models import StripeEvent
+
+
+class Command(BaseCommand):
+    help = 'Apply pending Stripe webhook events in order per subscription'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=1000, help='Maximum subscriptions per run (default: 1000)')
+
+    def handle(self, *args, **options):
+        processed = process_pending_events(limit=options['limit'])
+
+        pending = StripeEvent.objects.filter(status='pending').count()
+        failed = StripeEvent.objects.filter(status='failed').count()
+        if failed:
+            self.stdout.write(self.style.WARNING(f'{failed} event(s) failed permanently (see admin)'))
+        self.stdout.write(self.style.SUCCESS(f'Processed {processed} event(s), {pending} still pending'))
@@ -0,0 +1,60 @@
+"""
+Management command to analyze captures deferred while the Vision API was unavailable.
+Run every few minutes via cron: python manage.py reanalyze_pending_captures
+
+Also picks up async uploads whose background analysis never finished; captures
+younger than IN_FLIGHT_SECONDS are left to the upload's own background worker.
+"""
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from devices.models import Capture
+from devices.api_views import analyze_capture_async
+from devices.firebase_vision import get_circuit_breaker, CircuitBreaker
+import logging
+
+logger = logging.getLogger(__name__)
+
+IN_FLIGHT_SECONDS = 120
+
+
+class Command(BaseCommand):
+    help = 'Run Vision analysis for captures marked as pending analysis'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=100,
+            help='Maximum number of captures to analyze in this run (default: 100)'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write('Analyzing pending captures...')
+
+        # The breaker is per process and starts closed; it only tells us
+        # something once this run's own calls have failed
+        breaker = get_circuit_breaker()
+
+        pending = Capture.objects.filter(
+            analysis_pending=True,
+            analysis__isnull=True,
+            timestamp__lte=timezone.now() - timedelta(seconds=IN_FLIGHT_SECONDS)
+        ).select_related('device', 'device__owner').order_by('timestamp')[:options['limit']]
+
+        analyzed = 0
+        deferred = 0
+
+        for capture in pending:
+            if analyze_capture_async(capture):
+                analyzed += 1
+            else:
+                deferred += 1
+                # Stop early instead of hammering a degraded API
+                if breaker.state == CircuitBreaker.OPEN:
+                    self.stdout.write(self.style.WARNING('Vision API circuit breaker opened, stopping'))
+                    break
+
+        self.stdout.write(
+            self.style.SUCCESS(f'\nAnalyzed {analyzed} capture(s), {deferred} still pending')
+        )
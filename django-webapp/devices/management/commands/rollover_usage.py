@@ -0,0 +1,33 @@
+"""
+Management command to pre-create monthly DataUsage rows.
+Creates next month's usage record for every active device so captures on
+the 1st only update existing rows. Safe to repeat; run daily via cron:
+python manage.py rollover_usage
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from devices.billing import precreate_usage_records
+
+
+class Command(BaseCommand):
+    help = "Pre-create DataUsage rows for next month (and fill any gaps in the current month)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--month', help='Only this month, as YYYY-MM')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per bulk insert (default: 1000)')
+
+    def handle(self, *args, **options):
+        if options['month']:
+            try:
+                year, month = (int(part) for part in options['month'].split('-'))
+            except ValueError:
+                raise CommandError('--month must be YYYY-MM')
+            periods = [(year, month)]
+        else:
+            now = timezone.now()
+            next_year, next_month = (now.year + 1, 1) if now.month == 12 else (now.year, now.month + 1)
+            periods = [(now.year, now.month), (next_year, next_month)]
+
+        for year, month in periods:
+            covered = precreate_usage_records(year, month, batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f'{year}/{month:02d}: usage records ready for {covered} device(s)'))
@@ -0,0 +1,110 @@
+"""
+Lightweight operational counters.
+Counters live in the Django cache so they are shared between workers
+whenever a shared cache backend (Redis) is configured.
+
+Every update is a cache round trip; async code uses the a-prefixed
+variants, which run them off the event loop.
+"""
+import logging
+from typing import Dict, Iterable
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+METRICS_KEY_PREFIX = 'metrics:'
+
+
+def _key(name: str) -> str:
+    return f"{METRICS_KEY_PREFIX}{name}"
+
+
+def increment(name: str, amount: int = 1):
+    """
+    Increment a counter. Never raises: metrics must not break request handling.
+
+    Args:
+        name: Counter name (e.g. 'ingest.bytes_saved')
+        amount: Amount to add (default 1)
+    """
+    key = _key(name)
+    try:
+        cache.add(key, 0, timeout=None)
+        cache.incr(key, amount)
+    except ValueError:
+        # Key evicted between add() and incr()
+        cache.set(key, amount, timeout=None)
+    except Exception as e:
+        logger.debug(f"Could not increment metric {name}: {str(e)}")
+
+
+def increment_many(counts: Dict[str, int]):
+    """Increment several counters (name -> amount)"""
+    for name, amount in counts.items():
+        increment(name, amount)
+
+
+def adjust_gauge(name: str, amount: int, timeout: int):
+    """
+    Add to a gauge (e.g. open connections in a group) and renew its TTL.
+    The TTL drops counts leaked by workers that died without decrementing;
+    decrementing an expired gauge is ignored rather than going negative.
+
+    Args:
+        name: Gauge name
+        amount: Amount to add (negative to subtract)
+        timeout: Seconds the gauge lives after its last change
+    """
+    key = _key(name)
+    try:
+        if amount > 0:
+            cache.add(key, 0, timeout=timeout)
+        cache.incr(key, amount)
+        cache.touch(key, timeout)
+    except ValueError:
+        # Expired (or evicted between add() and incr())
+        if amount > 0:
+            cache.set(key, amount, timeout=timeout)
+    except Exception as e:
+        logger.debug(f"Could not adjust metric {name}: {str(e)}")
+
+
+async def aincrement(name: str, amount: int = 1):
+    await sync_to_async(increment, thread_sensitive=False)(name, amount)
+
+
+async def aincrement_many(counts: Dict[str, int]):
+    await sync_to_async(increment_many, thread_sensitive=False)(counts)
+
+
+async def aadjust_gauge(name: str, amount: int, timeout: int):
+    await sync_to_async(adjust_gauge, thread_sensitive=False)(name, amount, timeout)
+
+
+def get_counter(name: str) -> int:
+    """Get the current value of a counter (0 if never incremented)"""
+    try:
+        return cache.get(_key(name), 0)
+    except Exception as e:
+        logger.debug(f"Could not read metric {name}: {str(e)}")
+        return 0
+
+
+def get_counters(names: Iterable[str]) -> Dict[str, int]:
+    """Get several counters in a single cache round trip"""
+    names = list(names)
+    try:
+        values = cache.get_many([_key(name) for name in names])
+    except Exception as e:
+        logger.debug(f"Could not read metrics: {str(e)}")
+        values = {}
+    return {name: values.get(_key(name), 0) for name in names}
+
+
+def reset_counters(names: Iterable[str]):
+    """Reset counters to zero"""
+    try:
+        cache.delete_many([_key(name) for name in names])
+    except Exception as e:
+        logger.debug(f"Could not reset metrics: {str(e)}")
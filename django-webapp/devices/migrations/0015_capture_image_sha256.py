@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0014_merge_20251224_2119'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='capture',
+            name='image_sha256',
+            field=models.CharField(blank=True, db_index=True, help_text='SHA-256 of the decoded image bytes (used to reuse analysis results)', max_length=64),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0015_capture_image_sha256'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='capture',
+            name='analysis_pending',
+            field=models.BooleanField(db_index=True, default=False, help_text='Vision analysis deferred because the API was unavailable'),
+        ),
+    ]
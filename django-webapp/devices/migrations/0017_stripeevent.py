@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0016_capture_analysis_pending'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=255, unique=True)),
+                ('event_type', models.CharField(max_length=100)),
+                ('stripe_subscription_id', models.CharField(blank=True, default='', max_length=255)),
+                ('stripe_created', models.DateTimeField(help_text='When Stripe created the event (ordering key)')),
+                ('payload', models.JSONField(help_text='Event data object')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('processed', 'Processed'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['stripe_created', 'id'],
+                'indexes': [models.Index(fields=['status', 'stripe_subscription_id', 'stripe_created'], name='devices_str_status_c808f9_idx')],
+            },
+        ),
+    ]
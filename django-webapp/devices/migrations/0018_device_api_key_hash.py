@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0017_stripeevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='api_key_hash',
+            field=models.CharField(blank=True, editable=False, help_text='SHA-256 of the device API key', max_length=64),
+        ),
+    ]
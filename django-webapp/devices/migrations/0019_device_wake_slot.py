@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0018_device_api_key_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='wake_slot',
+            field=models.PositiveSmallIntegerField(blank=True, editable=False, help_text='Assigned wake slot within the wake interval', null=True),
+        ),
+    ]
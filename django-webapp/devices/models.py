@@ -73,12 +73,70 @@ class Device(models.Model):
     activated_at = models.DateTimeField(null=True, blank=True, help_text="When device was activated by customer")
     claimed_at = models.DateTimeField(null=True, blank=True, help_text="When device was claimed")
     
+    # API authentication (see devices/device_auth.py)
+    api_key_hash = models.CharField(max_length=64, blank=True, editable=False, help_text="SHA-256 of the device API key")
+    
+    # Fleet wake scheduling (see devices/wake_schedule.py)
+    wake_slot = models.PositiveSmallIntegerField(null=True, blank=True, editable=False, help_text="Assigned wake slot within the wake interval")
+    
     class Meta:
         ordering = ['-last_seen']
     
     def __str__(self):
         return f"{self.serial_number} ({self.status})"
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember ownership as loaded so save() only invalidates the cache when it changes
+        instance._loaded_ownership = (instance.__dict__.get('serial_number'), instance.__dict__.get('owner_id'))
+        instance._loaded_api_key_hash = instance.__dict__.get('api_key_hash')
+        return instance
+    
+    def save(self, *args, **kwargs):
+        loaded = getattr(self, '_loaded_ownership', None)
+        loaded_key_hash = getattr(self, '_loaded_api_key_hash', '')
+        super().save(*args, **kwargs)
+        if self.api_key_hash != loaded_key_hash or (self.api_key_hash and loaded and loaded[0] != self.serial_number):
+            from .device_auth import invalidate_device_keys
+            invalidate_device_keys()
+            self._loaded_api_key_hash = self.api_key_hash
+        current = (self.serial_number, self.owner_id)
+        if loaded != current:
+            from .ownership import invalidate_device_owner
+            if loaded and loaded[0] != current[0]:
+                invalidate_device_owner(loaded[0], loaded[1])
+            invalidate_device_owner(self.serial_number, self.owner_id, loaded[1] if loaded else None)
+            self._loaded_ownership = current
+    
+    def delete(self, *args, **kwargs):
+        serial_number, owner_id = self.serial_number, self.owner_id
+        result = super().delete(*args, **kwargs)
+        from .ownership import invalidate_device_owner
+        invalidate_device_owner(serial_number, owner_id)
+        if self.api_key_hash:
+            from .device_auth import invalidate_device_keys
+            invalidate_device_keys()
+        return result
+    
+    def issue_api_key(self):
+        """
+        Generate a new API key for the device, replacing any previous one.
+        
+        Returns:
+            The plaintext key (only its hash is stored; show it once)
+        """
+        from .device_auth import generate_api_key, hash_api_key
+        api_key = generate_api_key()
+        self.api_key_hash = hash_api_key(api_key)
+        self.save(update_fields=['api_key_hash'] if self.pk else None)
+        return api_key
+    
+    def revoke_api_key(self):
+        """Revoke the device's API key (its requests are rejected until a new key is issued)"""
+        self.api_key_hash = ''
+        self.save(update_fields=['api_key_hash'])
+    
     def can_operate(self):
         """Check if device can operate (has active subscription)"""
         if not self.owner:
@@ -198,6 +256,17 @@ class Capture(models.Model):
     door_open = models.BooleanField(default=False, help_text="Door state when capture was taken")
     battery_voltage = models.FloatField(null=True, blank=True, help_text="Battery voltage at capture time")
     solar_charging = models.BooleanField(default=False, help_text="Solar charging status at capture time")
+    image_sha256 = models.CharField(
+        max_length=64,
+        blank=True,
+        db_index=True,
+        help_text="SHA-256 of the decoded image bytes (used to reuse analysis results)"
+    )
+    analysis_pending = models.BooleanField(
+        default=False,
+        db_index=True,
+        help_text="Vision analysis deferred because the API was unavailable"
+    )
     
     class Meta:
         ordering = ['-timestamp']
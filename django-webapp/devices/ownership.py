@@ -0,0 +1,145 @@
+"""
+Device ownership cache.
+Answers "does this user own this device?" from the shared cache so
+WebSocket connects (and reconnect storms) and HTTP views don't each need a
+DB query. Entries are invalidated whenever a device is created, deleted,
+claimed or reassigned (see Device.save / Device.delete), which also
+invalidates the owners' cached dashboard device lists.
+"""
+import logging
+from django.conf import settings
+from django.core.cache import cache
+from .caching import NAMESPACE_DEVICES, get_or_load, invalidate_namespace
+
+logger = logging.getLogger(__name__)
+
+# Cached value for serial numbers with no device row
+MISSING = (None, None)
+
+
+def _device_key(serial_number):
+    return f"device_owner:{serial_number}"
+
+
+def _user_key(user_id):
+    return f"user_devices:{user_id}"
+
+
+def _ttl():
+    return getattr(settings, 'DEVICE_OWNER_CACHE_SECONDS', 300)
+
+
+def get_cached_device_owner(serial_number):
+    """
+    Cache-only lookup. Still a blocking cache (Redis) call: async code
+    must run it in a thread like any other lookup here.
+
+    Returns:
+        (device_id, owner_id), MISSING if the device is known not to exist,
+        or None on a cache miss
+    """
+    try:
+        return cache.get(_device_key(serial_number))
+    except Exception as e:
+        logger.debug(f"Device owner cache unavailable: {str(e)}")
+        return None
+
+
+def get_device_owner(serial_number):
+    """
+    Look up (device_id, owner_id) for a serial number, filling the cache on a miss.
+
+    Returns:
+        (device_id, owner_id), or MISSING if there is no such device
+    """
+    cached = get_cached_device_owner(serial_number)
+    if cached is not None:
+        return tuple(cached)
+
+    from .models import Device
+    row = Device.objects.filter(serial_number=serial_number).values_list('id', 'owner_id').first()
+    value = tuple(row) if row else MISSING
+    try:
+        cache.set(_device_key(serial_number), value, timeout=_ttl())
+    except Exception as e:
+        logger.debug(f"Could not cache owner of {serial_number}: {str(e)}")
+    return value
+
+
+def get_owned_device_id(serial_number, user_id):
+    """
+    Get the device ID if user_id owns the device.
+
+    Returns:
+        Device ID, or None if the device doesn't exist or belongs to someone else
+    """
+    device_id, owner_id = get_device_owner(serial_number)
+    if device_id is None or owner_id is None or owner_id != user_id:
+        return None
+    return device_id
+
+
+def get_user_device_serials(user_id):
+    """Serial numbers of every device a user owns (cached)"""
+    try:
+        serials = cache.get(_user_key(user_id))
+    except Exception as e:
+        logger.debug(f"Device owner cache unavailable: {str(e)}")
+        serials = None
+    if serials is not None:
+        return serials
+
+    from .models import Device
+    serials = list(Device.objects.filter(owner_id=user_id).values_list('serial_number', flat=True))
+    try:
+        cache.set(_user_key(user_id), serials, timeout=_ttl())
+    except Exception as e:
+        logger.debug(f"Could not cache devices of user {user_id}: {str(e)}")
+    return serials
+
+
+def _device_list_namespace(user_id):
+    return f"{NAMESPACE_DEVICES}:{user_id}"
+
+
+def get_user_device_list(user_id):
+    """
+    Dashboard device list for a user (serial_number, status, last_seen dicts,
+    most recently seen first).
+
+    Cached for DASHBOARD_DEVICE_CACHE_SECONDS (default 30): status and
+    last_seen change on every heartbeat, so they are allowed to be slightly
+    stale rather than invalidated on each check-in. Claims and reassignments
+    invalidate immediately.
+    """
+    from .models import Device
+
+    def load():
+        return list(
+            Device.objects.filter(owner_id=user_id)
+            .order_by('-last_seen')
+            .values('serial_number', 'status', 'last_seen')
+        )
+
+    return get_or_load(
+        _device_list_namespace(user_id), ('list',), load,
+        timeout=getattr(settings, 'DASHBOARD_DEVICE_CACHE_SECONDS', 30)
+    )
+
+
+def invalidate_device_owner(serial_number, *owner_ids):
+    """Drop cached ownership for a device and the device lists of its old/new owners"""
+    owner_ids = [owner_id for owner_id in owner_ids if owner_id]
+    keys = [_device_key(serial_number)] + [_user_key(owner_id) for owner_id in owner_ids]
+    try:
+        cache.delete_many(keys)
+    except Exception as e:
+        logger.warning(f"Could not invalidate ownership cache for {serial_number}: {str(e)}")
+    invalidate_user_device_lists(owner_ids)
+
+
+def invalidate_user_device_lists(owner_ids):
+    """Drop the cached device lists of several users (e.g. after a bulk lifecycle change)"""
+    for owner_id in owner_ids:
+        if owner_id:
+            invalidate_namespace(_device_list_namespace(owner_id))
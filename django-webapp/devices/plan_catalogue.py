@@ -0,0 +1,142 @@
+"""
+In-process SubscriptionPlan catalogue.
+Plans almost never change, so every plan is loaded once per process and
+billing, limit checks and the billing page resolve pricing and limits
+without touching the database or the cache. post_save/post_delete
+signals (see devices/signals.py) reload this process and bump the shared
+'plans' namespace version; other workers check that version at most every
+PLAN_CATALOGUE_CHECK_SECONDS and reload when it has changed. Only reloads
+are counted (cache.plans.misses): a hit counter would cost a round trip
+per lookup.
+
+Returned plans are shared between requests and must not be modified;
+fetch a fresh instance from the ORM to edit a plan.
+"""
+import logging
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+from . import metrics
+from .caching import NAMESPACE_PLANS, namespace_version, versioned_key, invalidate_namespace, get_or_load
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_catalogue = None  # (generation, {plan_id: plan}, {tier: plan}, monotonic time generation was checked)
+
+
+def _load():
+    """Load every plan (inactive plans are kept: existing subscriptions may still use them)"""
+    from .subscription_models import SubscriptionPlan
+
+    plans = list(SubscriptionPlan.objects.order_by('price_monthly'))
+    return {plan.id: plan for plan in plans}, {plan.tier: plan for plan in plans}
+
+
+def _get_catalogue(reload=False):
+    """
+    Current catalogue; reload=True reloads this process's copy without
+    telling other workers (for a lookup miss)
+    """
+    global _catalogue
+    now = time.monotonic()
+    catalogue = _catalogue
+    if not reload and catalogue and now - catalogue[3] < getattr(settings, 'PLAN_CATALOGUE_CHECK_SECONDS', 5):
+        return catalogue
+
+    generation = namespace_version(NAMESPACE_PLANS)
+    if not reload and catalogue and catalogue[0] == generation:
+        catalogue = (generation, catalogue[1], catalogue[2], now)
+        with _lock:
+            _catalogue = catalogue
+        return catalogue
+
+    metrics.increment(f"cache.{NAMESPACE_PLANS}.misses")
+    by_id, by_tier = _load()
+    catalogue = (generation, by_id, by_tier, now)
+    with _lock:
+        _catalogue = catalogue
+    return catalogue
+
+
+def invalidate_plan_catalogue():
+    """Reload plans in this process and tell other workers to reload"""
+    global _catalogue
+    with _lock:
+        _catalogue = None
+    invalidate_namespace(NAMESPACE_PLANS)
+
+
+def get_plan(plan_id):
+    """
+    Get a plan by primary key (e.g. subscription.plan_id).
+
+    Raises:
+        SubscriptionPlan.DoesNotExist: If there is no such plan
+    """
+    plan = _get_catalogue()[1].get(plan_id)
+    if plan is None:
+        # Possibly created by another worker before its invalidation reached
+        # us: reload here only, a stale plan_id mustn't make every worker reload
+        plan = _get_catalogue(reload=True)[1].get(plan_id)
+    if plan is None:
+        from .subscription_models import SubscriptionPlan
+        raise SubscriptionPlan.DoesNotExist(f"No subscription plan with id {plan_id}")
+    return plan
+
+
+def get_plan_by_tier(tier):
+    """Get the active plan for a tier, or None"""
+    plan = _get_catalogue()[2].get(tier)
+    if plan is None or not plan.is_active:
+        return None
+    return plan
+
+
+def get_active_plans():
+    """Active plans, cheapest first"""
+    return [plan for plan in _get_catalogue()[1].values() if plan.is_active]
+
+
+def get_subscription_plan(subscription):
+    """
+    Resolve a subscription's plan from the catalogue and attach it, so later
+    subscription.plan accesses (e.g. in templates) don't query either.
+    """
+    plan = get_plan(subscription.plan_id)
+    subscription.plan = plan
+    return plan
+
+
+def get_user_tier(user_id):
+    """
+    Tier of a user's subscription plan ('' without a subscription).
+    Cached per user for per-tier device limits; subscription saves
+    invalidate it (devices/signals.py).
+    """
+    def load():
+        from .subscription_models import CustomerSubscription
+        plan_id = CustomerSubscription.objects.filter(user_id=user_id).values_list('plan_id', flat=True).first()
+        return get_plan(plan_id).tier if plan_id else ''
+
+    return get_or_load(NAMESPACE_PLANS, ('user_tier', user_id), load,
+                       timeout=getattr(settings, 'DEVICE_OWNER_CACHE_SECONDS', 300))
+
+
+def invalidate_user_tier(user_id):
+    """Forget a user's cached tier (their subscription changed)"""
+    key = versioned_key(NAMESPACE_PLANS, 'user_tier', user_id)
+    try:
+        cache.delete(key)
+    except Exception as e:
+        logger.debug(f"Could not delete {key}: {str(e)}")
+
+
+def get_device_tier(serial_number):
+    """Tier of a device owner's plan ('' for unknown, unclaimed or unsubscribed devices)"""
+    from .ownership import get_device_owner
+    _, owner_id = get_device_owner(serial_number)
+    if owner_id is None:
+        return ''
+    return get_user_tier(owner_id)
@@ -0,0 +1,265 @@
+"""
+Token-bucket rate limiting for the device API (/api/device/).
+A device stuck in a boot loop is turned away with a 429 before its upload
+is parsed. Under ASGI (Daphne) the checks run in devices.admission, an ASGI
+wrapper ahead of Django, because Django's ASGI handler reads the whole body
+before any middleware runs; there a rejected upload is never read.
+DeviceRateLimitMiddleware covers WSGI deployments, where the body is read
+lazily, and skips requests the ASGI wrapper has already admitted. Nginx's
+client_max_body_size caps uploads before either.
+
+Limits are configured per endpoint (URL name) in DEVICE_RATE_LIMITS:
+
+    'capture_upload': {
+        'device': '30/hour',                # per authenticated device
+        'tiers': {'premium': '120/hour'},   # device limit by owner's plan tier
+        'ip': '1200/hour',                  # per client IP (all requests)
+    }
+
+A rate 'N/period' is a bucket of N tokens refilled at N per period, so a
+device may burst N requests and then sustain the average rate. Buckets
+live in Redis (one atomic script call per check) when the cache is Redis,
+and in process memory otherwise. Limiter outages let requests through.
+"""
+import logging
+import math
+import threading
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.urls import resolve, Resolver404
+from . import metrics
+from .device_auth import parse_authorization, verify_device_key
+from .plan_catalogue import get_device_tier
+
+logger = logging.getLogger(__name__)
+
+DEVICE_API_PREFIX = '/api/device/'
+
+# Set in the ASGI scope by devices.admission once a request has been checked
+ADMITTED_SCOPE_KEY = 'device_api_admitted'
+
+METRIC_THROTTLED = 'ratelimit.throttled'
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# KEYS[1]: bucket; ARGV: capacity, refill rate (tokens/second).
+# Returns {allowed (0/1), seconds until the next token (string)}.
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring((1 - tokens) / rate)}
+"""
+
+_lock = threading.Lock()
+_local_buckets = {}  # key -> [tokens, monotonic timestamp]
+LOCAL_MAX_BUCKETS = 10000
+
+_script = None
+
+
+def parse_rate(rate):
+    """
+    Parse 'N/period' (period: s, m, h or d; 'sec', 'min', 'hour', 'day' also work).
+
+    Returns:
+        (capacity, tokens per second)
+    """
+    count, _, period = rate.partition('/')
+    capacity = int(count)
+    return capacity, capacity / PERIODS[period.strip()[0]]
+
+
+def _take_local(key, capacity, rate):
+    now = time.monotonic()
+    with _lock:
+        bucket = _local_buckets.get(key)
+        if bucket is None:
+            if len(_local_buckets) >= LOCAL_MAX_BUCKETS:
+                _local_buckets.clear()  # Forgetting buckets only ever lets requests through
+            bucket = _local_buckets[key] = [capacity, now]
+        tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        bucket[0], bucket[1] = tokens, now
+    return allowed, (1 - tokens) / rate
+
+
+def _get_script():
+    """Registered token bucket script, or None when the cache isn't Redis"""
+    global _script
+    if _script is None:
+        try:
+            from django_redis import get_redis_connection
+            connection = get_redis_connection('default')
+        except (ImportError, NotImplementedError):
+            _script = False  # Not a Redis cache backend
+        else:
+            _script = connection.register_script(TOKEN_BUCKET_SCRIPT)
+    return _script or None
+
+
+def take_token(key, rate):
+    """
+    Take a token from a bucket.
+
+    Args:
+        key: Bucket identity (e.g. 'capture_upload:device:ESP-A1B2C3')
+        rate: 'N/period' rate string
+
+    Returns:
+        (allowed, seconds until a token is available)
+    """
+    capacity, refill = parse_rate(rate)
+    script = _get_script()
+    if script is None:
+        return _take_local(key, capacity, refill)
+    try:
+        allowed, wait = script(keys=[f"smartmailbox:ratelimit:{key}"], args=[capacity, refill])
+        return bool(allowed), float(wait)
+    except Exception as e:
+        logger.debug(f"Rate limiter unavailable: {str(e)}")
+        return True, 0.0
+
+
+def _device_rate(limits, serial_number):
+    tiers = limits.get('tiers')
+    if tiers:
+        tier_rate = tiers.get(get_device_tier(serial_number))
+        if tier_rate:
+            return tier_rate
+    return limits.get('device')
+
+
+def client_ip(meta):
+    """Client address (RATE_LIMIT_CLIENT_IP_HEADER when behind nginx)"""
+    header = getattr(settings, 'RATE_LIMIT_CLIENT_IP_HEADER', '')
+    if header and meta.get(header):
+        return meta[header].split(',')[0].strip()
+    return meta.get('REMOTE_ADDR', '')
+
+
+def device_endpoint(path):
+    """URL name of a device API path, or None for other paths"""
+    if not path.startswith(DEVICE_API_PREFIX):
+        return None
+    try:
+        return resolve(path).url_name
+    except Resolver404:
+        return None
+
+
+def check_limits(endpoint, meta):
+    """
+    Take a token from each of an endpoint's buckets.
+
+    Args:
+        endpoint: Device API URL name
+        meta: request.META, or the equivalent built from ASGI scope headers
+
+    Returns:
+        Seconds to wait (Retry-After) if a bucket is empty, otherwise None
+    """
+    limits = getattr(settings, 'DEVICE_RATE_LIMITS', {}).get(endpoint)
+    if not limits:
+        return None
+
+    checks = []
+    if limits.get('ip'):
+        checks.append(('ip', client_ip(meta), limits['ip']))
+    # Only verified credentials get a device bucket: a spoofed serial can't drain a real device's tokens
+    credentials = parse_authorization(meta.get('HTTP_AUTHORIZATION', ''))
+    if credentials and verify_device_key(*credentials) is not None:
+        rate = _device_rate(limits, credentials[0])
+        if rate:
+            checks.append(('device', credentials[0], rate))
+
+    for scope, identity, rate in checks:
+        allowed, wait = take_token(f"{endpoint}:{scope}:{identity}", rate)
+        if not allowed:
+            metrics.increment(METRIC_THROTTLED)
+            metrics.increment(f"{METRIC_THROTTLED}.{endpoint}.{scope}")
+            logger.warning(f"Rate limited {endpoint} for {scope} {identity}")
+            return max(1, math.ceil(wait))
+    return None
+
+
+def throttled_response(retry_after):
+    """429 response with Retry-After"""
+    response = JsonResponse({'error': 'Rate limit exceeded', 'retry_after': retry_after}, status=429)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
+def check_request(request):
+    """
+    Apply the device API limits to a request.
+
+    Returns:
+        429 response if a bucket is empty, otherwise None
+    """
+    if getattr(request, 'scope', {}).get(ADMITTED_SCOPE_KEY):
+        return None  # Already checked by devices.admission
+    endpoint = device_endpoint(request.path_info)
+    if endpoint is None:
+        return None
+    retry_after = check_limits(endpoint, request.META)
+    if retry_after is None:
+        return None
+    return throttled_response(retry_after)
+
+
+def get_throttle_stats():
+    """Throttled request counters: total and per endpoint/scope"""
+    names = [METRIC_THROTTLED]
+    for endpoint, limits in getattr(settings, 'DEVICE_RATE_LIMITS', {}).items():
+        names += [f"{METRIC_THROTTLED}.{endpoint}.{scope}" for scope in ('device', 'ip') if scope in limits]
+    return metrics.get_counters(names)
+
+
+class DeviceRateLimitMiddleware:
+    """
+    Reject over-limit device API requests before the body is parsed.
+    Under Daphne requests arrive here already checked by devices.admission
+    (with their body read) and pass straight through; under WSGI this is
+    where the limits apply. Async-capable, so async ingest views stay on the
+    event loop under Daphne.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        response = check_request(request)
+        if response is not None:
+            return response
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        if request.path_info.startswith(DEVICE_API_PREFIX) and not request.scope.get(ADMITTED_SCOPE_KEY):
+            # Cache/Redis round trips (and a rare tier lookup) are blocking
+            response = await sync_to_async(check_request)(request)
+            if response is not None:
+                return response
+        return await self.get_response(request)
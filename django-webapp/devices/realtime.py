@@ -0,0 +1,105 @@
+"""
+Real-time feed fan-out.
+Device events are published to the per-device group (ws/device/<serial>/)
+and to the owner's per-user group (ws/feed/), so one browser socket can
+follow every device a user owns. Capture events are also written to the
+device event log so reconnecting clients can resume.
+"""
+import logging
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync, sync_to_async
+from . import metrics
+from .event_log import append_event
+
+logger = logging.getLogger(__name__)
+
+# Metric names
+METRIC_CONNECTIONS = 'ws.connections'
+METRIC_MESSAGES_SENT = 'ws.messages_sent'
+METRIC_MESSAGES_DROPPED = 'ws.messages_dropped'
+METRIC_MESSAGES_COALESCED = 'ws.messages_coalesced'
+GROUP_SIZE_METRIC_PREFIX = 'ws.group_size.'
+
+# Group sizes expire this long after their last join/leave, so counts leaked
+# by a worker that died with sockets open don't outlive it forever
+GROUP_SIZE_TTL = 24 * 3600
+
+# Events replayed to reconnecting clients
+LOGGED_EVENT_TYPES = ('new_capture', 'analysis_complete')
+
+FEED_METRICS = (
+    METRIC_CONNECTIONS,
+    METRIC_MESSAGES_SENT,
+    METRIC_MESSAGES_DROPPED,
+    METRIC_MESSAGES_COALESCED,
+)
+
+
+def device_group_name(serial_number):
+    return f'device_{serial_number}'
+
+
+def user_group_name(user_id):
+    return f'user_{user_id}'
+
+
+def group_size_metric(group_name):
+    return f'{GROUP_SIZE_METRIC_PREFIX}{group_name}'
+
+
+def broadcast_device_event(serial_number, owner_id, event):
+    """
+    Send an event to a device's feed subscribers and its owner's feed.
+
+    Args:
+        serial_number: Device serial number
+        owner_id: Owner user ID (None for unclaimed devices)
+        event: Channel layer message; 'type' selects the consumer handler.
+            serial_number is added so multiplexed feeds can route it, and
+            event_id (from the device event log) so clients can resume.
+
+    Returns:
+        True if the event was handed to the channel layer
+    """
+    channel_layer = get_channel_layer()
+    if not channel_layer:
+        logger.warning("Channel layer not configured, skipping WebSocket notification")
+        return False
+
+    event = {**event, 'serial_number': serial_number}
+    if event['type'] in LOGGED_EVENT_TYPES:
+        event['event_id'] = append_event(serial_number, event)
+    async_to_sync(channel_layer.group_send)(device_group_name(serial_number), event)
+    if owner_id:
+        async_to_sync(channel_layer.group_send)(user_group_name(owner_id), event)
+    return True
+
+
+async def abroadcast_device_event(serial_number, owner_id, event):
+    """
+    broadcast_device_event() for async views: channel layer sends are awaited
+    on the event loop, and only the event log append runs in a thread.
+    """
+    channel_layer = get_channel_layer()
+    if not channel_layer:
+        logger.warning("Channel layer not configured, skipping WebSocket notification")
+        return False
+
+    event = {**event, 'serial_number': serial_number}
+    if event['type'] in LOGGED_EVENT_TYPES:
+        event['event_id'] = await sync_to_async(append_event, thread_sensitive=False)(serial_number, event)
+    await channel_layer.group_send(device_group_name(serial_number), event)
+    if owner_id:
+        await channel_layer.group_send(user_group_name(owner_id), event)
+    return True
+
+
+def get_feed_metrics(group_names=()):
+    """
+    Feed counters plus current subscriber counts for the given groups.
+
+    Returns:
+        Dict of metric name -> value
+    """
+    names = list(FEED_METRICS) + [group_size_metric(group) for group in group_names]
+    return metrics.get_counters(names)
@@ -19,7 +19,7 @@ class DeviceCaptureSerializer(serializers.ModelSerializer):
 
 
 class HeartbeatSerializer(serializers.Serializer):
-    serial_number = serializers.CharField(max_length=100)
+    serial_number = serializers.CharField(max_length=100, required=False)  # Taken from device credentials when present
     connection_type = serializers.ChoiceField(
         choices=[('wifi', 'WiFi'), ('cellular', 'Cellular'), ('unknown', 'Unknown')],
         default='unknown',
@@ -28,7 +28,7 @@ class HeartbeatSerializer(serializers.Serializer):
 
 
 class CaptureRequestSerializer(serializers.Serializer):
-    serial_number = serializers.CharField(max_length=100)
+    serial_number = serializers.CharField(max_length=100, required=False)  # Taken from device credentials when present
     image = serializers.CharField()  # Base64 encoded image
     motion_detected = serializers.BooleanField(default=False, required=False)
     connection_type = serializers.ChoiceField(
@@ -0,0 +1,21 @@
+"""
+Signal handlers for the devices app.
+"""
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .subscription_models import CustomerSubscription, SubscriptionPlan
+from .plan_catalogue import invalidate_plan_catalogue, invalidate_user_tier
+
+
+@receiver(post_save, sender=SubscriptionPlan)
+@receiver(post_delete, sender=SubscriptionPlan)
+def subscription_plan_changed(sender, instance, **kwargs):
+    """Reload the plan catalogue when a plan is added, edited or removed"""
+    invalidate_plan_catalogue()
+
+
+@receiver(post_save, sender=CustomerSubscription)
+@receiver(post_delete, sender=CustomerSubscription)
+def customer_subscription_changed(sender, instance, **kwargs):
+    """Drop the user's cached tier so a plan change applies to their limits at once"""
+    invalidate_user_tier(instance.user_id)
@@ -0,0 +1,233 @@
+"""
+Stripe webhook event ledger.
+The webhook view only verifies the signature and records the event (one
+insert; a duplicate delivery is a unique-key conflict and nothing else),
+then returns 200. Events are applied afterwards - in a background thread
+in the receiving process and by the process_stripe_events command as a
+sweep - in Stripe creation order per subscription, loading and saving each
+subscription once per batch of events.
+"""
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from django.conf import settings
+from django.db import transaction, close_old_connections
+from django.utils import timezone
+from .plan_catalogue import get_plan
+
+logger = logging.getLogger(__name__)
+
+# One thread per process keeps in-process application ordered; row locks
+# keep concurrent processes from applying the same subscription's events
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='stripe-events')
+
+
+def _subscription_id(event_type, data):
+    if event_type.startswith('customer.subscription.'):
+        return data.get('id') or ''
+    return data.get('subscription') or ''
+
+
+def record_event(payload):
+    """
+    Add a verified webhook payload to the ledger.
+
+    Args:
+        payload: Raw request body (already signature-checked)
+
+    Returns:
+        The event's Stripe subscription ID ('' if none)
+    """
+    from .subscription_models import StripeEvent
+
+    event = json.loads(payload)
+    data = event['data']['object']
+    subscription_id = _subscription_id(event['type'], data)
+    StripeEvent.objects.bulk_create([
+        StripeEvent(
+            event_id=event['id'],
+            event_type=event['type'],
+            stripe_subscription_id=subscription_id,
+            stripe_created=datetime.fromtimestamp(event['created'], tz=dt_timezone.utc),
+            payload=data,
+        )
+    ], ignore_conflicts=True)  # Duplicate delivery: unique event_id conflict, no-op
+    return subscription_id
+
+
+def schedule_processing(stripe_subscription_id):
+    """Apply a subscription's pending events in the background (after the response)"""
+    if not getattr(settings, 'STRIPE_EVENTS_PROCESS_IN_BACKGROUND', True):
+        return
+
+    def run():
+        try:
+            process_pending_events(stripe_subscription_id=stripe_subscription_id)
+        except Exception as e:
+            logger.error(f"Background Stripe event processing failed: {str(e)}", exc_info=True)
+        finally:
+            close_old_connections()
+
+    transaction.on_commit(lambda: _executor.submit(run))
+
+
+def apply_event(subscription, event, now):
+    """
+    Apply one event to an in-memory subscription. Event fields are read
+    before the subscription is touched, so a malformed event changes nothing.
+
+    Returns:
+        Unsaved PaymentHistory, or None
+    """
+    from .subscription_models import PaymentHistory
+
+    data = event.payload
+    event_type = event.event_type
+
+    if event_type == 'invoice.payment_succeeded':
+        payment = PaymentHistory(
+            subscription=subscription,
+            amount=Decimal(data['amount_paid']) / 100,
+            status='succeeded',
+            stripe_invoice_id=data['id'],
+            stripe_payment_intent_id=data.get('payment_intent'),
+            paid_at=now,
+            description=f"Monthly subscription - {get_plan(subscription.plan_id).name}"
+        )
+        subscription.status = 'active'
+        subscription.grace_period_end = None
+        return payment
+
+    if event_type == 'invoice.payment_failed':
+        amount_due = data.get('amount_due', 0) or data.get('total', 0)
+        last_error = data.get('last_payment_error') or {}
+        payment = PaymentHistory(
+            subscription=subscription,
+            amount=Decimal(amount_due) / 100,
+            status='failed',
+            stripe_invoice_id=data['id'],
+            failure_reason=last_error.get('message', 'Payment failed') if last_error else 'Payment failed',
+            description=f"Failed payment - {get_plan(subscription.plan_id).name}"
+        )
+        # Devices are suspended after the grace period (check_suspended_devices)
+        subscription.status = 'suspended'
+        subscription.grace_period_end = now + timedelta(days=3)
+        return payment
+
+    if event_type == 'customer.subscription.deleted':
+        subscription.status = 'cancelled'
+        subscription.cancelled_at = now
+        subscription.auto_renew = False
+    elif event_type == 'customer.subscription.updated':
+        period_start = datetime.fromtimestamp(data['current_period_start'], tz=dt_timezone.utc)
+        period_end = datetime.fromtimestamp(data['current_period_end'], tz=dt_timezone.utc)
+        subscription.current_period_start = period_start
+        subscription.current_period_end = period_end
+    return None
+
+
+def _process_subscription_events(stripe_subscription_id, now):
+    """
+    Apply one subscription's pending events in order.
+
+    Returns:
+        Number of events processed
+    """
+    from .subscription_models import CustomerSubscription, PaymentHistory, StripeEvent
+
+    max_attempts = getattr(settings, 'STRIPE_EVENT_MAX_ATTEMPTS', 5)
+    with transaction.atomic():
+        events = list(
+            StripeEvent.objects.select_for_update(skip_locked=True)
+            .filter(status='pending', stripe_subscription_id=stripe_subscription_id)
+            .order_by('stripe_created', 'id')
+        )
+        if not events:
+            return 0
+
+        subscription = None
+        if stripe_subscription_id:
+            subscription = (
+                CustomerSubscription.objects.select_for_update()
+                .filter(stripe_subscription_id=stripe_subscription_id).first()
+            )
+
+        payments = []
+        done = []
+        for event in events:
+            try:
+                if subscription is None:
+                    if stripe_subscription_id:
+                        # Usually the webhook raced the code that stores stripe_subscription_id;
+                        # the event stays pending and the sweep retries it
+                        raise LookupError(f"Subscription {stripe_subscription_id} not found")
+                else:
+                    payment = apply_event(subscription, event, now)
+                    if payment:
+                        payments.append(payment)
+            except Exception as e:
+                # Later events wait for this one, unless it keeps failing
+                event.attempts += 1
+                event.last_error = str(e)
+                if event.attempts >= max_attempts:
+                    event.status = 'failed'
+                    logger.error(f"Giving up on Stripe event {event.event_id}: {str(e)}", exc_info=True)
+                    done.append(event)
+                    continue
+                logger.warning(f"Stripe event {event.event_id} failed (attempt {event.attempts}): {str(e)}")
+                StripeEvent.objects.filter(pk=event.pk).update(attempts=event.attempts, last_error=event.last_error)
+                break
+            event.status = 'processed'
+            event.processed_at = now
+            done.append(event)
+
+        if subscription is not None and done:
+            subscription.updated_at = now
+            subscription.save()
+
+        if payments:
+            # Stripe retries a failed invoice under the same ID, so a payment
+            # is a duplicate only if the invoice already has one with its status
+            recorded = set(PaymentHistory.objects.filter(
+                stripe_invoice_id__in=[payment.stripe_invoice_id for payment in payments]
+            ).values_list('stripe_invoice_id', 'status'))
+            new_payments = []
+            for payment in payments:
+                key = (payment.stripe_invoice_id, payment.status)
+                if key not in recorded:
+                    recorded.add(key)
+                    new_payments.append(payment)
+            PaymentHistory.objects.bulk_create(new_payments, ignore_conflicts=True)
+
+        StripeEvent.objects.bulk_update(done, ['status', 'processed_at', 'attempts', 'last_error'])
+        return len(done)
+
+
+def process_pending_events(stripe_subscription_id=None, limit=1000):
+    """
+    Apply pending ledger events.
+
+    Args:
+        stripe_subscription_id: Only this subscription's events (default: all)
+        limit: Maximum subscriptions to process in one call
+
+    Returns:
+        Number of events processed
+    """
+    from .subscription_models import StripeEvent
+
+    pending = StripeEvent.objects.filter(status='pending')
+    if stripe_subscription_id is not None:
+        pending = pending.filter(stripe_subscription_id=stripe_subscription_id)
+    subscription_ids = (
+        pending.order_by('stripe_subscription_id')
+        .values_list('stripe_subscription_id', flat=True).distinct()[:limit]
+    )
+
+    now = timezone.now()
+    processed = 0
+    for subscription_id in subscription_ids:
+        processed += _process_subscription_events(subscription_id, now)
+    return processed
@@ -214,11 +214,15 @@ class DataUsage(models.Model):
         
         # Calculate overage charges
         self._calculate_overage_charge()
-        self.save()
+        self.save(update_fields=[
+            'notification_count', 'data_used_mb', 'overage_notifications',
+            'overage_data_mb', 'overage_charge', 'updated_at'
+        ])
     
     def _calculate_overage_charge(self):
         """Calculate overage charges based on plan pricing"""
-        plan = self.subscription.plan
+        from .plan_catalogue import get_plan
+        plan = get_plan(self.subscription.plan_id)
         charge = decimal.Decimal('0.00')
         
         if self.overage_notifications > 0:
@@ -274,3 +278,38 @@ class PaymentHistory(models.Model):
 
 
 
+
+
+class StripeEvent(models.Model):
+    """
+    Ledger of received Stripe webhook events.
+    The unique event_id makes duplicate deliveries a no-op insert; pending
+    events are applied asynchronously, in order per subscription.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('processed', 'Processed'),
+        ('failed', 'Failed'),
+    ]
+    
+    event_id = models.CharField(max_length=255, unique=True)
+    event_type = models.CharField(max_length=100)
+    stripe_subscription_id = models.CharField(max_length=255, blank=True, default='')
+    stripe_created = models.DateTimeField(help_text="When Stripe created the event (ordering key)")
+    payload = models.JSONField(help_text="Event data object")
+    
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['stripe_created', 'id']
+        indexes = [
+            models.Index(fields=['status', 'stripe_subscription_id', 'stripe_created']),
+        ]
+    
+    def __str__(self):
+        return f"{self.event_type} {self.event_id} ({self.status})"
@@ -1,3 +1,1041 @@
-from django.test import TestCase
+import base64
+import io
+import json
+import random
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from google.api_core import exceptions as google_exceptions
+from PIL import Image, JpegImagePlugin
+from .admission import DeviceApiAdmission
+from . import views_async, wake_schedule
+from .analysis_cache import analyze_mail_cached, compute_image_hash, get_analysis_cache
+from .billing import (
+    check_usage_limits, create_subscription_plans, precreate_usage_records, record_notification, suspend_devices_past_grace,
+)
+from . import plan_catalogue
+from .billing_runner import ERROR, NO_PAYMENT_METHOD, PAID, PAYMENT_FAILED, billing_period, run_billing
+from .firebase_vision import CircuitBreaker, FirebaseVisionService, VisionUnavailable
+from .device_auth import generate_api_key, hash_api_key, invalidate_device_keys
+from .ingest_guard import UploadRejected, check_image_header, check_upload
+from .email_service import get_photos_for_email, select_event_photo_ids
+from .caching import NAMESPACE_PLANS, invalidate_namespace
+from .event_log import EMPTY_LOG_EVENT_ID, append_event, events_since, latest_event_id
+from . import image_processing
+from .image_processing import create_thumbnail, get_capture_thumbnail, normalize_base64_image, normalize_image
+from .models import Capture, CaptureAnalysis, Device
+from .ownership import get_owned_device_id, get_user_device_list, get_user_device_serials
+from .stripe_events import process_pending_events
+from .subscription_models import CustomerSubscription, DataUsage, PaymentHistory, StripeEvent, SubscriptionPlan
 
-# Create your tests here.
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def make_jpeg(width=640, height=480, comment_bytes=0):
+    """JPEG with an optional COM segment (up to 64KB) before the frame header"""
+    output = io.BytesIO()
+    Image.new('RGB', (width, height), (90, 120, 150)).save(output, format='JPEG', quality=80)
+    jpeg = output.getvalue()
+    if comment_bytes:
+        comment = b'x' * comment_bytes
+        jpeg = jpeg[:2] + b'\xff\xfe' + (len(comment) + 2).to_bytes(2, 'big') + comment + jpeg[2:]
+    return jpeg
+
+
+def make_photo(width=1600, height=1200, orientation=None, seed=1):
+    """Noisy JPEG that compresses like a camera frame; optionally with an EXIF orientation"""
+    noise = Image.frombytes('L', (width // 8, height // 8), random.Random(seed).randbytes(width * height // 64))
+    image = Image.merge('RGB', [noise.resize((width, height))] * 3)
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=90, exif=exif.tobytes())
+    return output.getvalue()
+
+
+@override_settings(CACHES=LOCMEM_CACHES, INGEST_MAX_IMAGE_DIMENSION=2592)
+class UploadGuardTests(SimpleTestCase):
+
+    def test_accepts_jpeg_with_frame_header_beyond_scan_window(self):
+        jpeg = make_jpeg(comment_bytes=60 * 1024)
+        image_base64 = base64.b64encode(jpeg).decode()
+
+        check_image_header(image_base64)
+
+        body = json.dumps({'image': image_base64}).encode()
+        request = RequestFactory().post('/', body, content_type='application/json')
+        self.assertTrue(check_upload(request))
+        storage_base64, _, _ = normalize_base64_image(image_base64)
+        self.assertEqual(Image.open(io.BytesIO(base64.b64decode(storage_base64))).size, (640, 480))
+
+    def test_rejects_missing_soi(self):
+        with self.assertRaises(UploadRejected) as rejected:
+            check_image_header(base64.b64encode(b'GIF89a' + b'\x00' * 64).decode())
+        self.assertEqual(rejected.exception.status_code, 400)
+
+    def test_rejects_malformed_marker(self):
+        with self.assertRaises(UploadRejected) as rejected:
+            check_image_header(base64.b64encode(b'\xff\xd8\x00\x10' + b'\x00' * 64).decode())
+        self.assertEqual(rejected.exception.status_code, 400)
+
+    def test_rejects_oversized_dimensions(self):
+        with self.assertRaises(UploadRejected) as rejected:
+            check_image_header(base64.b64encode(make_jpeg(3000, 16)).decode())
+        self.assertEqual(rejected.exception.status_code, 413)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, INGEST_MAX_DIMENSION=1280, INGEST_ANALYSIS_MAX_DIMENSION=1024)
+class ImageNormalizationTests(SimpleTestCase):
+
+    def test_uxga_frame_is_stored_and_analysed_downscaled(self):
+        photo = make_photo(1600, 1200)
+        real_draft = JpegImagePlugin.JpegImageFile.draft
+        with mock.patch.object(JpegImagePlugin.JpegImageFile, 'draft', autospec=True, side_effect=real_draft) as draft:
+            normalized = normalize_image(photo)
+        # Decoded by libjpeg at reduced scale, not at full UXGA size
+        draft.assert_any_call(mock.ANY, 'RGB', (1280, 1280))
+        self.assertEqual((normalized.width, normalized.height), (1280, 960))
+        self.assertLess(len(normalized.storage_data), len(photo))
+        self.assertEqual(Image.open(io.BytesIO(normalized.analysis_data)).size, (1024, 768))
+
+    def test_orientation_is_applied_before_exif_is_stripped(self):
+        normalized = normalize_image(make_photo(800, 600, orientation=6))  # Rotated 90° clockwise
+        stored = Image.open(io.BytesIO(normalized.storage_data))
+        self.assertEqual(stored.size, (600, 800))
+        self.assertNotIn('exif', stored.info)
+        self.assertIs(normalized.analysis_data, normalized.storage_data)
+
+    def test_undecodable_upload_is_kept(self):
+        normalized = normalize_image(b'\xff\xd8not a jpeg')
+        self.assertEqual(normalized.storage_data, b'\xff\xd8not a jpeg')
+        self.assertIsNone(normalized.width)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ThumbnailTests(SimpleTestCase):
+
+    def setUp(self):
+        encode = image_processing._encode_jpeg
+        patcher = mock.patch('devices.image_processing._encode_jpeg', side_effect=encode)
+        self.encode = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_fits_the_size_bound_in_a_few_encodes(self):
+        photo = make_photo(1600, 1200)
+        thumbnail = create_thumbnail(photo, max_size_kb=20)
+        self.assertLessEqual(len(thumbnail), 20 * 1024)
+        self.assertLess(Image.open(io.BytesIO(thumbnail)).width, 1600)
+        # One encode at full quality plus a binary search over a 10-step ladder
+        self.assertLessEqual(self.encode.call_count, 6)
+
+    def test_small_jpeg_is_reused(self):
+        photo = make_photo(160, 120)
+        self.assertIs(create_thumbnail(photo, max_size_kb=100), photo)
+        self.encode.assert_not_called()
+
+    def test_thumbnail_is_cached_per_capture(self):
+        load_image = mock.Mock(return_value=base64.b64encode(make_photo(1600, 1200)).decode())
+        first = get_capture_thumbnail(41, load_image, max_size_kb=20)
+        self.assertEqual(get_capture_thumbnail(41, load_image, max_size_kb=20), first)
+        load_image.assert_called_once()
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class EventPhotoTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.device = Device.objects.create(serial_number='ESP-EVENT')
+        other_device = Device.objects.create(serial_number='ESP-OTHER')
+        self.image = base64.b64encode(make_photo(320, 240)).decode()
+        now = timezone.now()
+        self.primary = self.add_capture(self.device, now)
+        self.before = self.add_capture(self.device, now - timedelta(seconds=5))
+        self.after = self.add_capture(self.device, now + timedelta(seconds=3))
+        self.add_capture(self.device, now + timedelta(minutes=1))
+        self.add_capture(other_device, now)
+
+    def add_capture(self, device, timestamp):
+        capture = Capture.objects.create(device=device, image_base64=self.image)
+        Capture.objects.filter(pk=capture.pk).update(timestamp=timestamp)
+        capture.timestamp = timestamp
+        return capture
+
+    def test_selects_only_the_same_event(self):
+        self.assertEqual(select_event_photo_ids(self.primary), [self.before.id, self.after.id])
+
+    def test_related_images_are_read_only_on_a_thumbnail_miss(self):
+        related_ids = [self.before.id, self.after.id]
+        with self.assertNumQueries(2):
+            photos = get_photos_for_email(self.primary, related_ids)
+        self.assertEqual([filename for _, filename, _ in photos], [
+            f'mailbox_photo_1_{self.primary.id}.jpg',
+            f'mailbox_photo_2_{self.before.id}.jpg',
+            f'mailbox_photo_3_{self.after.id}.jpg',
+        ])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_photos_for_email(self.primary, related_ids), photos)
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES, INGEST_MAX_IMAGE_KB={'default': 3},
+    DEVICE_RATE_LIMITS={'capture_upload': {'ip': '1/hour'}}
+)
+class DeviceApiAdmissionTests(SimpleTestCase):
+    """Limits apply from the ASGI scope, before the body is received"""
+
+    def call(self, messages, client_ip, headers=()):
+        """Run one request; returns (status, body received by Django or None)"""
+        scope = {
+            'type': 'http', 'method': 'POST', 'path': '/api/device/capture/', 'root_path': '',
+            'client': (client_ip, 5000), 'headers': [(name, value) for name, value in headers],
+        }
+        pending = list(messages)
+        sent = []
+        admitted = []
+
+        async def receive():
+            if not pending:
+                self.fail('Body read past the end of the request')
+            return pending.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        async def django_app(scope, receive, send):
+            body = b''
+            while True:
+                message = await receive()
+                body += message.get('body', b'')
+                if not message.get('more_body'):
+                    break
+            admitted.append(body)
+            await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        async_to_sync(DeviceApiAdmission(django_app))(scope, receive, send)
+        self.unread = len(pending)
+        return sent[0]['status'], admitted[0] if admitted else None
+
+    def test_throttled_request_body_is_not_read(self):
+        body = [{'type': 'http.request', 'body': b'{}'}]
+        headers = [(b'content-length', b'2')]
+        self.assertEqual(self.call(body, '10.0.0.1', headers), (200, b'{}'))
+        self.assertEqual(self.call(body, '10.0.0.1', headers), (429, None))
+        self.assertEqual(self.unread, 1)
+
+    def test_oversized_content_length_is_not_read(self):
+        body = [{'type': 'http.request', 'body': b'x' * 100}]
+        self.assertEqual(self.call(body, '10.0.0.2', [(b'content-length', b'100000')]), (413, None))
+        self.assertEqual(self.unread, 1)
+
+    def test_chunked_upload_is_counted_and_replayed(self):
+        chunks = [{'type': 'http.request', 'body': b'x' * 4096, 'more_body': True} for _ in range(4)]
+        self.assertEqual(self.call(chunks, '10.0.0.3'), (413, None))
+        self.assertEqual(self.unread, 1)
+
+        chunks = [
+            {'type': 'http.request', 'body': b'x' * 4096, 'more_body': True},
+            {'type': 'http.request', 'body': b'y' * 100},
+        ]
+        self.assertEqual(self.call(chunks, '10.0.0.4'), (200, b'x' * 4096 + b'y' * 100))
+
+
+class FakeVisionClient:
+    """Stands in for ImageAnnotatorClient: runs the given behaviour per call"""
+
+    def __init__(self, *behaviours):
+        self.behaviours = list(behaviours)
+        self.calls = []
+
+    def object_localization(self, timeout=None, **kwargs):
+        self.calls.append(timeout)
+        behaviour = self.behaviours.pop(0) if len(self.behaviours) > 1 else self.behaviours[0]
+        return behaviour(timeout)
+
+
+def slow(seconds, result='ok'):
+    """A call taking seconds; exceeds its deadline the way the client does"""
+    def behaviour(timeout):
+        time.sleep(min(seconds, timeout))
+        if seconds > timeout:
+            raise google_exceptions.DeadlineExceeded('Deadline exceeded')
+        return result
+    return behaviour
+
+
+def succeeding(timeout):
+    return 'ok'
+
+
+def failing(error=google_exceptions.ServiceUnavailable):
+    def behaviour(timeout):
+        raise error('Vision API error')
+    return behaviour
+
+
+@override_settings(
+    VISION_CALL_TIMEOUT_SECONDS=0.05, VISION_MAX_RETRIES=2, VISION_RETRY_BASE_DELAY_SECONDS=0.01,
+    VISION_CONCURRENCY_WAIT_SECONDS=0.05,
+)
+class VisionCallTests(SimpleTestCase):
+    """FirebaseVisionService._call() against a slow or failing client"""
+
+    def make_service(self, client, max_concurrency=4, failure_threshold=5, reset_timeout=60):
+        with mock.patch.object(FirebaseVisionService, '_initialize_client'):
+            service = FirebaseVisionService()
+        # Fresh limits, not the process-wide ones
+        service.semaphore = threading.BoundedSemaphore(max_concurrency)
+        service.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        service.client = client
+        return service
+
+    def test_call_within_deadline(self):
+        client = FakeVisionClient(slow(0.01))
+        self.assertEqual(self.make_service(client)._call('object_localization'), 'ok')
+        self.assertEqual(client.calls, [0.05])
+
+    def test_deadline_exceeded_is_retried_then_unavailable(self):
+        client = FakeVisionClient(slow(5))
+        started = time.monotonic()
+        with self.assertRaises(VisionUnavailable):
+            self.make_service(client)._call('object_localization')
+        self.assertEqual(len(client.calls), 3)
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_retries_back_off_with_full_jitter(self):
+        client = FakeVisionClient(failing(), failing(), succeeding)
+        with mock.patch('devices.firebase_vision.random.uniform', side_effect=lambda low, high: high / 2) as uniform, \
+                mock.patch('devices.firebase_vision.time.sleep') as sleep:
+            self.assertEqual(self.make_service(client)._call('object_localization'), 'ok')
+        self.assertEqual([call.args for call in uniform.call_args_list], [(0, 0.01), (0, 0.02)])
+        self.assertEqual([call.args for call in sleep.call_args_list], [(0.005,), (0.01,)])
+
+    def test_other_errors_are_not_retried(self):
+        client = FakeVisionClient(failing(google_exceptions.InvalidArgument))
+        service = self.make_service(client)
+        with self.assertRaises(google_exceptions.InvalidArgument):
+            service._call('object_localization')
+        self.assertEqual(len(client.calls), 1)
+
+    def test_concurrency_limit(self):
+        release = threading.Event()
+        in_flight = []
+        peak = []
+
+        def blocking(timeout):
+            in_flight.append(1)
+            peak.append(len(in_flight))
+            release.wait(5)
+            in_flight.pop()
+            return 'ok'
+
+        service = self.make_service(FakeVisionClient(blocking), max_concurrency=2)
+        results = []
+
+        def call():
+            try:
+                results.append(service._call('object_localization'))
+            except VisionUnavailable:
+                results.append('unavailable')
+
+        threads = [threading.Thread(target=call) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        # Callers beyond the limit give up after VISION_CONCURRENCY_WAIT_SECONDS
+        deadline = time.monotonic() + 5
+        while results.count('unavailable') < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), ['ok', 'ok', 'unavailable', 'unavailable'])
+        self.assertEqual(max(peak), 2)
+
+    @override_settings(VISION_MAX_RETRIES=0)
+    def test_breaker_opens_and_half_opens(self):
+        client = FakeVisionClient(failing())
+        service = self.make_service(client, failure_threshold=2, reset_timeout=0.1)
+        for _ in range(2):
+            with self.assertRaises(VisionUnavailable):
+                service._call('object_localization')
+        self.assertEqual(service.breaker.state, CircuitBreaker.OPEN)
+
+        # Open: rejected without calling the API
+        with self.assertRaisesMessage(VisionUnavailable, 'circuit breaker is open'):
+            service._call('object_localization')
+        self.assertEqual(len(client.calls), 2)
+
+        # Half-open: one trial; its failure re-opens the breaker
+        time.sleep(0.1)
+        self.assertEqual(service.breaker.state, CircuitBreaker.HALF_OPEN)
+        with self.assertRaises(VisionUnavailable):
+            service._call('object_localization')
+        self.assertEqual(len(client.calls), 3)
+        self.assertEqual(service.breaker.state, CircuitBreaker.OPEN)
+
+        # A successful trial closes it
+        time.sleep(0.1)
+        client.behaviours = [succeeding]
+        self.assertEqual(service._call('object_localization'), 'ok')
+        self.assertEqual(service.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_non_retryable_error_in_half_open_trial_gives_back_the_slot(self):
+        client = FakeVisionClient(failing(google_exceptions.InvalidArgument))
+        service = self.make_service(client, failure_threshold=1, reset_timeout=0.05)
+        service.breaker.record_failure()
+        time.sleep(0.05)
+        self.assertEqual(service.breaker.state, CircuitBreaker.HALF_OPEN)
+
+        with self.assertRaises(google_exceptions.InvalidArgument):
+            service._call('object_localization')
+        client.behaviours = [succeeding]
+        self.assertEqual(service._call('object_localization'), 'ok')
+        self.assertEqual(service.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_other_server_errors_open_the_breaker(self):
+        client = FakeVisionClient(failing(google_exceptions.MethodNotImplemented))
+        service = self.make_service(client, failure_threshold=1)
+        with self.assertRaises(google_exceptions.MethodNotImplemented):
+            service._call('object_localization')
+        self.assertEqual(len(client.calls), 1)
+        self.assertEqual(service.breaker.state, CircuitBreaker.OPEN)
+
+    def test_half_open_allows_a_single_trial(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        breaker.record_failure()
+        time.sleep(0.05)
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+        breaker.cancel_trial()
+        self.assertTrue(breaker.allow_request())
+
+
+@override_settings(CACHES=LOCMEM_CACHES, STRIPE_EVENTS_PROCESS_IN_BACKGROUND=False)
+class StripeEventLedgerTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.plan = create_subscription_plans().get(tier='basic')
+        cls.user = User.objects.create_user(username='subscriber')
+
+    def add_subscription(self):
+        now = timezone.now()
+        return CustomerSubscription.objects.create(
+            user=self.user, plan=self.plan, status='active', stripe_subscription_id='sub_1',
+            current_period_start=now, current_period_end=now + timedelta(days=30)
+        )
+
+    def add_event(self, event_id, event_type, payload, seconds=0):
+        StripeEvent.objects.create(
+            event_id=event_id, event_type=event_type, stripe_subscription_id='sub_1',
+            stripe_created=timezone.now() + timedelta(seconds=seconds), payload=payload
+        )
+
+    def test_retried_invoice_records_failure_and_success(self):
+        subscription = self.add_subscription()
+        self.add_event('evt_1', 'invoice.payment_failed', {'id': 'in_1', 'subscription': 'sub_1', 'amount_due': 999})
+        self.add_event('evt_2', 'invoice.payment_succeeded', {
+            'id': 'in_1', 'subscription': 'sub_1', 'amount_paid': 999, 'payment_intent': 'pi_1'
+        }, seconds=1)
+
+        self.assertEqual(process_pending_events(), 2)
+
+        statuses = sorted(PaymentHistory.objects.filter(stripe_invoice_id='in_1').values_list('status', flat=True))
+        self.assertEqual(statuses, ['failed', 'succeeded'])
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.status, 'active')
+
+    def test_event_for_unknown_subscription_is_retried(self):
+        self.add_event('evt_1', 'invoice.payment_succeeded', {
+            'id': 'in_1', 'subscription': 'sub_1', 'amount_paid': 999, 'payment_intent': 'pi_1'
+        })
+
+        self.assertEqual(process_pending_events(), 0)
+        event = StripeEvent.objects.get(event_id='evt_1')
+        self.assertEqual((event.status, event.attempts), ('pending', 1))
+
+        self.add_subscription()
+        self.assertEqual(process_pending_events(), 1)
+        self.assertEqual(StripeEvent.objects.get(event_id='evt_1').status, 'processed')
+        self.assertTrue(PaymentHistory.objects.filter(stripe_invoice_id='in_1', status='succeeded').exists())
+
+
+class FakeStripe:
+    """
+    Local stand-in for the stripe module's invoice calls. Customers listed
+    in declined have their card declined; the first server_errors invoice
+    creations fail with a 5xx. Idempotency keys replay the original result
+    (errors included) the way Stripe does, until expire_keys().
+    """
+
+    class CardError(Exception):
+        def __init__(self, message):
+            super().__init__(message)
+            self.user_message = message
+
+    class APIError(Exception):
+        pass
+
+    def __init__(self, declined=(), server_errors=0):
+        self.declined = set(declined)
+        self.server_errors = server_errors
+        self.charges = 0
+        self._replies = {}
+        self._invoices = {}
+        self.Invoice = SimpleNamespace(create=self._create_invoice, pay=self._pay_invoice, list=self._list_invoices)
+
+    def expire_keys(self):
+        """Stripe prunes idempotency keys after 24 hours"""
+        self._replies.clear()
+
+    def _replay(self, key, call):
+        if key not in self._replies:
+            try:
+                self._replies[key] = ('ok', call())
+            except (self.CardError, self.APIError) as e:
+                self._replies[key] = ('error', e)
+        kind, value = self._replies[key]
+        if kind == 'error':
+            raise value
+        return value
+
+    def _create_invoice(self, customer, subscription, auto_advance, metadata, idempotency_key):
+        def create():
+            if self.server_errors:
+                self.server_errors -= 1
+                raise self.APIError('Internal server error')
+            invoice = SimpleNamespace(
+                id=f'in_{len(self._invoices) + 1}', customer=customer, subscription=subscription,
+                metadata=dict(metadata), created=int(time.time()), status='open',
+                amount_due=999, amount_paid=0, payment_intent=None, last_payment_error=None,
+            )
+            self._invoices[invoice.id] = invoice
+            return invoice
+        return self._replay(idempotency_key, create)
+
+    def _pay_invoice(self, invoice_id, idempotency_key):
+        def pay():
+            invoice = self._invoices[invoice_id]
+            self.charges += 1
+            if invoice.customer in self.declined:
+                raise self.CardError('Your card was declined.')
+            invoice.status, invoice.amount_paid, invoice.payment_intent = 'paid', invoice.amount_due, f'pi_{invoice_id}'
+            return invoice
+        return self._replay(idempotency_key, pay)
+
+    def _list_invoices(self, subscription, created):
+        invoices = [
+            invoice for invoice in self._invoices.values()
+            if invoice.subscription == subscription and invoice.created >= created['gte']
+        ]
+        return SimpleNamespace(auto_paging_iter=lambda: iter(invoices))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BillingRunTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.plan = create_subscription_plans().get(tier='basic')
+        cls.now = timezone.now()
+
+    def add_subscription(self, name, status='active', payment_method='pm_1'):
+        ended = self.now - timedelta(hours=1)
+        return CustomerSubscription.objects.create(
+            user=User.objects.create_user(username=name), plan=self.plan, status=status,
+            stripe_customer_id=f'cus_{name}', stripe_subscription_id=f'sub_{name}',
+            stripe_payment_method_id=payment_method,
+            trial_end=ended if status == 'trial' else None,
+            current_period_start=ended - timedelta(days=30), current_period_end=ended,
+        )
+
+    def test_outcomes(self):
+        paying = self.add_subscription('paying')
+        declined = self.add_subscription('declined')
+        trial = self.add_subscription('trial', status='trial', payment_method=None)
+        stripe = FakeStripe(declined={'cus_declined'})
+
+        summary = run_billing(stripe, workers=2, now=self.now)
+
+        self.assertEqual(
+            (summary['processed'], summary[PAID], summary[PAYMENT_FAILED], summary[NO_PAYMENT_METHOD]),
+            (3, 1, 1, 1)
+        )
+        paying.refresh_from_db()
+        self.assertEqual(paying.status, 'active')
+        self.assertEqual(paying.current_period_end, self.now + timedelta(days=30))
+        payment = PaymentHistory.objects.get(subscription=paying)
+        self.assertEqual((payment.status, payment.amount), ('succeeded', Decimal('9.99')))
+
+        declined.refresh_from_db()
+        self.assertEqual(declined.status, 'suspended')
+        self.assertEqual(declined.grace_period_end, self.now + timedelta(days=3))
+        payment = PaymentHistory.objects.get(subscription=declined)
+        self.assertEqual((payment.status, payment.failure_reason), ('failed', 'Your card was declined.'))
+
+        trial.refresh_from_db()
+        self.assertEqual(trial.status, 'suspended')
+        self.assertFalse(PaymentHistory.objects.filter(subscription=trial).exists())
+        self.assertEqual(stripe.charges, 2)
+
+    def test_rerun_after_interrupted_write_charges_and_records_once(self):
+        subscription = self.add_subscription('paying')
+        stripe = FakeStripe()
+
+        # Charged at Stripe, then the run dies before writing its results
+        with mock.patch('devices.billing_runner._apply_results', side_effect=RuntimeError('worker killed')):
+            with self.assertRaises(RuntimeError):
+                run_billing(stripe, now=self.now)
+        self.assertFalse(PaymentHistory.objects.exists())
+
+        summary = run_billing(stripe, now=self.now)
+        self.assertEqual(summary[PAID], 1)
+        self.assertEqual(stripe.charges, 1)
+        self.assertEqual(PaymentHistory.objects.filter(subscription=subscription).count(), 1)
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.current_period_end, self.now + timedelta(days=30))
+
+        # Renewed: a further run finds nothing due
+        self.assertEqual(run_billing(stripe, now=self.now)['processed'], 0)
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.current_period_end, self.now + timedelta(days=30))
+        self.assertEqual(PaymentHistory.objects.count(), 1)
+
+    def test_rerun_after_keys_expired_reuses_the_period_invoice(self):
+        subscription = self.add_subscription('paying')
+        stripe = FakeStripe()
+        with mock.patch('devices.billing_runner._apply_results', side_effect=RuntimeError('worker killed')):
+            with self.assertRaises(RuntimeError):
+                run_billing(stripe, now=self.now)
+
+        # Next day's run: the idempotency keys are gone
+        stripe.expire_keys()
+        next_day = self.now + timedelta(days=1)
+        self.assertEqual(run_billing(stripe, now=next_day)[PAID], 1)
+
+        self.assertEqual((len(stripe._invoices), stripe.charges), (1, 1))
+        self.assertEqual(PaymentHistory.objects.filter(subscription=subscription).count(), 1)
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.current_period_end, next_day + timedelta(days=30))
+
+    def test_server_error_is_retried_with_fresh_keys(self):
+        subscription = self.add_subscription('paying')
+        stripe = FakeStripe(server_errors=1)
+        self.assertEqual(run_billing(stripe, now=self.now)[ERROR], 1)
+
+        # Same day: a reused key would replay the stored 5xx
+        self.assertEqual(run_billing(stripe, now=self.now + timedelta(hours=1))[PAID], 1)
+        self.assertEqual(len(stripe._invoices), 1)
+        self.assertEqual(PaymentHistory.objects.filter(subscription=subscription, status='succeeded').count(), 1)
+
+    def test_payment_already_recorded_by_webhook_is_not_duplicated(self):
+        subscription = self.add_subscription('paying')
+        stripe = FakeStripe()
+        invoice = stripe.Invoice.create(
+            customer='cus_paying', subscription='sub_paying', auto_advance=True,
+            metadata={'billing_period': billing_period(subscription)}, idempotency_key='earlier-run'
+        )
+        PaymentHistory.objects.create(
+            subscription=subscription, amount=Decimal('9.99'), status='succeeded',
+            stripe_invoice_id=invoice.id, stripe_payment_intent_id=f'pi_{invoice.id}'
+        )
+
+        self.assertEqual(run_billing(stripe, now=self.now)[PAID], 1)
+        self.assertEqual(PaymentHistory.objects.filter(stripe_invoice_id=invoice.id).count(), 1)
+
+
+class AnalysisCacheTests(TestCase):
+    """Stored analyses are reused for identical images, failed ones aren't"""
+
+    def setUp(self):
+        get_analysis_cache().clear()
+        self.addCleanup(get_analysis_cache().clear)
+        self.image = base64.b64encode(make_jpeg()).decode()
+        self.image_hash = compute_image_hash(self.image)
+        self.device = Device.objects.create(serial_number='ESP-CACHE')
+
+    def store_analysis(self, **detected):
+        capture = Capture.objects.create(device=self.device, image_base64=self.image, image_sha256=self.image_hash)
+        CaptureAnalysis.objects.create(capture=capture, summary='', **detected)
+
+    def analyze(self):
+        vision = mock.Mock()
+        vision.analyze_mail.return_value = {'type': 'letter', 'size': 'small', 'carrier': None,
+                                            'confidence': 0.9, 'text': '', 'carriers': []}
+        with mock.patch('devices.firebase_vision.get_vision_service', return_value=vision):
+            analysis_data, cache_hit = analyze_mail_cached(self.image, self.image_hash)
+        return analysis_data, cache_hit, vision.analyze_mail.call_count
+
+    def test_stored_analysis_is_reused(self):
+        self.store_analysis(package_detected=True)
+        analysis_data, cache_hit, vision_calls = self.analyze()
+        self.assertEqual((analysis_data['type'], cache_hit, vision_calls), ('package', True, 0))
+
+    def test_failed_analysis_is_not_reused(self):
+        self.store_analysis()
+        analysis_data, cache_hit, vision_calls = self.analyze()
+        self.assertEqual((analysis_data['type'], cache_hit, vision_calls), ('letter', False, 1))
+        # The fresh result is what later lookups get
+        self.assertEqual(self.analyze()[:2], (analysis_data, True))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, PLAN_CATALOGUE_CHECK_SECONDS=0.2)
+class PlanCatalogueTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.plan = create_subscription_plans().get(tier='basic')
+
+    def setUp(self):
+        plan_catalogue.invalidate_plan_catalogue()
+        self.addCleanup(plan_catalogue.invalidate_plan_catalogue)
+
+    def test_lookups_check_generation_at_most_every_interval(self):
+        plan_catalogue.get_plan(self.plan.id)
+        with mock.patch('devices.plan_catalogue.namespace_version', return_value=1) as version, \
+                mock.patch('devices.plan_catalogue.metrics.increment') as increment:
+            for _ in range(100):
+                plan_catalogue.get_plan(self.plan.id)
+        self.assertEqual(version.call_count, 0)
+        self.assertEqual(increment.call_count, 0)
+
+    def test_other_worker_changes_are_picked_up_after_interval(self):
+        self.assertEqual(plan_catalogue.get_plan(self.plan.id).name, self.plan.name)
+        # Another worker renames the plan: its signal bumps the namespace
+        SubscriptionPlan.objects.filter(pk=self.plan.pk).update(name='Renamed')
+        invalidate_namespace(NAMESPACE_PLANS)
+
+        self.assertEqual(plan_catalogue.get_plan(self.plan.id).name, self.plan.name)
+        time.sleep(0.2)
+        self.assertEqual(plan_catalogue.get_plan(self.plan.id).name, 'Renamed')
+
+    def test_unknown_plan_reloads_locally_only(self):
+        plan_catalogue.get_plan(self.plan.id)
+        with mock.patch('devices.plan_catalogue.invalidate_namespace') as invalidate, \
+                self.assertRaises(SubscriptionPlan.DoesNotExist):
+            plan_catalogue.get_plan(self.plan.id + 1000)
+        invalidate.assert_not_called()
+
+    def test_plan_change_applies_to_user_tier_at_once(self):
+        user = User.objects.create_user(username='upgrader')
+        subscription = CustomerSubscription.objects.create(
+            user=user, plan=self.plan, status='active',
+            current_period_start=timezone.now(), current_period_end=timezone.now() + timedelta(days=30)
+        )
+        self.assertEqual(plan_catalogue.get_user_tier(user.id), 'basic')
+
+        subscription.plan = SubscriptionPlan.objects.get(tier='premium')
+        subscription.save()
+        self.assertEqual(plan_catalogue.get_user_tier(user.id), 'premium')
+
+
+class FakeEventStream:
+    """The Redis stream commands devices.event_log uses, with exact MAXLEN trimming"""
+
+    def __init__(self):
+        self.streams = {}
+        self.next_ms = 1000
+
+    def pipeline(self):
+        client, commands = self, []
+
+        class Pipeline:
+            def xadd(self, *args, **kwargs):
+                commands.append(lambda: client.xadd(*args, **kwargs))
+
+            def expire(self, *args):
+                commands.append(lambda: True)
+
+            def execute(self):
+                return [command() for command in commands]
+        return Pipeline()
+
+    def xadd(self, key, fields, maxlen, approximate=True):
+        self.next_ms += 1
+        entry_id = f"{self.next_ms}-0".encode()
+        entries = self.streams.setdefault(key, [])
+        entries.append((entry_id, {k.encode(): v.encode() for k, v in fields.items()}))
+        del entries[:-maxlen]
+        return entry_id
+
+    @staticmethod
+    def _ms(entry_id):
+        return int(entry_id.decode().split('-')[0]) if isinstance(entry_id, bytes) else int(entry_id.split('-')[0])
+
+    def xrange(self, key, min='-', max='+', count=None):
+        low = 0 if min == '-' else self._ms(min)
+        return [entry for entry in self.streams.get(key, []) if self._ms(entry[0]) >= low][:count]
+
+    def xrevrange(self, key, max='+', min='-', count=None):
+        return list(reversed(self.streams.get(key, [])))[:count]
+
+
+@override_settings(DEVICE_EVENT_LOG_MAX_LEN=5)
+class EventLogTests(SimpleTestCase):
+
+    def setUp(self):
+        self.stream = FakeEventStream()
+        patcher = mock.patch('devices.event_log.get_redis_client', return_value=self.stream)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def log(self, count):
+        return [append_event('ESP-LOG', {'type': 'analysis_complete', 'capture_id': n}) for n in range(count)]
+
+    def test_replays_events_after_a_retained_id(self):
+        event_ids = self.log(4)
+        events, complete = events_since('ESP-LOG', event_ids[1])
+        self.assertTrue(complete)
+        self.assertEqual([event['event_id'] for event in events], event_ids[2:])
+
+    def test_id_trimmed_out_of_the_log_is_incomplete(self):
+        event_ids = self.log(8)  # The log keeps the last 5
+        self.assertFalse(events_since('ESP-LOG', event_ids[0])[1])
+        self.assertFalse(events_since('ESP-LOG', event_ids[2])[1])
+        self.assertTrue(events_since('ESP-LOG', event_ids[3])[1])
+
+    def test_expired_log_is_incomplete(self):
+        event_id = self.log(1)[0]
+        self.stream.streams.clear()
+        self.assertEqual(events_since('ESP-LOG', event_id), ([], False))
+
+    def test_page_seeded_from_an_empty_log_replays_everything(self):
+        seed = latest_event_id('ESP-LOG')
+        self.assertEqual(seed, EMPTY_LOG_EVENT_ID)
+        event_ids = self.log(2)
+        events, complete = events_since('ESP-LOG', seed)
+        self.assertTrue(complete)
+        self.assertEqual([event['event_id'] for event in events], event_ids)
+        self.assertEqual(latest_event_id('ESP-LOG'), event_ids[-1])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class DeviceOwnershipCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user(username='alice')
+        self.bob = User.objects.create_user(username='bob')
+        self.device = Device.objects.create(serial_number='ESP-OWN', owner=self.alice)
+
+    def test_lookups_are_cached(self):
+        self.assertEqual(get_owned_device_id('ESP-OWN', self.alice.id), self.device.id)
+        get_user_device_serials(self.alice.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_owned_device_id('ESP-OWN', self.alice.id), self.device.id)
+            self.assertIsNone(get_owned_device_id('ESP-OWN', self.bob.id))
+            self.assertEqual(get_user_device_serials(self.alice.id), ['ESP-OWN'])
+
+    def test_reassignment_invalidates_both_owners(self):
+        self.assertEqual(get_user_device_serials(self.alice.id), ['ESP-OWN'])
+        self.assertEqual(get_user_device_list(self.bob.id), [])
+        self.device.owner = self.bob
+        self.device.save()
+
+        self.assertIsNone(get_owned_device_id('ESP-OWN', self.alice.id))
+        self.assertEqual(get_owned_device_id('ESP-OWN', self.bob.id), self.device.id)
+        self.assertEqual(get_user_device_serials(self.alice.id), [])
+        self.assertEqual([device['serial_number'] for device in get_user_device_list(self.bob.id)], ['ESP-OWN'])
+
+    def test_deleted_device_is_not_owned(self):
+        get_owned_device_id('ESP-OWN', self.alice.id)
+        self.device.delete()
+        self.assertIsNone(get_owned_device_id('ESP-OWN', self.alice.id))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class GracePeriodSuspensionTests(TestCase):
+
+    def setUp(self):
+        plan = create_subscription_plans().get(tier='basic')
+        now = timezone.now()
+        self.devices = {}
+        for username, status, grace_period_end in (
+            ('lapsed', 'suspended', now - timedelta(days=1)),
+            ('in_grace', 'suspended', now + timedelta(days=1)),
+            ('paying', 'active', None),
+        ):
+            user = User.objects.create_user(username=username)
+            CustomerSubscription.objects.create(
+                user=user, plan=plan, status=status, grace_period_end=grace_period_end,
+                current_period_start=now - timedelta(days=30), current_period_end=now
+            )
+            count = 3 if username == 'lapsed' else 1
+            self.devices[username] = [
+                Device.objects.create(serial_number=f'ESP-{username}-{n}', owner=user, lifecycle_state='active_subscription')
+                for n in range(count)
+            ]
+        self.last_seen = dict(Device.objects.values_list('id', 'last_seen'))
+
+    def states(self):
+        return dict(Device.objects.values_list('serial_number', 'lifecycle_state'))
+
+    def assert_lapsed_suspended(self, suspended):
+        lapsed = self.devices['lapsed']
+        self.assertEqual(sorted(suspended), sorted((d.id, d.serial_number, d.owner_id) for d in lapsed))
+        states = self.states()
+        self.assertEqual({serial for serial, state in states.items() if state == 'suspended'},
+                         {device.serial_number for device in lapsed})
+        self.assertEqual(dict(Device.objects.values_list('id', 'last_seen')), self.last_seen)
+        self.assertEqual(suspend_devices_past_grace(chunk_size=2), [])
+
+    def test_dry_run_changes_nothing(self):
+        self.assertEqual(len(suspend_devices_past_grace(dry_run=True)), 3)
+        self.assertNotIn('suspended', self.states().values())
+
+    def test_suspends_in_chunks_with_update_returning(self):
+        with CaptureQueriesContext(connection) as queries:
+            suspended = suspend_devices_past_grace(chunk_size=2)
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 2)
+        self.assertTrue(all('RETURNING' in sql for sql in updates))
+        self.assert_lapsed_suspended(suspended)
+
+    def test_suspends_in_chunks_without_update_returning(self):
+        with mock.patch.object(connection, 'vendor', 'mysql'):
+            self.assert_lapsed_suspended(suspend_devices_past_grace(chunk_size=2))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class UsagePrecreationTests(TestCase):
+
+    def setUp(self):
+        self.plan = create_subscription_plans().get(tier='basic')
+        now = timezone.now()
+        self.year, self.month = now.year, now.month
+        self.devices = []
+        for username, status in (('subscriber', 'active'), ('cancelled', 'cancelled')):
+            user = User.objects.create_user(username=username)
+            CustomerSubscription.objects.create(
+                user=user, plan=self.plan, status=status,
+                current_period_start=now - timedelta(days=1), current_period_end=now + timedelta(days=29)
+            )
+            self.devices.append(
+                Device.objects.create(serial_number=f'ESP-{username}', owner=user, lifecycle_state='active_subscription')
+            )
+        Device.objects.create(serial_number='ESP-UNCLAIMED')
+
+    def test_creates_rows_for_subscribed_devices_only_and_reruns_are_no_ops(self):
+        self.assertEqual(precreate_usage_records(self.year, self.month), 1)
+        usage = DataUsage.objects.get()
+        self.assertEqual((usage.device, usage.notification_limit), (self.devices[0], self.plan.notification_limit))
+
+        DataUsage.objects.update(notification_count=7)
+        precreate_usage_records(self.year, self.month)
+        self.assertEqual(list(DataUsage.objects.values_list('notification_count', flat=True)), [7])
+
+    def test_ingest_only_updates_the_precreated_row(self):
+        precreate_usage_records(self.year, self.month)
+        device = Device.objects.select_related('owner').get(pk=self.devices[0].pk)
+        with CaptureQueriesContext(connection) as queries:
+            can_send, _, usage = check_usage_limits(device, 2048)
+            record_notification(device, 2048, usage=usage)
+        self.assertTrue(can_send)
+        statements = [query['sql'].split()[0] for query in queries]
+        self.assertNotIn('INSERT', statements)
+        self.assertEqual(statements.count('UPDATE'), 1)
+        self.assertEqual(DataUsage.objects.get().notification_count, 1)
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES, DEVICE_RATE_LIMITS={}, DEVICE_AUTH_REQUIRED=True,
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+)
+class AsyncCaptureUploadTests(TestCase):
+
+    def setUp(self):
+        self.addCleanup(invalidate_device_keys)
+        plan = create_subscription_plans().get(tier='basic')
+        user = User.objects.create_user(username='uploader')
+        CustomerSubscription.objects.create(
+            user=user, plan=plan, status='active',
+            current_period_start=timezone.now(), current_period_end=timezone.now() + timedelta(days=30)
+        )
+        api_key = generate_api_key()
+        self.device = Device.objects.create(
+            serial_number='ESP-ASYNC', owner=user, lifecycle_state='active_subscription', api_key_hash=hash_api_key(api_key)
+        )
+        invalidate_device_keys()
+        self.authorization = f'Device ESP-ASYNC:{api_key}'
+        self.body = {'image': base64.b64encode(make_photo(1600, 1200)).decode(), 'trigger_type': 'manual'}
+        patcher = mock.patch.object(views_async, '_analysis_executor')
+        self.executor = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('devices.event_log.get_redis_client', return_value=FakeEventStream())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def upload(self, body, authorization=None):
+        return await self.async_client.post(
+            reverse('devices:capture_upload'), json.dumps(body), content_type='application/json',
+            headers={'Authorization': authorization} if authorization else None
+        )
+
+    async def test_capture_is_stored_and_analysed_after_the_response(self):
+        response = await self.upload(self.body, self.authorization)
+        self.assertEqual(response.status_code, 201)
+        payload = response.json()
+        self.assertGreater(payload['next_wake_seconds'], 0)
+
+        capture = await Capture.objects.aget(pk=payload['capture_id'])
+        self.assertTrue(capture.analysis_pending)
+        self.assertEqual(capture.trigger_type, 'manual')
+        self.assertEqual(Image.open(io.BytesIO(base64.b64decode(capture.image_base64))).size, (1280, 960))
+        self.executor.submit.assert_called_once()
+        self.assertEqual(self.executor.submit.call_args.args[1].pk, capture.pk)
+
+    async def test_credentials_are_required(self):
+        response = await self.upload(self.body)
+        self.assertEqual((response.status_code, response['WWW-Authenticate']), (401, 'Device'))
+        response = await self.upload({**self.body, 'serial': 'ESP-OTHER'}, self.authorization)
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(await Capture.objects.aexists())
+        self.executor.submit.assert_not_called()
+
+
+@override_settings(DEVICE_WAKE_INTERVAL_SECONDS=3600, DEVICE_WAKE_SLOTS=12)
+class WakeScheduleTests(TestCase):
+
+    def setUp(self):
+        wake_schedule._occupancy = None
+        self.addCleanup(setattr, wake_schedule, '_occupancy', None)
+
+    def test_sleeps_stay_within_half_to_one_and_a_half_intervals(self):
+        device = Device.objects.create(serial_number='ESP-WAKE')
+        sleeps = [wake_schedule.next_wake_seconds(device, now=1_700_000_000 + second) for second in range(0, 7200, 7)]
+        self.assertGreaterEqual(min(sleeps), 1800)
+        self.assertLess(max(sleeps), 5400)
+
+        # Waking on time in its slot means sleeping exactly one interval
+        slot_start = device.wake_slot * 300 + zlib.crc32(b'ESP-WAKE') % 300
+        self.assertEqual(wake_schedule.next_wake_seconds(device, now=3600 * 1000 + slot_start), 3600)
+
+    def test_devices_fill_the_least_occupied_slots(self):
+        devices = [Device.objects.create(serial_number=f'ESP-SLOT-{n}') for n in range(24)]
+        for device in devices:
+            wake_schedule.next_wake_seconds(device)
+        per_slot = Counter(Device.objects.values_list('wake_slot', flat=True))
+        self.assertEqual(sorted(per_slot), list(range(12)))
+        self.assertEqual(set(per_slot.values()), {2})
+
+    @override_settings(DEVICE_WAKE_SLOTS=6)
+    def test_slot_outside_a_smaller_schedule_is_reassigned(self):
+        device = Device.objects.create(serial_number='ESP-RESLOT', wake_slot=11)
+        wake_schedule.next_wake_seconds(device)
+        device.refresh_from_db()
+        self.assertLess(device.wake_slot, 6)
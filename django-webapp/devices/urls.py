@@ -3,13 +3,15 @@ from . import views
 from . import api_views
 from . import views_email
 from . import views_customer
+from . import views_async
 
 app_name = 'devices'
 
 urlpatterns = [
     # Device API endpoints
     path('heartbeat/', views.device_heartbeat, name='device_heartbeat'),
-    path('capture/', api_views.capture_upload, name='capture_upload'),
+    path('capture/', views_async.capture_upload, name='capture_upload'),
+    path('capture/sync/', api_views.capture_upload, name='capture_upload_sync'),  # WSGI deployments, benchmarks
     path('trigger/', api_views.manual_trigger, name='manual_trigger'),
     path('click-status/', api_views.click_status, name='click_status'),
     path('capture/<int:capture_id>/acknowledge/', views_email.acknowledge_capture_api, name='acknowledge_capture'),
@@ -1,23 +1,27 @@
 from rest_framework import status
-from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import AllowAny
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
 from rest_framework.response import Response
 from django.utils import timezone
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
 import logging
 from .models import Device, DeviceCapture, SIM
+from .image_processing import normalize_base64_image
+from .realtime import broadcast_device_event
+from .device_auth import DeviceKeyAuthentication, IsDevice, device_serial
+from .ingest_guard import UploadRejected, check_upload, check_image_header
+from .wake_schedule import next_wake_seconds
 from .serializers import HeartbeatSerializer, CaptureRequestSerializer, DeviceCaptureSerializer
 
 logger = logging.getLogger(__name__)
 
 
 @api_view(['POST'])
-@permission_classes([AllowAny])  # Allow unauthenticated requests from ESP32
+@authentication_classes([DeviceKeyAuthentication])
+@permission_classes([IsDevice])
 def device_heartbeat(request):
     """
     Handle device heartbeat POST requests.
-    Updates device last_seen timestamp.
+    Updates device last_seen timestamp and returns next_wake_seconds,
+    the sleep that wakes the device in its fleet wake slot.
     """
     serializer = HeartbeatSerializer(data=request.data)
     
@@ -28,7 +32,9 @@ def device_heartbeat(request):
             status=status.HTTP_400_BAD_REQUEST
         )
     
-    serial_number = serializer.validated_data['serial_number']
+    serial_number = device_serial(request, serializer.validated_data.get('serial_number'))
+    if not serial_number:
+        return Response({'error': 'Missing required field: serial_number'}, status=status.HTTP_400_BAD_REQUEST)
     connection_type = serializer.validated_data.get('connection_type', 'unknown')
     
     logger.debug(f"Heartbeat received from device: {serial_number} via {connection_type}")
@@ -51,19 +57,27 @@ def device_heartbeat(request):
         'status': 'success',
         'message': 'Heartbeat received',
         'device_id': device.id,
-        'device_created': created
+        'device_created': created,
+        'next_wake_seconds': next_wake_seconds(device),
     }, status=status.HTTP_200_OK)
 
 
 @api_view(['POST'])
-@permission_classes([AllowAny])  # Allow unauthenticated requests from ESP32
+@authentication_classes([DeviceKeyAuthentication])
+@permission_classes([IsDevice])
 def device_capture(request):
     """
     Handle device photo capture POST requests.
     Accepts serial_number, base64 encoded image, and optional motion_detected flag.
     Sets ir_sensor_status to 'motion_detected' if motion is detected.
     Auto-resets to 'idle' after 5 seconds.
+    Oversized or non-JPEG uploads are rejected before the body is parsed.
     """
+    try:
+        header_checked = check_upload(request, device_serial(request, None))
+    except UploadRejected as e:
+        return Response({'error': e.reason}, status=e.status_code)
+    
     serializer = CaptureRequestSerializer(data=request.data)
     
     if not serializer.is_valid():
@@ -72,8 +86,15 @@ def device_capture(request):
             status=status.HTTP_400_BAD_REQUEST
         )
     
-    serial_number = serializer.validated_data['serial_number']
+    serial_number = device_serial(request, serializer.validated_data.get('serial_number'))
+    if not serial_number:
+        return Response({'error': 'Missing required field: serial_number'}, status=status.HTTP_400_BAD_REQUEST)
     base64_image = serializer.validated_data['image']
+    if not header_checked:
+        try:
+            check_image_header(base64_image)
+        except UploadRejected as e:
+            return Response({'error': e.reason}, status=e.status_code)
     motion_detected = serializer.validated_data.get('motion_detected', False)
     connection_type = serializer.validated_data.get('connection_type', 'unknown')
     
@@ -145,6 +166,9 @@ def device_capture(request):
         # Calculate data size (base64 encoded string size)
         data_size_bytes = len(base64_image.encode('utf-8'))
         
+        # Downscale/re-encode before storage (data_size_bytes keeps the uploaded size for SIM usage)
+        base64_image, _, _ = normalize_base64_image(base64_image)
+        
         # Create capture record
         capture = DeviceCapture.objects.create(
             device=device,
@@ -173,23 +197,17 @@ def device_capture(request):
         device.connection_type = connection_type
         device.save()
         
-        # Send WebSocket message to device feed subscribers
+        # Send WebSocket message to device and owner feed subscribers
         try:
-            channel_layer = get_channel_layer()
-            group_name = f'device_{serial_number}'
-            
-            async_to_sync(channel_layer.group_send)(
-                group_name,
-                {
-                    'type': 'new_capture',
-                    'capture_id': capture.id,
-                    'image': base64_image,
-                    'captured_at': capture.captured_at.isoformat(),
-                    'motion_detected': motion_detected,
-                    'device_status': device.status,
-                    'ir_sensor_status': device.ir_sensor_status,
-                }
-            )
+            broadcast_device_event(serial_number, device.owner_id, {
+                'type': 'new_capture',
+                'capture_id': capture.id,
+                'image': base64_image,
+                'captured_at': capture.captured_at.isoformat(),
+                'motion_detected': motion_detected,
+                'device_status': device.status,
+                'ir_sensor_status': device.ir_sensor_status,
+            })
             logger.debug(f"WebSocket message sent for capture {capture.id} to device {serial_number}")
         except Exception as ws_error:
             # Log error but don't fail the request
@@ -215,6 +233,7 @@ def device_capture(request):
             'motion_detected': motion_detected,
             'connection_type': connection_type,
             'data_size_bytes': data_size_bytes,
+            'next_wake_seconds': next_wake_seconds(device),
         }
         
         if warnings:
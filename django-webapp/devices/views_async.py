@@ -0,0 +1,217 @@
+"""
+Async-native device ingest views for Daphne (iot_platform/asgi.py).
+Under ASGI a sync view holds a thread from a small executor (by default
+min(32, CPUs + 4)) for the whole request, including Vision, SMTP and channel
+layer round trips, so uploads queue once those threads are busy. These views
+stay on the event loop: the ORM is used through its async API, channel
+layer sends are awaited, image normalization runs in a worker thread, and
+Vision analysis plus notifications are handed to a background pool after
+the response.
+
+Captures are created with analysis_pending=True and the flag is cleared
+once the analysis is saved, so reanalyze_pending_captures picks up any
+capture whose background analysis was lost (e.g. a worker restart).
+"""
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import JsonResponse
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from rest_framework import exceptions
+from .models import Device, Capture
+from .analysis_cache import compute_image_hash
+from .image_processing import normalize_base64_image
+from .realtime import abroadcast_device_event
+from .device_auth import AUTH_SCHEME, authenticate_device
+from .ingest_guard import UploadRejected, check_upload, check_image_header
+from .wake_schedule import next_wake_seconds
+
+logger = logging.getLogger(__name__)
+
+# Vision analysis, email, SMS and push for new captures (blocking I/O)
+_analysis_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'INGEST_ANALYSIS_WORKERS', 4),
+    thread_name_prefix='capture-analysis'
+)
+
+
+def _admit_upload(request):
+    """
+    Authenticate the device and run the upload guard (one thread hop).
+
+    Returns:
+        (authenticated serial number or None, whether the image header was checked)
+    """
+    device = authenticate_device(request)
+    if device is None and getattr(settings, 'DEVICE_AUTH_REQUIRED', False):
+        raise exceptions.NotAuthenticated()
+    serial_number = device.serial_number if device else None
+    return serial_number, check_upload(request, serial_number)
+
+
+def _check_billing(device, image_size_bytes):
+    """
+    Subscription and usage checks (as in api_views.capture_upload).
+
+    Returns:
+        (error response or None, usage record)
+    """
+    from .billing import check_usage_limits
+
+    if not device.can_operate() and device.owner:
+        return JsonResponse(
+            {'error': 'Device subscription not active. Please update payment method.'},
+            status=402
+        ), None
+
+    can_send, reason, usage_record = check_usage_limits(device, image_size_bytes)
+    if not can_send:
+        return JsonResponse({
+            'error': 'Usage limit reached',
+            'reason': reason,
+            'notification_count': usage_record.notification_count if usage_record else 0,
+            'notification_limit': usage_record.notification_limit if usage_record else 0,
+            'data_used_mb': float(usage_record.data_used_mb) if usage_record else 0,
+            'data_limit_mb': usage_record.data_limit_mb if usage_record else 0
+        }, status=429), None
+    return None, usage_record
+
+
+def _prepare_image(image_base64):
+    """Hash the upload as sent, then downscale/re-encode (CPU-bound, no database)"""
+    image_sha256 = compute_image_hash(image_base64) or ''
+    storage_base64, analysis_base64, _ = normalize_base64_image(image_base64)
+    return image_sha256, storage_base64, analysis_base64
+
+
+def _analyze_in_background(capture, analysis_image_base64):
+    from .api_views import analyze_capture_async
+    try:
+        analyze_capture_async(capture, analysis_image_base64)
+    except Exception as e:
+        logger.error(f"Background analysis failed for capture {capture.id}: {str(e)}", exc_info=True)
+    finally:
+        close_old_connections()
+
+
+@csrf_exempt
+@require_POST
+async def capture_upload(request):
+    """
+    Async device photo upload.
+    Requires "Authorization: Device <serial>:<api key>".
+    Accepts JSON: {"image": "base64string", "trigger_type": ..., ...} (same
+    body as api_views.capture_upload) and returns capture_id and
+    next_wake_seconds once the capture is stored; analysis and notifications
+    follow in the background.
+    """
+    try:
+        authenticated_serial, header_checked = await sync_to_async(_admit_upload)(request)
+    except exceptions.APIException as e:
+        response = JsonResponse({'detail': str(e.detail)}, status=e.status_code)
+        if e.status_code == 401:
+            response['WWW-Authenticate'] = AUTH_SCHEME
+        return response
+    except UploadRejected as e:
+        return JsonResponse({'error': e.reason}, status=e.status_code)
+
+    try:
+        data = json.loads(request.body)
+    except ValueError as e:
+        return JsonResponse({'detail': f'JSON parse error - {str(e)}'}, status=400)
+    if not isinstance(data, dict):
+        return JsonResponse({'error': 'Expected a JSON object'}, status=400)
+
+    # Accept both 'serial' and 'serial_number' for compatibility
+    claimed_serial = data.get('serial') or data.get('serial_number')
+    if authenticated_serial and claimed_serial and claimed_serial != authenticated_serial:
+        return JsonResponse({'detail': 'Serial number does not match device credentials'}, status=403)
+    serial_number = authenticated_serial or claimed_serial
+    image_base64 = data.get('image')
+
+    if not serial_number:
+        return JsonResponse({'error': 'Missing required field: serial'}, status=400)
+    if not image_base64:
+        return JsonResponse({'error': 'Missing required field: image'}, status=400)
+    if not header_checked:
+        try:
+            check_image_header(image_base64)
+        except UploadRejected as e:
+            return JsonResponse({'error': e.reason}, status=e.status_code)
+
+    try:
+        # Get or create device (auto-create if doesn't exist)
+        device, created = await Device.objects.select_related('owner').aget_or_create(
+            serial_number=serial_number,
+            defaults={'status': 'online', 'lifecycle_state': 'pre_activation'}
+        )
+
+        image_size_bytes = len(image_base64) * 3 / 4  # Approximate base64 to bytes
+        error_response, usage_record = await sync_to_async(_check_billing)(device, image_size_bytes)
+        if error_response:
+            return error_response
+
+        trigger_type = data.get('trigger_type', 'automatic')  # 'automatic' or 'manual'
+        door_open = data.get('door_open', False)
+        battery_voltage = data.get('battery_voltage')
+        solar_charging = data.get('solar_charging', False)
+
+        # Update device last_seen and status
+        device.last_seen = timezone.now()
+        device.status = 'online'
+        device.connection_type = data.get('connection_type', 'unknown')
+        await device.asave(update_fields=['last_seen', 'status', 'connection_type'])
+
+        image_sha256, image_base64, analysis_image_base64 = await sync_to_async(
+            _prepare_image, thread_sensitive=False
+        )(image_base64)
+
+        capture = await Capture.objects.acreate(
+            device=device,
+            image_base64=image_base64,
+            trigger_type=trigger_type,
+            door_open=door_open,
+            battery_voltage=battery_voltage,
+            solar_charging=solar_charging,
+            image_sha256=image_sha256,
+            analysis_pending=True
+        )
+        logger.info(f"Capture saved: ID={capture.id}, Device={serial_number}, Trigger={trigger_type}, Door={door_open}")
+
+        if usage_record:
+            from .billing import record_notification
+            await sync_to_async(record_notification)(device, image_size_bytes, usage=usage_record)
+
+        _analysis_executor.submit(_analyze_in_background, capture, analysis_image_base64)
+
+        # Send WebSocket notification to device and owner feed subscribers
+        try:
+            await abroadcast_device_event(serial_number, device.owner_id, {
+                'type': 'new_capture',
+                'capture_id': capture.id,
+                'image': image_base64,
+                'captured_at': capture.timestamp.isoformat(),
+                'trigger_type': trigger_type,
+                'door_open': door_open,
+                'battery_voltage': battery_voltage,
+                'solar_charging': solar_charging,
+                'device_status': device.status,
+            })
+        except Exception as ws_error:
+            # Log error but don't fail the request
+            logger.error(f"WebSocket error for device {serial_number}: {str(ws_error)}", exc_info=True)
+
+        return JsonResponse({
+            'status': 'saved',
+            'capture_id': capture.id,
+            'next_wake_seconds': await sync_to_async(next_wake_seconds)(device),
+        }, status=201)
+
+    except Exception as e:
+        logger.error(f"Failed to save capture: {str(e)}", exc_info=True)
+        return JsonResponse({'error': 'Failed to save capture', 'details': str(e)}, status=500)
@@ -10,8 +10,9 @@ from django.db.models import Q, Sum, Count
 from django.views.decorators.http import require_http_methods
 from datetime import datetime, timedelta
 from .models import Device, Capture, CaptureAnalysis
-from .subscription_models import CustomerSubscription, DataUsage, PaymentHistory, SubscriptionPlan
+from .subscription_models import CustomerSubscription, DataUsage, PaymentHistory
 from .notification_preferences import get_notification_preferences
+from .plan_catalogue import get_active_plans, get_subscription_plan
 import json
 
 
@@ -183,11 +184,12 @@ def billing(request):
     # Get subscription
     try:
         subscription = user.subscription
+        get_subscription_plan(subscription)
     except CustomerSubscription.DoesNotExist:
         subscription = None
     
     # Get all available plans for upgrade/downgrade
-    available_plans = SubscriptionPlan.objects.filter(is_active=True).order_by('price_monthly')
+    available_plans = get_active_plans()
     
     # Get payment history
     payments = []
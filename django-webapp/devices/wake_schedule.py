@@ -0,0 +1,113 @@
+"""
+Fleet wake scheduling.
+Devices used to sleep a fixed interval from their last wake, so devices
+power-cycled together (after an outage or a batch install) stayed
+phase-locked and uploaded at the same moment. The wake interval is now
+divided into DEVICE_WAKE_SLOTS slots. Each device gets the least-occupied
+slot on first check-in (Device.wake_slot), and capture and heartbeat
+responses carry next_wake_seconds: how long to sleep to wake in that slot.
+Peak concurrent uploads drop to about fleet size / slots.
+
+Offsets are computed from the server clock at every wake, so RTC drift
+during deep sleep never accumulates. Devices in one slot are spread across
+it by a stable per-device offset.
+"""
+import logging
+import random
+import threading
+import time
+import zlib
+from django.conf import settings
+from django.db.models import Count
+
+logger = logging.getLogger(__name__)
+
+# Occupancy counts are reloaded from the database this often; in between,
+# each process counts its own assignments and breaks ties randomly
+OCCUPANCY_RELOAD_SECONDS = 60
+
+_lock = threading.Lock()
+_occupancy = None  # (slots, loaded_at, [devices per slot])
+
+
+def _schedule():
+    """(wake interval in seconds, number of slots)"""
+    interval = getattr(settings, 'DEVICE_WAKE_INTERVAL_SECONDS', 7200)
+    slots = max(1, min(getattr(settings, 'DEVICE_WAKE_SLOTS', 120), interval))
+    return interval, slots
+
+
+def _load_occupancy(slots):
+    from .models import Device
+
+    counts = [0] * slots
+    rows = (
+        Device.objects.filter(wake_slot__lt=slots)
+        .values_list('wake_slot').annotate(devices=Count('id')).order_by()
+    )
+    for slot, devices in rows:
+        counts[slot] = devices
+    return counts
+
+
+def get_occupancy():
+    """Devices assigned to each slot (this process's view, at most a minute old)"""
+    global _occupancy
+    _, slots = _schedule()
+    now = time.monotonic()
+    with _lock:
+        if _occupancy is None or _occupancy[0] != slots or now - _occupancy[1] >= OCCUPANCY_RELOAD_SECONDS:
+            _occupancy = (slots, now, _load_occupancy(slots))
+        return list(_occupancy[2])
+
+
+def assign_wake_slot(device):
+    """
+    Give a device the least-occupied wake slot.
+
+    Returns:
+        The assigned slot
+    """
+    from .models import Device
+
+    get_occupancy()  # Reload if stale
+    with _lock:
+        counts = _occupancy[2]
+        least = min(counts)
+        slot = random.choice([index for index, count in enumerate(counts) if count == least])
+        counts[slot] += 1
+
+    Device.objects.filter(pk=device.pk).update(wake_slot=slot)
+    device.wake_slot = slot
+    logger.debug(f"Assigned wake slot {slot} to {device.serial_number}")
+    return slot
+
+
+def next_wake_seconds(device, now=None):
+    """
+    How long a device should sleep to wake in its slot, assigning a slot
+    (one UPDATE) if it has none or the slot count changed.
+
+    Sleeps are between half and one and a half wake intervals: a device
+    waking in its slot sleeps one interval, and one re-phasing never wakes
+    again within half an interval.
+
+    Args:
+        device: Device that just checked in
+        now: Unix time (default: current time)
+
+    Returns:
+        Seconds to sleep
+    """
+    interval, slots = _schedule()
+    slot = device.wake_slot
+    if slot is None or slot >= slots:
+        slot = assign_wake_slot(device)
+
+    slot_width = interval / slots
+    offset = zlib.crc32(device.serial_number.encode()) % max(1, int(slot_width))
+    phase = (time.time() if now is None else now) % interval
+    wait = (slot * slot_width + offset - phase) % interval
+    if wait < interval / 2:
+        wait += interval
+    return int(wait)
@@ -3,22 +3,27 @@ from django.http import HttpResponse
 from django.utils.html import format_html
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
-from .models import FirmwareVersion
+from .models import FirmwareVersion, FirmwarePatch, FirmwareRollout, FirmwareUpdateJob
+from .ota import annotate_release_savings, build_patches_for_release
+from .releases import invalidate_release_cache
 from devices.models import Device
 
 
 @admin.register(FirmwareVersion)
 class FirmwareVersionAdmin(admin.ModelAdmin):
-    list_display = ('version', 'file_size_display', 'release_date', 'is_active', 'download_link')
-    list_filter = ('is_active', 'release_date')
+    list_display = ('version', 'channel', 'rollout_percentage', 'file_size_display', 'release_date', 'is_active', 'download_link', 'delta_savings')
+    list_filter = ('is_active', 'channel', 'release_date')
     search_fields = ('version', 'release_notes')
-    readonly_fields = ('file_size', 'release_date')
+    readonly_fields = ('file_size', 'sha256', 'release_date')
     fieldsets = (
         ('Version Information', {
             'fields': ('version', 'is_active', 'release_date')
         }),
+        ('Rollout', {
+            'fields': ('channel', 'rollout_percentage')
+        }),
         ('Firmware File', {
-            'fields': ('file', 'file_size')
+            'fields': ('file', 'file_size', 'sha256')
         }),
         ('Release Notes', {
             'fields': ('release_notes',)
@@ -41,7 +46,33 @@ class FirmwareVersionAdmin(admin.ModelAdmin):
         return "No file"
     download_link.short_description = "Download"
     
-    actions = ['push_update_to_devices']
+    def get_queryset(self, request):
+        # Delta OTA savings for every row in the list query, not one query per row
+        return annotate_release_savings(super().get_queryset(request))
+    
+    def delta_savings(self, obj):
+        if not obj.patch_count:
+            return "-"
+        return f"{obj.patch_count} patch(es), {obj.bytes_saved / (1024 * 1024):.1f} MB saved"
+    delta_savings.short_description = "Delta OTA"
+    
+    actions = ['push_update_to_devices', 'build_delta_patches']
+    
+    def delete_queryset(self, request, queryset):
+        # Bulk delete bypasses FirmwareVersion.delete()
+        super().delete_queryset(request, queryset)
+        invalidate_release_cache()
+    
+    @admin.action(description='Build delta patches to selected versions')
+    def build_delta_patches(self, request, queryset):
+        """
+        Admin action to precompute delta patches from every version devices
+        currently report to each selected firmware version.
+        """
+        total = 0
+        for firmware in queryset:
+            total += len(build_patches_for_release(firmware))
+        self.message_user(request, f"{total} delta patch(es) available.", level='success')
     
     @admin.action(description='Push update to selected devices')
     def push_update_to_devices(self, request, queryset):
@@ -88,3 +119,27 @@ class FirmwareVersionAdmin(admin.ModelAdmin):
             )
         except Exception as e:
             self.message_user(request, f"Error sending update: {str(e)}", level='error')
+
+
+@admin.register(FirmwarePatch)
+class FirmwarePatchAdmin(admin.ModelAdmin):
+    list_display = ('from_version', 'to_version', 'patch_size', 'compression', 'served_count', 'last_served_at', 'created_at')
+    list_filter = ('to_version', 'compression')
+    search_fields = ('from_version__version', 'to_version__version', 'sha256')
+    readonly_fields = ('patch_size', 'sha256', 'target_sha256', 'compression', 'served_count', 'last_served_at', 'created_at')
+
+
+@admin.register(FirmwareRollout)
+class FirmwareRolloutAdmin(admin.ModelAdmin):
+    list_display = ('firmware', 'status', 'wave_size', 'max_concurrent', 'wave_interval_minutes', 'created_by', 'created_at', 'last_wave_at')
+    list_filter = ('status',)
+    readonly_fields = ('created_at', 'last_wave_at', 'completed_at', 'acknowledged_failures')
+
+
+@admin.register(FirmwareUpdateJob)
+class FirmwareUpdateJobAdmin(admin.ModelAdmin):
+    list_display = ('device', 'rollout', 'state', 'offered_at', 'updated_at', 'error_message')
+    list_filter = ('state',)
+    list_select_related = ('device', 'rollout__firmware')
+    search_fields = ('device__serial_number',)
+    raw_id_fields = ('device', 'rollout')
@@ -0,0 +1,131 @@
+"""
+Resumable firmware downloads.
+Serves firmware images and delta patches with strong ETags (stored SHA-256),
+If-None-Match / If-Range handling and single-range HTTP Range requests.
+When FIRMWARE_X_ACCEL_REDIRECT_PREFIX is set the file transfer is handed
+to nginx (X-Accel-Redirect) instead of being streamed by Python.
+"""
+import re
+from django.conf import settings
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+
+def _etag(sha256):
+    return f'"{sha256}"'
+
+
+def _etag_matches(header, etag):
+    """Check an If-None-Match / If-Range header value against an ETag"""
+    if not header:
+        return False
+    candidates = [value.strip() for value in header.split(',')]
+    return '*' in candidates or etag in candidates
+
+
+def parse_range(header, size):
+    """
+    Parse a single-range Range header.
+
+    Returns:
+        (start, end) inclusive byte offsets, None if the header is absent or
+        unsupported (serve the full file), or 'unsatisfiable'
+    """
+    if not header:
+        return None
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        # Multiple ranges or other units: ignoring Range is allowed
+        return None
+
+    start, end = match.groups()
+    if start == '' and end == '':
+        return None
+    if start == '':
+        # Suffix range: last N bytes
+        length = int(end)
+        if length == 0:
+            return 'unsatisfiable'
+        return max(0, size - length), size - 1
+
+    start = int(start)
+    end = int(end) if end else size - 1
+    if start >= size or end < start:
+        return 'unsatisfiable'
+    return start, min(end, size - 1)
+
+
+def _stream_range(field_file, start, length):
+    """Yield length bytes of a file starting at start"""
+    with field_file.open('rb') as f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def serve_firmware_file(request, field_file, sha256, size, filename):
+    """
+    Build the download response for a firmware image or patch.
+
+    Args:
+        request: HttpRequest
+        field_file: FieldFile to serve
+        sha256: Stored SHA-256 of the file (used as strong ETag)
+        size: File size in bytes
+        filename: Download filename
+
+    Returns:
+        HttpResponse (200, 206, 304 or 416)
+    """
+    etag = _etag(sha256) if sha256 else None
+
+    if etag and _etag_matches(request.META.get('HTTP_IF_NONE_MATCH'), etag):
+        response = HttpResponse(status=304)
+        response['ETag'] = etag
+        return response
+
+    range_header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if range_header and if_range and not (etag and if_range.strip() == etag):
+        # File changed since the partial download started: send it all again
+        range_header = None
+
+    accel_prefix = getattr(settings, 'FIRMWARE_X_ACCEL_REDIRECT_PREFIX', '')
+    if accel_prefix:
+        # nginx serves the bytes (including Range) from an internal location
+        response = HttpResponse(content_type='application/octet-stream')
+        response['X-Accel-Redirect'] = f"{accel_prefix.rstrip('/')}/{field_file.name}"
+    else:
+        byte_range = parse_range(range_header, size)
+        if byte_range == 'unsatisfiable':
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+        if byte_range:
+            start, end = byte_range
+            length = end - start + 1
+            response = StreamingHttpResponse(
+                _stream_range(field_file, start, length),
+                status=206,
+                content_type='application/octet-stream'
+            )
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+            response['Content-Length'] = length
+        else:
+            # FileResponse uses wsgi.file_wrapper (sendfile) where the server supports it
+            response = FileResponse(field_file.open('rb'), content_type='application/octet-stream')
+            response['Content-Length'] = size
+
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    if etag:
+        response['ETag'] = etag
+    return response
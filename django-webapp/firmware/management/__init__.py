@@ -0,0 +1,8 @@
+# Django management commands
+
+
+
+
+
+
+
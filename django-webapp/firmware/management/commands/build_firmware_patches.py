@@ -0,0 +1,60 @@
+"""
+Management command to precompute OTA delta patches for a firmware release.
+Run after uploading a release: python manage.py build_firmware_patches [--target 1.2.0]
+"""
+from django.core.management.base import BaseCommand, CommandError
+from firmware.models import FirmwareVersion
+from firmware.ota import build_patches_for_release, release_savings
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Build delta patches from every firmware version devices report to the target release'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--target',
+            dest='target_version',
+            help='Target release version (default: latest active release)'
+        )
+        parser.add_argument(
+            '--from',
+            dest='from_versions',
+            nargs='*',
+            help='Versions to patch from (default: versions reported by devices)'
+        )
+
+    def handle(self, *args, **options):
+        if options['target_version']:
+            try:
+                target = FirmwareVersion.objects.get(version=options['target_version'])
+            except FirmwareVersion.DoesNotExist:
+                raise CommandError(f"Firmware version {options['target_version']} not found")
+        else:
+            target = FirmwareVersion.objects.filter(is_active=True).order_by('-release_date').first()
+            if not target:
+                raise CommandError('No active firmware version available')
+
+        self.stdout.write(f'Building delta patches to v{target.version}...')
+
+        patches = build_patches_for_release(target, options['from_versions'])
+
+        for patch in patches:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f'[OK] v{patch.from_version.version} -> v{target.version}: '
+                    f'{patch.patch_size / 1024:.1f} KB '
+                    f'(saves {patch.bytes_saved_per_download / 1024:.1f} KB per download)'
+                )
+            )
+
+        savings = release_savings(target)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"\n{savings['patches']} patch(es) available for v{target.version}, "
+                f"served {savings['served']} time(s), "
+                f"{savings['bytes_saved'] / (1024 * 1024):.2f} MB saved so far"
+            )
+        )
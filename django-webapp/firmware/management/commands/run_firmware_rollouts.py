@@ -0,0 +1,26 @@
+"""
+Management command to advance firmware rollouts (release waves, expire stale
+jobs, auto-pause on failures, complete finished rollouts).
+Run every minute via cron: python manage.py run_firmware_rollouts
+"""
+from django.core.management.base import BaseCommand
+from firmware.models import FirmwareRollout
+from firmware.rollout import advance_rollouts, rollouts_with_progress
+
+
+class Command(BaseCommand):
+    help = 'Release the next wave of every running firmware rollout'
+
+    def handle(self, *args, **options):
+        offered = advance_rollouts()
+
+        active = rollouts_with_progress(FirmwareRollout.objects.filter(status__in=['running', 'paused']))
+        for rollout in active:
+            self.stdout.write(
+                f'  v{rollout.firmware.version} [{rollout.status}]: '
+                f'{rollout.jobs_confirmed} confirmed, {rollout.jobs_failed} failed, '
+                f'{rollout.jobs_pending} pending of {rollout.jobs_total}'
+                + (f' - {rollout.pause_reason}' if rollout.pause_reason else '')
+            )
+
+        self.stdout.write(self.style.SUCCESS(f'\nOffered update to {offered} device(s)'))
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('firmware', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FirmwarePatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(help_text='Patch file', upload_to='firmware/patches/')),
+                ('patch_size', models.IntegerField(default=0, help_text='Patch size in bytes')),
+                ('sha256', models.CharField(help_text='SHA-256 of the patch file', max_length=64)),
+                ('target_sha256', models.CharField(help_text='SHA-256 of the firmware image after patching', max_length=64)),
+                ('compression', models.CharField(default='heatshrink', max_length=20)),
+                ('served_count', models.IntegerField(default=0, help_text='Times this patch was offered instead of the full image')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_served_at', models.DateTimeField(blank=True, null=True)),
+                ('from_version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='patches_from', to='firmware.firmwareversion')),
+                ('to_version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='patches_to', to='firmware.firmwareversion')),
+            ],
+            options={
+                'verbose_name': 'Firmware Patch',
+                'verbose_name_plural': 'Firmware Patches',
+                'ordering': ['-created_at'],
+                'unique_together': {('from_version', 'to_version')},
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:46
+
+import hashlib
+from django.db import migrations, models
+
+
+def backfill_sha256(apps, schema_editor):
+    FirmwareVersion = apps.get_model('firmware', 'FirmwareVersion')
+    for firmware in FirmwareVersion.objects.filter(sha256='').exclude(file=''):
+        digest = hashlib.sha256()
+        try:
+            with firmware.file.open('rb') as f:
+                for chunk in f.chunks():
+                    digest.update(chunk)
+        except (FileNotFoundError, OSError):
+            continue
+        FirmwareVersion.objects.filter(pk=firmware.pk).update(sha256=digest.hexdigest())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('firmware', '0002_firmwarepatch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='firmwareversion',
+            name='sha256',
+            field=models.CharField(blank=True, help_text='SHA-256 of the firmware file (download ETag)', max_length=64),
+        ),
+        migrations.RunPython(backfill_sha256, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:47
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('firmware', '0003_firmwareversion_sha256'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='firmwareversion',
+            name='channel',
+            field=models.CharField(choices=[('stable', 'Stable'), ('beta', 'Beta')], default='stable', help_text='Beta devices also receive stable releases', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='firmwareversion',
+            name='rollout_percentage',
+            field=models.PositiveSmallIntegerField(default=100, help_text='Share of devices (by serial number hash) offered this release', validators=[django.core.validators.MaxValueValidator(100)]),
+        ),
+    ]
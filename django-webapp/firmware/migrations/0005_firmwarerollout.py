@@ -0,0 +1,61 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:49
+
+import django.core.validators
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0016_capture_analysis_pending'),
+        ('firmware', '0004_firmwareversion_channel_rollout'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FirmwareRollout',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('running', 'Running'), ('paused', 'Paused'), ('completed', 'Completed'), ('cancelled', 'Cancelled')], default='running', max_length=20)),
+                ('wave_size', models.PositiveIntegerField(default=50, help_text='Devices released per wave')),
+                ('max_concurrent', models.PositiveIntegerField(default=20, help_text='Maximum devices updating at the same time')),
+                ('wave_interval_minutes', models.PositiveIntegerField(default=15, help_text='Minimum time between waves')),
+                ('failure_threshold_percent', models.PositiveSmallIntegerField(default=20, help_text='Pause when this share of finished jobs failed', validators=[django.core.validators.MaxValueValidator(100)])),
+                ('min_failures_to_pause', models.PositiveIntegerField(default=3, help_text='Failures needed before the threshold applies')),
+                ('acknowledged_failures', models.PositiveIntegerField(default=0, help_text='Failures already reviewed when the rollout was resumed')),
+                ('pause_reason', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_wave_at', models.DateTimeField(blank=True, null=True)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='firmware_rollouts', to=settings.AUTH_USER_MODEL)),
+                ('firmware', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollouts', to='firmware.firmwareversion')),
+            ],
+            options={
+                'verbose_name': 'Firmware Rollout',
+                'verbose_name_plural': 'Firmware Rollouts',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='FirmwareUpdateJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(choices=[('pending', 'Pending'), ('offered', 'Offered'), ('downloading', 'Downloading'), ('applying', 'Applying'), ('confirmed', 'Confirmed'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('error_message', models.CharField(blank=True, max_length=255)),
+                ('offered_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='firmware_jobs', to='devices.device')),
+                ('rollout', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='firmware.firmwarerollout')),
+            ],
+            options={
+                'verbose_name': 'Firmware Update Job',
+                'verbose_name_plural': 'Firmware Update Jobs',
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['rollout', 'state'], name='firmware_fi_rollout_c421ad_idx'), models.Index(fields=['device', 'state'], name='firmware_fi_device__6470a7_idx')],
+                'unique_together': {('rollout', 'device')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('firmware', '0005_firmwarerollout'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='firmwarepatch',
+            name='served_count',
+            field=models.IntegerField(default=0, help_text='Times this patch was downloaded instead of the full image'),
+        ),
+    ]
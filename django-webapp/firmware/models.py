@@ -1,8 +1,15 @@
+import hashlib
 from django.db import models
-from django.core.validators import FileExtensionValidator
+from django.contrib.auth.models import User
+from django.core.validators import FileExtensionValidator, MaxValueValidator
 
 
 class FirmwareVersion(models.Model):
+    CHANNEL_CHOICES = [
+        ('stable', 'Stable'),
+        ('beta', 'Beta'),
+    ]
+    
     version = models.CharField(max_length=50, unique=True, help_text="Version number (e.g., 1.0.0)")
     file = models.FileField(
         upload_to='firmware/',
@@ -11,8 +18,15 @@ class FirmwareVersion(models.Model):
     )
     release_date = models.DateTimeField(auto_now_add=True)
     is_active = models.BooleanField(default=True, help_text="Only active versions are available for OTA updates")
+    channel = models.CharField(max_length=10, choices=CHANNEL_CHOICES, default='stable', help_text="Beta devices also receive stable releases")
+    rollout_percentage = models.PositiveSmallIntegerField(
+        default=100,
+        validators=[MaxValueValidator(100)],
+        help_text="Share of devices (by serial number hash) offered this release"
+    )
     release_notes = models.TextField(blank=True, help_text="Release notes and changelog")
     file_size = models.IntegerField(help_text="File size in bytes", default=0)
+    sha256 = models.CharField(max_length=64, blank=True, help_text="SHA-256 of the firmware file (download ETag)")
     
     class Meta:
         ordering = ['-release_date']
@@ -23,6 +37,130 @@ class FirmwareVersion(models.Model):
         return f"v{self.version} ({'Active' if self.is_active else 'Inactive'})"
     
     def save(self, *args, **kwargs):
-        if self.file:
+        # Size and hash only change when a new file is uploaded
+        if self.file and (not self.file._committed or not self.sha256):
             self.file_size = self.file.size
+            self.sha256 = compute_file_sha256(self.file)
         super().save(*args, **kwargs)
+        from .releases import invalidate_release_cache
+        invalidate_release_cache()
+    
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        from .releases import invalidate_release_cache
+        invalidate_release_cache()
+        return result
+
+
+def compute_file_sha256(field_file):
+    """Hash a FieldFile in chunks without loading it into memory"""
+    digest = hashlib.sha256()
+    field_file.open('rb')
+    try:
+        field_file.seek(0)
+        for chunk in field_file.chunks():
+            digest.update(chunk)
+        field_file.seek(0)
+    finally:
+        if field_file._committed:
+            field_file.close()
+    return digest.hexdigest()
+
+
+class FirmwarePatch(models.Model):
+    """Binary delta (detools/bsdiff) that upgrades one firmware version to another"""
+    from_version = models.ForeignKey(FirmwareVersion, on_delete=models.CASCADE, related_name='patches_from')
+    to_version = models.ForeignKey(FirmwareVersion, on_delete=models.CASCADE, related_name='patches_to')
+    file = models.FileField(upload_to='firmware/patches/', help_text="Patch file")
+    patch_size = models.IntegerField(default=0, help_text="Patch size in bytes")
+    sha256 = models.CharField(max_length=64, help_text="SHA-256 of the patch file")
+    target_sha256 = models.CharField(max_length=64, help_text="SHA-256 of the firmware image after patching")
+    compression = models.CharField(max_length=20, default='heatshrink')
+    served_count = models.IntegerField(default=0, help_text="Times this patch was downloaded instead of the full image")
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_served_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+        unique_together = ['from_version', 'to_version']
+        verbose_name = "Firmware Patch"
+        verbose_name_plural = "Firmware Patches"
+    
+    def __str__(self):
+        return f"v{self.from_version.version} -> v{self.to_version.version} ({self.patch_size} bytes)"
+    
+    @property
+    def bytes_saved_per_download(self):
+        """Bytes saved each time the patch is downloaded instead of the full image"""
+        return max(0, self.to_version.file_size - self.patch_size)
+
+
+class FirmwareRollout(models.Model):
+    """Paced delivery of a firmware release to a set of devices"""
+    STATUS_CHOICES = [
+        ('running', 'Running'),
+        ('paused', 'Paused'),
+        ('completed', 'Completed'),
+        ('cancelled', 'Cancelled'),
+    ]
+    
+    firmware = models.ForeignKey(FirmwareVersion, on_delete=models.CASCADE, related_name='rollouts')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='running')
+    wave_size = models.PositiveIntegerField(default=50, help_text="Devices released per wave")
+    max_concurrent = models.PositiveIntegerField(default=20, help_text="Maximum devices updating at the same time")
+    wave_interval_minutes = models.PositiveIntegerField(default=15, help_text="Minimum time between waves")
+    failure_threshold_percent = models.PositiveSmallIntegerField(
+        default=20,
+        validators=[MaxValueValidator(100)],
+        help_text="Pause when this share of finished jobs failed"
+    )
+    min_failures_to_pause = models.PositiveIntegerField(default=3, help_text="Failures needed before the threshold applies")
+    acknowledged_failures = models.PositiveIntegerField(default=0, help_text="Failures already reviewed when the rollout was resumed")
+    pause_reason = models.CharField(max_length=255, blank=True)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='firmware_rollouts')
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_wave_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = "Firmware Rollout"
+        verbose_name_plural = "Firmware Rollouts"
+    
+    def __str__(self):
+        return f"Rollout of v{self.firmware.version} ({self.get_status_display()})"
+
+
+class FirmwareUpdateJob(models.Model):
+    """One device's progress through a rollout"""
+    STATE_CHOICES = [
+        ('pending', 'Pending'),
+        ('offered', 'Offered'),
+        ('downloading', 'Downloading'),
+        ('applying', 'Applying'),
+        ('confirmed', 'Confirmed'),
+        ('failed', 'Failed'),
+    ]
+    
+    # Jobs that occupy a concurrency slot
+    IN_FLIGHT_STATES = ('offered', 'downloading', 'applying')
+    
+    rollout = models.ForeignKey(FirmwareRollout, on_delete=models.CASCADE, related_name='jobs')
+    device = models.ForeignKey('devices.Device', on_delete=models.CASCADE, related_name='firmware_jobs')
+    state = models.CharField(max_length=20, choices=STATE_CHOICES, default='pending')
+    error_message = models.CharField(max_length=255, blank=True)
+    offered_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['id']
+        unique_together = ['rollout', 'device']
+        indexes = [
+            models.Index(fields=['rollout', 'state']),
+            models.Index(fields=['device', 'state']),
+        ]
+        verbose_name = "Firmware Update Job"
+        verbose_name_plural = "Firmware Update Jobs"
+    
+    def __str__(self):
+        return f"{self.device.serial_number} -> v{self.rollout.firmware.version}: {self.state}"
@@ -0,0 +1,241 @@
+"""
+OTA delta updates.
+Builds binary patches (detools, bsdiff algorithm) between firmware releases
+so cellular devices download a small delta instead of the full image.
+Patches are stored under MEDIA_ROOT and evicted least-recently-served first.
+"""
+import hashlib
+import io
+import logging
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db.models import Count, F, IntegerField, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+from .models import FirmwareVersion, FirmwarePatch
+
+logger = logging.getLogger(__name__)
+
+# A device re-downloading a patch within this window isn't counted again
+PATCH_DOWNLOAD_DEDUPE_SECONDS = 7 * 86400
+
+
+def _read_firmware(firmware):
+    """Read a firmware image into memory"""
+    with firmware.file.open('rb') as f:
+        return f.read()
+
+
+def build_patch(from_firmware, to_firmware, force=False):
+    """
+    Build (or return the existing) delta patch between two firmware versions.
+
+    Args:
+        from_firmware: FirmwareVersion the device is running
+        to_firmware: Target FirmwareVersion
+        force: Rebuild even if a patch already exists
+
+    Returns:
+        FirmwarePatch, or None if detools isn't installed or the patch
+        wouldn't be smaller than FIRMWARE_PATCH_MAX_RATIO of the full image
+    """
+    if from_firmware.pk == to_firmware.pk:
+        return None
+
+    existing = FirmwarePatch.objects.filter(from_version=from_firmware, to_version=to_firmware).first()
+    if existing and not force:
+        return existing
+
+    try:
+        import detools
+    except ImportError:
+        logger.warning("detools not installed. Install with: pip install detools (delta OTA disabled)")
+        return None
+
+    compression = getattr(settings, 'FIRMWARE_PATCH_COMPRESSION', 'heatshrink')
+    max_ratio = getattr(settings, 'FIRMWARE_PATCH_MAX_RATIO', 0.8)
+
+    try:
+        from_data = _read_firmware(from_firmware)
+        to_data = _read_firmware(to_firmware)
+        patch_buffer = io.BytesIO()
+        detools.create_patch(io.BytesIO(from_data), io.BytesIO(to_data), patch_buffer, compression=compression)
+        patch_data = patch_buffer.getvalue()
+    except Exception as e:
+        logger.error(f"Failed to build patch {from_firmware.version} -> {to_firmware.version}: {str(e)}", exc_info=True)
+        return None
+
+    if len(patch_data) >= len(to_data) * max_ratio:
+        logger.info(
+            f"Patch {from_firmware.version} -> {to_firmware.version} not worth serving "
+            f"({len(patch_data)} of {len(to_data)} bytes)"
+        )
+        if existing:
+            delete_patch(existing)
+        return None
+
+    if existing:
+        existing.file.delete(save=False)
+        patch = existing
+    else:
+        patch = FirmwarePatch(from_version=from_firmware, to_version=to_firmware)
+
+    patch.patch_size = len(patch_data)
+    patch.sha256 = hashlib.sha256(patch_data).hexdigest()
+    patch.target_sha256 = hashlib.sha256(to_data).hexdigest()
+    patch.compression = compression
+    patch.file.save(
+        f"{from_firmware.version}_to_{to_firmware.version}.patch",
+        ContentFile(patch_data),
+        save=False
+    )
+    patch.save()
+
+    logger.info(
+        f"Built patch {from_firmware.version} -> {to_firmware.version}: "
+        f"{len(patch_data)} bytes ({len(patch_data) / max(len(to_data), 1) * 100:.1f}% of full image)"
+    )
+    return patch
+
+
+def build_patches_for_release(to_firmware, from_versions=None):
+    """
+    Precompute patches to a release from every version devices report.
+
+    Args:
+        to_firmware: Target FirmwareVersion
+        from_versions: Version strings to patch from (default: all distinct
+            Device.firmware_version values that match a stored release)
+
+    Returns:
+        List of FirmwarePatch instances that are available
+    """
+    from devices.models import Device
+
+    if from_versions is None:
+        from_versions = Device.objects.exclude(firmware_version='').values_list(
+            'firmware_version', flat=True
+        ).distinct()
+
+    sources = FirmwareVersion.objects.filter(version__in=list(from_versions)).exclude(pk=to_firmware.pk)
+
+    patches = []
+    for from_firmware in sources:
+        patch = build_patch(from_firmware, to_firmware)
+        if patch:
+            patches.append(patch)
+
+    evict_patches()
+    return patches
+
+
+def find_patch(from_version, to_version):
+    """
+    Find a stored patch between two version strings.
+
+    Returns:
+        FirmwarePatch or None
+    """
+    if not from_version or from_version == to_version:
+        return None
+    return FirmwarePatch.objects.filter(
+        from_version__version=from_version,
+        to_version__version=to_version
+    ).select_related('from_version').first()
+
+
+def record_patch_served(patch, serial_number=None):
+    """
+    Count a patch being downloaded (used for savings reporting and LRU eviction).
+
+    Args:
+        patch: FirmwarePatch
+        serial_number: Authenticated device, if known: counted once per device
+
+    Returns:
+        True if the download was counted
+    """
+    if serial_number:
+        try:
+            if not cache.add(f"firmware:patch_served:{patch.pk}:{serial_number}", True, PATCH_DOWNLOAD_DEDUPE_SECONDS):
+                return False
+        except Exception as e:
+            logger.debug(f"Patch download dedupe unavailable: {str(e)}")
+    FirmwarePatch.objects.filter(pk=patch.pk).update(
+        served_count=F('served_count') + 1,
+        last_served_at=timezone.now()
+    )
+    return True
+
+
+def delete_patch(patch):
+    """Delete a patch row and its file"""
+    patch.file.delete(save=False)
+    patch.delete()
+
+
+def evict_patches():
+    """
+    Evict least-recently-served patches until the store fits
+    FIRMWARE_PATCH_CACHE_MAX_MB and FIRMWARE_PATCH_CACHE_MAX_COUNT.
+
+    Returns:
+        Number of patches evicted
+    """
+    max_bytes = getattr(settings, 'FIRMWARE_PATCH_CACHE_MAX_MB', 200) * 1024 * 1024
+    max_count = getattr(settings, 'FIRMWARE_PATCH_CACHE_MAX_COUNT', 100)
+
+    total_bytes = FirmwarePatch.objects.aggregate(total=Sum('patch_size'))['total'] or 0
+    total_count = FirmwarePatch.objects.count()
+
+    evicted = 0
+    if total_bytes <= max_bytes and total_count <= max_count:
+        return evicted
+
+    # Never-served patches age from their build time
+    candidates = FirmwarePatch.objects.order_by(Coalesce('last_served_at', 'created_at'))
+    for patch in candidates.iterator():
+        if total_bytes <= max_bytes and total_count <= max_count:
+            break
+        total_bytes -= patch.patch_size
+        total_count -= 1
+        logger.info(f"Evicting firmware patch {patch}")
+        delete_patch(patch)
+        evicted += 1
+
+    return evicted
+
+
+def release_savings(to_firmware):
+    """
+    Report bytes saved by delta downloads for a release.
+
+    Returns:
+        Dict with patch count, times served and total bytes saved
+    """
+    patch_count = 0
+    bytes_saved = 0
+    served = 0
+    rows = FirmwarePatch.objects.filter(to_version=to_firmware).values_list('patch_size', 'served_count')
+    for patch_size, served_count in rows:
+        patch_count += 1
+        bytes_saved += max(0, to_firmware.file_size - patch_size) * served_count
+        served += served_count
+    return {
+        'patches': patch_count,
+        'served': served,
+        'bytes_saved': bytes_saved,
+    }
+
+
+def annotate_release_savings(queryset):
+    """
+    Annotate FirmwareVersions with patch_count and bytes_saved (as
+    release_savings() reports them) in the same query, for list views.
+    """
+    bytes_saved = Greatest(F('file_size') - F('patches_to__patch_size'), Value(0)) * F('patches_to__served_count')
+    return queryset.annotate(
+        patch_count=Count('patches_to'),
+        bytes_saved=Coalesce(Sum(bytes_saved, output_field=IntegerField()), 0),
+    )
@@ -0,0 +1,123 @@
+"""
+Release resolver for firmware update checks.
+Keeps the active releases per channel in process memory so device check-ins
+don't query and serialize FirmwareVersion on every wake-up, and applies
+staged rollouts by hashing the device serial number.
+"""
+import hashlib
+import logging
+import threading
+import time
+from django.conf import settings
+from devices import metrics
+from devices.caching import NAMESPACE_FIRMWARE, namespace_version, invalidate_namespace
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_STABLE = 'stable'
+CHANNEL_BETA = 'beta'
+
+# Channels whose releases a device on a given channel may receive
+CHANNEL_RELEASES = {
+    CHANNEL_STABLE: (CHANNEL_STABLE,),
+    CHANNEL_BETA: (CHANNEL_STABLE, CHANNEL_BETA),
+}
+
+# Pseudo-channel covering every active release (used to avoid downgrades)
+ALL_RELEASES = '_all'
+
+_lock = threading.Lock()
+_releases = {}  # channel -> (generation, loaded_at, [serialized release, ...])
+
+
+def invalidate_release_cache():
+    """Drop cached releases in this process and tell other workers to reload"""
+    with _lock:
+        _releases.clear()
+    invalidate_namespace(NAMESPACE_FIRMWARE)
+
+
+def _load_releases(channel):
+    """Query and serialize the active releases a channel may receive, newest first"""
+    from .models import FirmwareVersion
+    from .serializers import FirmwareVersionSerializer
+
+    queryset = FirmwareVersion.objects.filter(is_active=True).order_by('-release_date')
+    if channel != ALL_RELEASES:
+        queryset = queryset.filter(channel__in=CHANNEL_RELEASES[channel])
+    # No request in context: download_url stays relative and is made absolute per request
+    return [FirmwareVersionSerializer(firmware).data for firmware in queryset]
+
+
+def get_channel_releases(channel):
+    """
+    Get the serialized active releases for a channel, newest first.
+
+    Cached per process for FIRMWARE_RELEASE_CACHE_SECONDS (default 300) or
+    until invalidate_release_cache() is called from any worker.
+    """
+    ttl = getattr(settings, 'FIRMWARE_RELEASE_CACHE_SECONDS', 300)
+    # The shared namespace version lets every worker notice an admin save
+    generation = namespace_version(NAMESPACE_FIRMWARE)
+    now = time.monotonic()
+
+    entry = _releases.get(channel)
+    if entry and entry[0] == generation and now - entry[1] < ttl:
+        metrics.increment(f"cache.{NAMESPACE_FIRMWARE}.hits")
+        return entry[2]
+
+    metrics.increment(f"cache.{NAMESPACE_FIRMWARE}.misses")
+    releases = _load_releases(channel)
+    with _lock:
+        _releases[channel] = (generation, now, releases)
+    return releases
+
+
+def rollout_bucket(version, serial_number):
+    """Stable 0-99 bucket for a device and release (independent per release)"""
+    digest = hashlib.sha256(f"{version}:{serial_number}".encode()).hexdigest()
+    return int(digest[:8], 16) % 100
+
+
+def in_rollout(release, serial_number):
+    """Check whether a device falls inside a release's staged rollout"""
+    percentage = release['rollout_percentage']
+    if percentage >= 100:
+        return True
+    if not serial_number or percentage <= 0:
+        return False
+    return rollout_bucket(release['version'], serial_number) < percentage
+
+
+def resolve_release(channel=CHANNEL_STABLE, serial_number=None, current_version=None):
+    """
+    Find the newest release a device should run.
+
+    Args:
+        channel: 'stable' or 'beta' (unknown channels fall back to stable)
+        serial_number: Device serial, used for staged rollouts. Devices that
+            don't send one only receive fully rolled-out releases.
+        current_version: Version the device runs. If that is an active
+            release newer than the resolved one (e.g. installed by a rollout
+            or from another channel), it is returned so the device isn't
+            downgraded.
+
+    Returns:
+        Serialized release dict, or None if nothing is available
+    """
+    if channel not in CHANNEL_RELEASES:
+        channel = CHANNEL_STABLE
+
+    resolved = None
+    for release in get_channel_releases(channel):
+        if in_rollout(release, serial_number):
+            resolved = release
+            break
+
+    if current_version and (resolved is None or current_version != resolved['version']):
+        for release in get_channel_releases(ALL_RELEASES):
+            if resolved is not None and release['version'] == resolved['version']:
+                break
+            if release['version'] == current_version:
+                return release
+    return resolved
@@ -0,0 +1,314 @@
+"""
+Firmware rollout scheduler.
+A rollout persists one FirmwareUpdateJob per device and releases them in
+waves (wave size, concurrency limit, wave interval) so a fleet update
+never floods the server or the cellular data budget. Devices pick up an
+offered job on their next firmware check-in and report download, apply and
+confirm states. Rollouts pause themselves when the failure rate crosses
+their threshold.
+
+Run advance_rollouts() periodically (manage.py run_firmware_rollouts).
+"""
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+from .models import FirmwareRollout, FirmwareUpdateJob
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_ROLLOUTS_CACHE_KEY = 'firmware:active_rollouts'
+
+# Rollouts whose devices may still be downloading their firmware
+UNFINISHED_ROLLOUT_STATUSES = ('running', 'paused')
+
+# Device report -> job state
+REPORT_STATES = {
+    'download': 'downloading',
+    'apply': 'applying',
+    'confirm': 'confirmed',
+    'failed': 'failed',
+}
+
+
+def _progress_aggregates(prefix=''):
+    """Count() expressions per job state (prefix 'jobs__' when annotating rollouts)"""
+    aggregates = {'total': Count(f'{prefix}id')}
+    for state, _ in FirmwareUpdateJob.STATE_CHOICES:
+        aggregates[state] = Count(f'{prefix}id', filter=Q(**{f'{prefix}state': state}))
+    return aggregates
+
+
+def rollout_progress(rollout):
+    """
+    Per-state job counts for a rollout from a single aggregate query.
+
+    Returns:
+        Dict with 'total', one key per job state, 'in_flight' and 'percent_done'
+    """
+    progress = FirmwareUpdateJob.objects.filter(rollout=rollout).aggregate(**_progress_aggregates())
+    return _with_derived(progress)
+
+
+def rollouts_with_progress(queryset=None):
+    """Annotate rollouts with per-state job counts (one query for the whole list)"""
+    queryset = queryset if queryset is not None else FirmwareRollout.objects.all()
+    return queryset.select_related('firmware').annotate(
+        **{f'jobs_{key}': value for key, value in _progress_aggregates('jobs__').items()}
+    )
+
+
+def _with_derived(progress):
+    progress['in_flight'] = sum(progress[state] for state in FirmwareUpdateJob.IN_FLIGHT_STATES)
+    finished = progress['confirmed'] + progress['failed']
+    progress['percent_done'] = round(finished * 100 / progress['total'], 1) if progress['total'] else 0
+    return progress
+
+
+def has_active_rollouts():
+    """Cheap check used by device check-ins before looking up jobs"""
+    try:
+        active = cache.get(ACTIVE_ROLLOUTS_CACHE_KEY)
+    except Exception:
+        active = None
+    if active is None:
+        active = FirmwareRollout.objects.filter(status='running').exists()
+        try:
+            cache.set(ACTIVE_ROLLOUTS_CACHE_KEY, active, timeout=60)
+        except Exception as e:
+            logger.debug(f"Could not cache active rollout flag: {str(e)}")
+    return active
+
+
+def _set_status(rollout, status, reason=''):
+    rollout.status = status
+    rollout.pause_reason = reason
+    update_fields = ['status', 'pause_reason']
+    if status == 'completed':
+        rollout.completed_at = timezone.now()
+        update_fields.append('completed_at')
+    rollout.save(update_fields=update_fields)
+    try:
+        cache.delete(ACTIVE_ROLLOUTS_CACHE_KEY)
+    except Exception as e:
+        logger.debug(f"Could not clear active rollout flag: {str(e)}")
+    logger.info(f"{rollout}: {reason or status}")
+
+
+def create_rollout(firmware, devices, user=None, **pacing):
+    """
+    Persist a rollout with one pending job per device and release the first wave.
+
+    Args:
+        firmware: Target FirmwareVersion
+        devices: Device queryset or iterable
+        user: Staff user starting the rollout
+        **pacing: wave_size, max_concurrent, wave_interval_minutes,
+            failure_threshold_percent, min_failures_to_pause
+
+    Returns:
+        FirmwareRollout
+    """
+    with transaction.atomic():
+        rollout = FirmwareRollout.objects.create(firmware=firmware, created_by=user, **pacing)
+        FirmwareUpdateJob.objects.bulk_create(
+            [FirmwareUpdateJob(rollout=rollout, device=device) for device in devices],
+            batch_size=500
+        )
+    try:
+        cache.delete(ACTIVE_ROLLOUTS_CACHE_KEY)
+    except Exception as e:
+        logger.debug(f"Could not clear active rollout flag: {str(e)}")
+    advance_rollout(rollout)
+    return rollout
+
+
+def pause_rollout(rollout, reason='Paused by staff'):
+    if rollout.status == 'running':
+        _set_status(rollout, 'paused', reason)
+
+
+def resume_rollout(rollout):
+    """Resume a paused rollout; failures so far no longer count toward the threshold"""
+    if rollout.status == 'paused':
+        rollout.acknowledged_failures = rollout_progress(rollout)['failed']
+        rollout.save(update_fields=['acknowledged_failures'])
+        _set_status(rollout, 'running')
+        advance_rollout(rollout, force_wave=True)
+
+
+def cancel_rollout(rollout):
+    """Stop a rollout; jobs not yet offered are failed so devices aren't offered the release"""
+    if rollout.status in UNFINISHED_ROLLOUT_STATUSES:
+        rollout.jobs.filter(state='pending').update(state='failed', error_message='Rollout cancelled')
+        _set_status(rollout, 'cancelled')
+
+
+def _check_failure_threshold(rollout, progress):
+    """Pause the rollout if too many finished jobs failed. Returns True if paused."""
+    failed = progress['failed'] - rollout.acknowledged_failures
+    finished = failed + progress['confirmed']
+    if failed < max(rollout.min_failures_to_pause, 1) or not finished:
+        return False
+    failure_rate = failed * 100 / finished
+    if failure_rate >= rollout.failure_threshold_percent:
+        _set_status(
+            rollout,
+            'paused',
+            f"Auto-paused: {failed}/{finished} updates failed ({failure_rate:.0f}%)"
+        )
+        return True
+    return False
+
+
+def _expire_stale_jobs(rollout):
+    """Fail jobs that were offered but never finished (frees their concurrency slot)"""
+    timeout = getattr(settings, 'FIRMWARE_ROLLOUT_JOB_TIMEOUT_MINUTES', 360)
+    cutoff = timezone.now() - timedelta(minutes=timeout)
+    return rollout.jobs.filter(
+        state__in=FirmwareUpdateJob.IN_FLIGHT_STATES,
+        offered_at__lt=cutoff
+    ).update(state='failed', error_message='Timed out', updated_at=timezone.now())
+
+
+def _notify_devices(rollout, serial_numbers):
+    """Nudge devices that hold a live connection; the rest pick the job up on check-in"""
+    try:
+        from channels.layers import get_channel_layer
+        from asgiref.sync import async_to_sync
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        for serial in serial_numbers:
+            async_to_sync(channel_layer.group_send)(
+                f'device_{serial}',
+                {
+                    'type': 'firmware_update',
+                    'version': rollout.firmware.version,
+                    'file_size': rollout.firmware.file_size,
+                }
+            )
+    except Exception as e:
+        logger.warning(f"Could not notify devices for {rollout}: {str(e)}")
+
+
+def advance_rollout(rollout, force_wave=False):
+    """
+    Run one scheduling step: expire stale jobs, enforce the failure
+    threshold, complete finished rollouts and release the next wave if the
+    wave interval has passed and concurrency slots are free.
+
+    Returns:
+        Number of jobs offered in this step
+    """
+    if rollout.status != 'running':
+        return 0
+
+    _expire_stale_jobs(rollout)
+    progress = rollout_progress(rollout)
+
+    if _check_failure_threshold(rollout, progress):
+        return 0
+
+    if progress['pending'] == 0:
+        if progress['in_flight'] == 0:
+            _set_status(rollout, 'completed')
+        return 0
+
+    now = timezone.now()
+    if (
+        not force_wave
+        and rollout.last_wave_at
+        and now - rollout.last_wave_at < timedelta(minutes=rollout.wave_interval_minutes)
+    ):
+        return 0
+
+    slots = min(rollout.wave_size, rollout.max_concurrent - progress['in_flight'])
+    if slots <= 0:
+        return 0
+
+    with transaction.atomic():
+        wave = list(
+            rollout.jobs.select_for_update(skip_locked=True, of=('self',))
+            .filter(state='pending')
+            .values_list('id', 'device__serial_number')[:slots]
+        )
+        job_ids = [job_id for job_id, _ in wave]
+        offered = FirmwareUpdateJob.objects.filter(id__in=job_ids, state='pending').update(
+            state='offered', offered_at=now, updated_at=now
+        )
+        FirmwareRollout.objects.filter(pk=rollout.pk).update(last_wave_at=now)
+        rollout.last_wave_at = now
+
+    _notify_devices(rollout, [serial for _, serial in wave])
+    logger.info(f"{rollout}: offered wave of {offered} device(s)")
+    return offered
+
+
+def advance_rollouts():
+    """Advance every running rollout. Returns total jobs offered."""
+    offered = 0
+    for rollout in FirmwareRollout.objects.filter(status='running').select_related('firmware'):
+        try:
+            offered += advance_rollout(rollout)
+        except Exception as e:
+            logger.error(f"Error advancing {rollout}: {str(e)}", exc_info=True)
+    return offered
+
+
+def get_offered_job(serial_number):
+    """
+    Find the job a checking-in device should act on.
+
+    Returns:
+        FirmwareUpdateJob (with rollout and firmware loaded) or None
+    """
+    if not serial_number or not has_active_rollouts():
+        return None
+    return FirmwareUpdateJob.objects.filter(
+        device__serial_number=serial_number,
+        state__in=FirmwareUpdateJob.IN_FLIGHT_STATES,
+        rollout__status='running'
+    ).select_related('rollout__firmware').order_by('-offered_at').first()
+
+
+def record_device_report(serial_number, report, version=None, error=''):
+    """
+    Apply a device progress report to its in-flight job.
+
+    Args:
+        serial_number: Device serial
+        report: 'download', 'apply', 'confirm' or 'failed'
+        version: Firmware version the report refers to (optional check)
+        error: Error message for failed reports
+
+    Returns:
+        Updated FirmwareUpdateJob or None if the device has no in-flight job
+    """
+    state = REPORT_STATES.get(report)
+    if not state:
+        raise ValueError(f"Unknown report '{report}'")
+
+    job = FirmwareUpdateJob.objects.filter(
+        device__serial_number=serial_number,
+        state__in=FirmwareUpdateJob.IN_FLIGHT_STATES
+    ).select_related('rollout__firmware').order_by('-offered_at').first()
+    if not job:
+        return None
+    if version and version != job.rollout.firmware.version:
+        logger.warning(
+            f"Device {serial_number} reported {report} for v{version}, "
+            f"expected v{job.rollout.firmware.version}"
+        )
+        return None
+
+    job.state = state
+    job.error_message = error[:255] if state == 'failed' else ''
+    job.save(update_fields=['state', 'error_message', 'updated_at'])
+
+    if state == 'failed' and job.rollout.status == 'running':
+        _check_failure_threshold(job.rollout, rollout_progress(job.rollout))
+    return job
@@ -1,3 +1,4 @@
+from django.urls import reverse
 from rest_framework import serializers
 from .models import FirmwareVersion
 
@@ -7,13 +8,14 @@ class FirmwareVersionSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = FirmwareVersion
-        fields = ['id', 'version', 'download_url', 'file_size', 'release_date', 'release_notes', 'is_active']
+        fields = ['id', 'version', 'download_url', 'file_size', 'sha256', 'release_date', 'release_notes', 'is_active', 'channel', 'rollout_percentage']
     
     def get_download_url(self, obj):
+        if not obj.file:
+            return None
+        url = reverse('firmware:download_firmware', args=[obj.version])
         request = self.context.get('request')
-        if request and obj.file:
-            return request.build_absolute_uri(obj.file.url)
-        return None
+        return request.build_absolute_uri(url) if request else url
 
 
 
@@ -1,3 +1,326 @@
-from django.test import TestCase
+import shutil
+import tempfile
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from devices.device_auth import generate_api_key, hash_api_key, invalidate_device_keys
+from devices.models import Device
+from .models import FirmwareVersion, FirmwarePatch, FirmwareUpdateJob
+from .ota import annotate_release_savings, release_savings
+from .releases import invalidate_release_cache, resolve_release, rollout_bucket
+from .rollout import (
+    advance_rollout, cancel_rollout, create_rollout, record_device_report, resume_rollout, rollout_progress,
+)
 
-# Create your tests here.
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+IN_MEMORY_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+def use_temp_media(test_case):
+    """Point MEDIA_ROOT at a temporary directory for one test"""
+    media_root = tempfile.mkdtemp()
+    test_case.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+    media = override_settings(MEDIA_ROOT=media_root)
+    media.enable()
+    test_case.addCleanup(media.disable)
+
+
+def add_firmware(version, content=b'f' * 1000, **fields):
+    firmware = FirmwareVersion(version=version, **fields)
+    firmware.file.save(f'firmware-{version}.bin', ContentFile(content))
+    return firmware
+
+
+def add_device(serial_number, firmware_version=''):
+    """Device with an API key; returns (device, Authorization header)"""
+    api_key = generate_api_key()
+    device = Device.objects.create(
+        serial_number=serial_number, api_key_hash=hash_api_key(api_key), firmware_version=firmware_version
+    )
+    invalidate_device_keys()
+    return device, f'Device {serial_number}:{api_key}'
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ReleaseResolverTests(TestCase):
+
+    def setUp(self):
+        use_temp_media(self)
+        invalidate_release_cache()
+        self.addCleanup(invalidate_release_cache)
+        add_firmware('1.0.0')
+        add_firmware('1.1.0', channel='beta')
+        add_firmware('1.2.0', rollout_percentage=50)
+
+    def version(self, **device):
+        release = resolve_release(**device)
+        return release and release['version']
+
+    def test_staged_release_reaches_its_share_of_devices(self):
+        serials = [f'ESP-{n:04d}' for n in range(200)]
+        staged = [serial for serial in serials if self.version(serial_number=serial) == '1.2.0']
+        self.assertEqual(staged, [serial for serial in serials if rollout_bucket('1.2.0', serial) < 50])
+        self.assertTrue(60 < len(staged) < 140)
+        # Devices without a serial only get fully rolled-out releases
+        self.assertEqual(self.version(), '1.0.0')
+
+    def test_beta_devices_also_get_stable_releases(self):
+        outside = next(f'ESP-{n}' for n in range(100) if rollout_bucket('1.2.0', f'ESP-{n}') >= 50)
+        self.assertEqual(self.version(channel='beta', serial_number=outside), '1.1.0')
+        self.assertEqual(self.version(channel='stable', serial_number=outside), '1.0.0')
+        # A device already on a newer release isn't downgraded
+        self.assertEqual(self.version(serial_number=outside, current_version='1.1.0'), '1.1.0')
+
+    def test_releases_are_cached_until_a_version_is_saved(self):
+        self.version()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.version(), '1.0.0')
+        add_firmware('1.3.0')
+        self.assertEqual(self.version(), '1.3.0')
+
+
+@override_settings(CACHES=LOCMEM_CACHES, FIRMWARE_X_ACCEL_REDIRECT_PREFIX='')
+class FirmwareDownloadTests(TestCase):
+    """Resumable full-image downloads"""
+
+    content = bytes(range(256)) * 8
+
+    def setUp(self):
+        use_temp_media(self)
+        self.firmware = add_firmware('2.0.0', self.content, is_active=True)
+        self.url = reverse('firmware:download_firmware', args=['2.0.0'])
+        self.etag = f'"{self.firmware.sha256}"'
+
+    def get(self, **headers):
+        response = self.client.get(self.url, **headers)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        response.close()
+        return response, body
+
+    def test_full_download_has_a_strong_etag(self):
+        response, body = self.get()
+        self.assertEqual((response.status_code, body), (200, self.content))
+        self.assertEqual(response['ETag'], self.etag)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_range_resumes_a_download(self):
+        response, body = self.get(HTTP_RANGE='bytes=1000-')
+        self.assertEqual((response.status_code, body), (206, self.content[1000:]))
+        self.assertEqual(response['Content-Range'], 'bytes 1000-2047/2048')
+
+        response, body = self.get(HTTP_RANGE='bytes=-48')
+        self.assertEqual((response.status_code, body), (206, self.content[-48:]))
+
+        response, _ = self.get(HTTP_RANGE='bytes=4096-')
+        self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */2048'))
+
+    def test_if_range_for_another_image_restarts_the_download(self):
+        response, body = self.get(HTTP_RANGE='bytes=1000-', HTTP_IF_RANGE=f'"{"0" * 64}"')
+        self.assertEqual((response.status_code, body), (200, self.content))
+        response, body = self.get(HTTP_RANGE='bytes=1000-', HTTP_IF_RANGE=self.etag)
+        self.assertEqual((response.status_code, body), (206, self.content[1000:]))
+
+    def test_matching_etag_is_not_modified(self):
+        response, body = self.get(HTTP_IF_NONE_MATCH=self.etag)
+        self.assertEqual((response.status_code, body), (304, b''))
+
+    @override_settings(FIRMWARE_X_ACCEL_REDIRECT_PREFIX='/protected-media/')
+    def test_nginx_serves_the_file(self):
+        response, body = self.get(HTTP_RANGE='bytes=1000-')
+        self.assertEqual((response.status_code, body), (200, b''))
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{self.firmware.file.name}')
+
+
+@override_settings(CACHES=LOCMEM_CACHES, FIRMWARE_X_ACCEL_REDIRECT_PREFIX='')
+class PatchDownloadCountTests(TestCase):
+    """Patches are counted when a download starts, once per known device"""
+
+    def setUp(self):
+        use_temp_media(self)
+        from_version = FirmwareVersion.objects.create(version='1.0.0')
+        to_version = FirmwareVersion.objects.create(version='1.1.0')
+        self.patch = FirmwarePatch(
+            from_version=from_version, to_version=to_version, patch_size=1024, sha256='a' * 64, target_sha256='b' * 64
+        )
+        self.patch.file.save('1.0.0_to_1.1.0.patch', ContentFile(b'p' * 1024))
+        self.url = reverse('firmware:download_patch', args=[self.patch.pk])
+
+    def served_count(self):
+        self.patch.refresh_from_db()
+        return self.patch.served_count
+
+    def download(self, **headers):
+        response = self.client.get(self.url, **headers)
+        b''.join(response.streaming_content)
+        response.close()
+        return response.status_code
+
+    def test_counts_started_downloads_only(self):
+        self.assertEqual(self.download(), 200)
+        self.assertEqual(self.download(HTTP_RANGE='bytes=0-511'), 206)
+        self.assertEqual(self.served_count(), 2)
+
+        # Resumes, conditional requests and HEAD aren't new downloads
+        self.assertEqual(self.download(HTTP_RANGE='bytes=512-'), 206)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=f'"{"a" * 64}"').status_code, 304)
+        self.assertEqual(self.client.head(self.url).status_code, 200)
+        self.assertEqual(self.served_count(), 2)
+
+    def test_counts_once_per_device(self):
+        api_key = generate_api_key()
+        Device.objects.create(serial_number='ESP-OTA', api_key_hash=hash_api_key(api_key))
+        invalidate_device_keys()
+        self.addCleanup(invalidate_device_keys)
+        authorization = f'Device ESP-OTA:{api_key}'
+
+        for _ in range(3):
+            self.assertEqual(self.download(HTTP_AUTHORIZATION=authorization), 200)
+        self.assertEqual(self.served_count(), 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, CHANNEL_LAYERS=IN_MEMORY_LAYERS, DEVICE_RATE_LIMITS={})
+class RolloutCheckInTests(TestCase):
+
+    def setUp(self):
+        use_temp_media(self)
+        self.addCleanup(invalidate_device_keys)
+        add_firmware('1.0.0')
+        self.target = add_firmware('1.1.0', channel='beta')
+        self.device, self.authorization = add_device('ESP-ROLL', '1.0.0')
+        self.rollout = create_rollout(self.target, [self.device])
+        self.job = FirmwareUpdateJob.objects.get(rollout=self.rollout)
+
+    def check_in(self, current_version):
+        return self.client.get(
+            reverse('firmware:latest_firmware'), {'current_version': current_version},
+            HTTP_AUTHORIZATION=self.authorization
+        )
+
+    def test_offered_job_gets_rollout_release(self):
+        response = self.check_in('1.0.0')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['version'], '1.1.0')
+
+    def test_check_in_on_target_version_does_not_confirm(self):
+        for _ in range(3):
+            self.assertEqual(self.check_in('1.1.0').status_code, 304)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.state, 'offered')
+
+        response = self.client.post(
+            reverse('firmware:report_update'), {'state': 'confirm', 'version': '1.1.0'},
+            content_type='application/json', HTTP_AUTHORIZATION=self.authorization
+        )
+        self.assertEqual(response.json(), {'state': 'confirmed'})
+
+    def test_rollout_firmware_is_downloadable_until_the_rollout_ends(self):
+        self.target.is_active = False
+        self.target.save()
+        url = reverse('firmware:download_firmware', args=['1.1.0'])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+        cancel_rollout(self.rollout)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class FirmwareAdminListTests(TestCase):
+
+    def setUp(self):
+        use_temp_media(self)
+        self.client.force_login(User.objects.create_superuser('ota-admin', password='x'))
+        previous = None
+        for minor in range(6):
+            firmware = add_firmware(f'1.{minor}.0', b'f' * 4096)
+            if previous is not None:
+                FirmwarePatch.objects.create(
+                    from_version=previous, to_version=firmware, patch_size=1024, served_count=minor,
+                    sha256='a' * 64, target_sha256='b' * 64
+                )
+            previous = firmware
+
+    def test_delta_savings_match_release_savings(self):
+        for firmware in annotate_release_savings(FirmwareVersion.objects.all()):
+            savings = release_savings(firmware)
+            self.assertEqual((firmware.patch_count, firmware.bytes_saved), (savings['patches'], savings['bytes_saved']))
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        url = reverse('admin:firmware_firmwareversion_changelist')
+        with self.assertNumQueries(5):
+            response = self.client.get(url)
+        self.assertContains(response, '1 patch(es)', count=5)
+
+        add_firmware('2.0.0')
+        with self.assertNumQueries(5):
+            self.client.get(url)
+
+    def test_delete_action_works_on_the_annotated_queryset(self):
+        firmware = FirmwareVersion.objects.get(version='1.5.0')
+        response = self.client.post(reverse('admin:firmware_firmwareversion_changelist'), {
+            'action': 'delete_selected', '_selected_action': [firmware.pk], 'post': 'yes',
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(FirmwareVersion.objects.filter(pk=firmware.pk).exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHES, CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class RolloutSchedulerTests(TestCase):
+    """Waves, concurrency, failure pauses and completion"""
+
+    def setUp(self):
+        use_temp_media(self)
+        self.addCleanup(invalidate_device_keys)
+        self.firmware = add_firmware('3.0.0')
+        self.serials = [f'ESP-W{n}' for n in range(5)]
+        devices = [add_device(serial, '2.0.0')[0] for serial in self.serials]
+        self.rollout = create_rollout(
+            self.firmware, devices, wave_size=3, max_concurrent=2, wave_interval_minutes=15,
+            failure_threshold_percent=50, min_failures_to_pause=2
+        )
+
+    def offered_serials(self):
+        return sorted(self.rollout.jobs.filter(state='offered').values_list('device__serial_number', flat=True))
+
+    def next_wave(self):
+        """Advance as if the wave interval had passed"""
+        self.rollout.last_wave_at = timezone.now() - timedelta(minutes=16)
+        return advance_rollout(self.rollout)
+
+    def report(self, report, serials):
+        for serial in serials:
+            record_device_report(serial, report, version='3.0.0')
+
+    def test_waves_respect_concurrency_and_interval(self):
+        first_wave = self.offered_serials()
+        self.assertEqual(len(first_wave), 2)  # max_concurrent, not wave_size
+        self.assertEqual(self.next_wave(), 0)  # No free slot
+
+        self.report('confirm', first_wave)
+        self.rollout.last_wave_at = timezone.now()
+        self.assertEqual(advance_rollout(self.rollout), 0)  # Interval not over
+        self.assertEqual(self.next_wave(), 2)
+        self.report('confirm', self.offered_serials())
+        self.assertEqual(self.next_wave(), 1)
+        self.report('confirm', self.offered_serials())
+
+        self.next_wave()
+        self.rollout.refresh_from_db()
+        self.assertEqual(self.rollout.status, 'completed')
+        self.assertEqual(rollout_progress(self.rollout)['percent_done'], 100)
+
+    def test_failures_pause_until_resumed(self):
+        self.report('failed', self.offered_serials())
+        self.rollout.refresh_from_db()
+        self.assertEqual(self.rollout.status, 'paused')
+        self.assertIn('2/2 updates failed', self.rollout.pause_reason)
+        self.assertEqual(self.next_wave(), 0)
+
+        resume_rollout(self.rollout)
+        self.rollout.refresh_from_db()
+        self.assertEqual((self.rollout.status, self.rollout.acknowledged_failures), ('running', 2))
+        self.assertEqual(len(self.offered_serials()), 2)
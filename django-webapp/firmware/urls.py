@@ -5,6 +5,9 @@ app_name = 'firmware'
 
 urlpatterns = [
     path('latest/', views.latest_firmware, name='latest_firmware'),
+    path('download/<str:version>/', views.download_firmware, name='download_firmware'),
+    path('patch/<int:patch_id>/', views.download_patch, name='download_patch'),
+    path('report/', views.report_update, name='report_update'),
 ]
 
 
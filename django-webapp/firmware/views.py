@@ -1,29 +1,164 @@
-from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import AllowAny
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
 from rest_framework.response import Response
+from django.db.models import Q
 from django.http import Http404
-from .models import FirmwareVersion
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.views.decorators.http import require_http_methods
+from .models import FirmwareVersion, FirmwarePatch
+from .ota import find_patch, record_patch_served
+from .releases import resolve_release, CHANNEL_STABLE
+from .rollout import UNFINISHED_ROLLOUT_STATUSES, get_offered_job, record_device_report
 from .serializers import FirmwareVersionSerializer
+from .downloads import serve_firmware_file
+from devices.device_auth import (
+    DeviceKeyAuthentication, IsDevice, device_serial, parse_authorization, verify_device_key,
+)
 
 
 @api_view(['GET'])
-@permission_classes([AllowAny])  # Allow ESP32 devices to check for updates
+@authentication_classes([DeviceKeyAuthentication])
+@permission_classes([IsDevice])
 def latest_firmware(request):
     """
-    Returns the latest active firmware version information.
+    Returns the firmware release a device should run.
+    Devices pass ?serial=ESP-12345 (used for staged rollouts), optionally
+    ?channel=beta and ?current_version=1.0.0 (defaults to the version they
+    last reported). Returns 304 Not Modified when the device is already on
+    that release. When a delta patch from the current version exists the
+    response includes a 'patch' object, otherwise devices use download_url.
+    Devices with an offered rollout job get the rollout's release instead;
+    once running it they confirm through report_update. This GET never
+    changes job state, so retries, caches and prefetches can't confirm an
+    install. With device credentials the serial comes from the Authorization header.
     """
+    serial = device_serial(request, request.GET.get('serial'))
     try:
-        latest = FirmwareVersion.objects.filter(is_active=True).order_by('-release_date').first()
+        current_version = request.GET.get('current_version')
+        if not current_version and serial:
+            from devices.models import Device
+            current_version = Device.objects.filter(serial_number=serial).values_list(
+                'firmware_version', flat=True
+            ).first()
         
-        if not latest:
+        release = None
+        job = get_offered_job(serial)
+        if job:
+            if current_version == job.rollout.firmware.version:
+                # Already running the rollout's release: it confirms through report_update
+                return Response(status=304)
+            release = FirmwareVersionSerializer(job.rollout.firmware).data
+        
+        if release is None:
+            release = resolve_release(request.GET.get('channel', CHANNEL_STABLE), serial, current_version)
+        
+        if not release:
             return Response({
                 'error': 'No active firmware version available'
             }, status=404)
         
-        serializer = FirmwareVersionSerializer(latest, context={'request': request})
-        return Response(serializer.data)
+        if current_version == release['version']:
+            return Response(status=304)
+        
+        # Cached releases are shared: copy before adding request-specific fields
+        data = dict(release)
+        if data['download_url']:
+            data['download_url'] = request.build_absolute_uri(data['download_url'])
+        
+        patch = find_patch(current_version, release['version'])
+        if patch and patch.file:
+            data['patch'] = {
+                'from_version': patch.from_version.version,
+                'download_url': request.build_absolute_uri(reverse('firmware:download_patch', args=[patch.pk])),
+                'size': patch.patch_size,
+                'sha256': patch.sha256,
+                'target_sha256': patch.target_sha256,
+                'compression': patch.compression,
+            }
+        
+        return Response(data)
     
     except Exception as e:
         return Response({
             'error': str(e)
         }, status=500)
+
+
+@api_view(['POST'])
+@authentication_classes([DeviceKeyAuthentication])
+@permission_classes([IsDevice])
+def report_update(request):
+    """
+    Device reports firmware update progress for its rollout job.
+    Body: {"serial": "ESP-12345", "state": "download|apply|confirm|failed",
+           "version": "1.2.0", "error": "..."}
+    """
+    serial = device_serial(request, request.data.get('serial'))
+    state = request.data.get('state')
+    if not serial or not state:
+        return Response({'error': 'serial and state are required'}, status=400)
+    
+    try:
+        job = record_device_report(
+            serial,
+            state,
+            version=request.data.get('version'),
+            error=request.data.get('error') or ''
+        )
+    except ValueError as e:
+        return Response({'error': str(e)}, status=400)
+    
+    if not job:
+        return Response({'error': 'No firmware update in progress for this device'}, status=404)
+    return Response({'state': job.state})
+
+
+@require_http_methods(['GET', 'HEAD'])
+def download_firmware(request, version):
+    """
+    Download an active firmware image, or one a running or paused rollout
+    offers (rollouts may ship a release before it is made active).
+    Supports Range (resume after a dropped connection), ETag/If-None-Match
+    and, behind nginx, X-Accel-Redirect.
+    """
+    firmware = get_object_or_404(
+        FirmwareVersion.objects.filter(
+            Q(is_active=True) | Q(rollouts__status__in=UNFINISHED_ROLLOUT_STATUSES)
+        ).distinct(),
+        version=version
+    )
+    if not firmware.file:
+        raise Http404('Firmware file missing')
+    return serve_firmware_file(
+        request,
+        firmware.file,
+        firmware.sha256,
+        firmware.file_size,
+        f"firmware-{firmware.version}.bin"
+    )
+
+
+@require_http_methods(['GET', 'HEAD'])
+def download_patch(request, patch_id):
+    """
+    Download a delta patch (same Range/ETag handling as full images).
+    Counts a download when one starts (resumed ranges, HEAD and 304s aren't
+    counted), once per device when it sends its credentials.
+    """
+    patch = get_object_or_404(FirmwarePatch.objects.select_related('from_version', 'to_version'), pk=patch_id)
+    if not patch.file:
+        raise Http404('Patch file missing')
+    response = serve_firmware_file(
+        request,
+        patch.file,
+        patch.sha256,
+        patch.patch_size,
+        f"{patch.from_version.version}_to_{patch.to_version.version}.patch"
+    )
+    range_header = request.META.get('HTTP_RANGE', '').replace(' ', '')
+    if request.method == 'GET' and response.status_code in (200, 206) and (
+            not range_header or range_header.startswith('bytes=0-')):
+        credentials = parse_authorization(request.META.get('HTTP_AUTHORIZATION', ''))
+        serial = credentials[0] if credentials and verify_device_key(*credentials) is not None else None
+        record_patch_served(patch, serial)
+    return response
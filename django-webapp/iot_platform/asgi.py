@@ -20,11 +20,13 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'iot_platform.settings')
 # is populated before importing code that may import ORM models.
 django_asgi_app = get_asgi_application()
 
-# Import WebSocket routing after Django is initialized
+# Import WebSocket routing and device admission after Django is initialized
+from devices.admission import DeviceApiAdmission
 from web.routing import websocket_urlpatterns
 
 application = ProtocolTypeRouter({
-    "http": django_asgi_app,
+    # Device API rate limits and upload ceiling apply before Django reads the body
+    "http": DeviceApiAdmission(django_asgi_app),
     "websocket": AllowedHostsOriginValidator(
         AuthMiddlewareStack(
             URLRouter(websocket_urlpatterns)
@@ -80,6 +80,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'devices.rate_limit.DeviceRateLimitMiddleware',  # Before anything reads the request body
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -175,7 +176,7 @@ STATICFILES_DIRS = [
 # WhiteNoise for static files in production
 if not DEBUG:
     STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
-    MIDDLEWARE.insert(1, 'whitenoise.middleware.WhiteNoiseMiddleware')
+    MIDDLEWARE.insert(1, 'iot_platform.middleware.AsyncWhiteNoiseMiddleware')  # Async-capable WhiteNoise
     
     # Nginx/Proxy settings
     USE_TZ = True
@@ -191,6 +192,18 @@ if not DEBUG:
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Delta OTA patches (detools)
+FIRMWARE_PATCH_COMPRESSION = config('FIRMWARE_PATCH_COMPRESSION', default='heatshrink')
+FIRMWARE_PATCH_MAX_RATIO = config('FIRMWARE_PATCH_MAX_RATIO', default=0.8, cast=float)  # Skip patches larger than this share of the full image
+FIRMWARE_PATCH_CACHE_MAX_MB = config('FIRMWARE_PATCH_CACHE_MAX_MB', default=200, cast=int)
+FIRMWARE_PATCH_CACHE_MAX_COUNT = config('FIRMWARE_PATCH_CACHE_MAX_COUNT', default=100, cast=int)
+
+# Firmware downloads: set to the nginx internal location (e.g. /protected-media/)
+# to hand file transfer to nginx via X-Accel-Redirect; empty streams from Django
+FIRMWARE_X_ACCEL_REDIRECT_PREFIX = config('FIRMWARE_X_ACCEL_REDIRECT_PREFIX', default='')
+FIRMWARE_RELEASE_CACHE_SECONDS = config('FIRMWARE_RELEASE_CACHE_SECONDS', default=300, cast=int)  # Upper bound; admin saves invalidate immediately
+FIRMWARE_ROLLOUT_JOB_TIMEOUT_MINUTES = config('FIRMWARE_ROLLOUT_JOB_TIMEOUT_MINUTES', default=360, cast=int)  # Offered jobs not confirmed by then count as failed
+
 # Login URL for @login_required decorator
 LOGIN_URL = '/login/'
 LOGIN_REDIRECT_URL = '/'
@@ -225,6 +238,79 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Shared cache (also backs metrics, ownership and release invalidation across workers).
+# Set CACHE_REDIS_URL to an empty string to fall back to a per-process cache.
+CACHE_REDIS_URL = config('CACHE_REDIS_URL', default=f'redis://{REDIS_HOST}:{REDIS_PORT}/1')
+
+if CACHE_REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': CACHE_REDIS_URL,
+            'KEY_PREFIX': 'smartmailbox',
+            'OPTIONS': {
+                'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+                'SOCKET_CONNECT_TIMEOUT': 1,
+                'SOCKET_TIMEOUT': 1,
+                # Cache outages degrade to database reads instead of failing requests
+                'IGNORE_EXCEPTIONS': True,
+            },
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    }
+
+# Cached read paths (writes invalidate immediately; these bound staleness of heartbeat-driven fields)
+DASHBOARD_DEVICE_CACHE_SECONDS = config('DASHBOARD_DEVICE_CACHE_SECONDS', default=30, cast=int)
+ADMIN_DASHBOARD_CACHE_SECONDS = config('ADMIN_DASHBOARD_CACHE_SECONDS', default=60, cast=int)
+# How often each process checks whether another worker changed the plan catalogue
+PLAN_CATALOGUE_CHECK_SECONDS = config('PLAN_CATALOGUE_CHECK_SECONDS', default=5, cast=int)
+
+# Per-connection outbound WebSocket queue (oldest messages dropped when full)
+WEBSOCKET_SEND_QUEUE_SIZE = config('WEBSOCKET_SEND_QUEUE_SIZE', default=50, cast=int)
+
+# Per-device WebSocket event log (Redis stream) for resume after reconnect
+DEVICE_EVENT_LOG_MAX_LEN = config('DEVICE_EVENT_LOG_MAX_LEN', default=200, cast=int)
+DEVICE_EVENT_LOG_TTL_SECONDS = config('DEVICE_EVENT_LOG_TTL_SECONDS', default=86400, cast=int)
+
+# Device ownership cache for WebSocket connects and views (invalidated on claim/reassign)
+DEVICE_OWNER_CACHE_SECONDS = config('DEVICE_OWNER_CACHE_SECONDS', default=300, cast=int)
+
+# Device API authentication ("Authorization: Device <serial>:<api key>", keys from issue_device_keys).
+# Off by default: devices in the field don't send keys yet and would get 401. Rollout order:
+#   1. python manage.py issue_device_keys --missing
+#   2. flash the keys (firmware that sends the Authorization header) to every device
+#   3. set DEVICE_AUTH_REQUIRED=True
+DEVICE_AUTH_REQUIRED = config('DEVICE_AUTH_REQUIRED', default=False, cast=bool)
+DEVICE_KEY_CACHE_SECONDS = config('DEVICE_KEY_CACHE_SECONDS', default=300, cast=int)  # Upper bound; key changes invalidate immediately
+
+# Device API rate limits (token buckets, see devices/rate_limit.py), keyed by URL name.
+# 'N/period': bursts of N, refilled at N per period. 'tiers' override 'device' by the owner's plan.
+_CAPTURE_RATE_LIMITS = {
+    'device': '20/hour',
+    'tiers': {'plus': '40/hour', 'premium': '120/hour'},
+    'ip': '1200/hour',  # Generous: cellular devices share carrier NAT addresses
+}
+DEVICE_RATE_LIMITS = {
+    'capture_upload': _CAPTURE_RATE_LIMITS,
+    'capture_upload_sync': _CAPTURE_RATE_LIMITS,
+    'device_heartbeat': {
+        'device': '60/hour',
+        'ip': '3600/hour',
+    },
+}
+# Header carrying the client address from nginx; set empty when Django is exposed directly
+RATE_LIMIT_CLIENT_IP_HEADER = config('RATE_LIMIT_CLIENT_IP_HEADER', default='HTTP_X_REAL_IP')
+
+# Fleet wake scheduling: devices are spread over DEVICE_WAKE_SLOTS slots of the wake interval
+# (capture/heartbeat responses return next_wake_seconds). Keep the interval in sync with the firmware.
+DEVICE_WAKE_INTERVAL_SECONDS = config('DEVICE_WAKE_INTERVAL_SECONDS', default=7200, cast=int)
+DEVICE_WAKE_SLOTS = config('DEVICE_WAKE_SLOTS', default=120, cast=int)
+
 # Logging configuration
 # Ensure logs directory exists
 LOGS_DIR = BASE_DIR / 'logs'
@@ -284,6 +370,42 @@ GOOGLE_APPLICATION_CREDENTIALS = config('GOOGLE_APPLICATION_CREDENTIALS', defaul
 # Path to Google Cloud service account JSON file
 # Example: GOOGLE_APPLICATION_CREDENTIALS=/path/to/service-account-key.json
 
+# Vision analysis cache (keyed by SHA-256 of the image bytes)
+ANALYSIS_CACHE_TTL_SECONDS = config('ANALYSIS_CACHE_TTL_SECONDS', default=86400, cast=int)
+ANALYSIS_CACHE_MAX_ENTRIES = config('ANALYSIS_CACHE_MAX_ENTRIES', default=1024, cast=int)
+
+# Upload image normalization (downscale + re-encode before storage and analysis)
+INGEST_NORMALIZE_ENABLED = config('INGEST_NORMALIZE_ENABLED', default=True, cast=bool)
+INGEST_MAX_DIMENSION = config('INGEST_MAX_DIMENSION', default=1280, cast=int)
+INGEST_ANALYSIS_MAX_DIMENSION = config('INGEST_ANALYSIS_MAX_DIMENSION', default=1024, cast=int)
+INGEST_JPEG_QUALITY = config('INGEST_JPEG_QUALITY', default=80, cast=int)
+INGEST_STRIP_EXIF = config('INGEST_STRIP_EXIF', default=True, cast=bool)
+
+# Upload guard (checked from Content-Length and the JPEG header before the body is parsed)
+INGEST_MAX_IMAGE_KB = {'default': 512, 'plus': 768, 'premium': 1024}  # By owner's plan tier
+INGEST_MAX_IMAGE_DIMENSION = config('INGEST_MAX_IMAGE_DIMENSION', default=2592, cast=int)  # Longest side in px
+
+# Background threads (per process) for Vision analysis and notifications of async uploads
+INGEST_ANALYSIS_WORKERS = config('INGEST_ANALYSIS_WORKERS', default=4, cast=int)
+
+# Vision API call limits (per-call deadline, retries, concurrency, circuit breaker)
+VISION_CALL_TIMEOUT_SECONDS = config('VISION_CALL_TIMEOUT_SECONDS', default=10.0, cast=float)
+VISION_MAX_RETRIES = config('VISION_MAX_RETRIES', default=2, cast=int)
+VISION_RETRY_BASE_DELAY_SECONDS = config('VISION_RETRY_BASE_DELAY_SECONDS', default=0.5, cast=float)
+VISION_MAX_CONCURRENCY = config('VISION_MAX_CONCURRENCY', default=4, cast=int)
+VISION_CONCURRENCY_WAIT_SECONDS = config('VISION_CONCURRENCY_WAIT_SECONDS', default=5.0, cast=float)
+VISION_BREAKER_FAILURE_THRESHOLD = config('VISION_BREAKER_FAILURE_THRESHOLD', default=5, cast=int)
+VISION_BREAKER_RESET_SECONDS = config('VISION_BREAKER_RESET_SECONDS', default=60, cast=int)
+
+# Monthly billing run (process_billing)
+BILLING_WORKERS = config('BILLING_WORKERS', default=8, cast=int)  # Concurrent Stripe calls
+BILLING_BATCH_SIZE = config('BILLING_BATCH_SIZE', default=100, cast=int)  # Subscriptions written per batch
+DEVICE_SUSPEND_CHUNK_SIZE = config('DEVICE_SUSPEND_CHUNK_SIZE', default=1000, cast=int)  # Devices per UPDATE in check_suspended_devices
+
+# Stripe webhook ledger (events are applied asynchronously; process_stripe_events sweeps leftovers)
+STRIPE_EVENTS_PROCESS_IN_BACKGROUND = config('STRIPE_EVENTS_PROCESS_IN_BACKGROUND', default=True, cast=bool)
+STRIPE_EVENT_MAX_ATTEMPTS = config('STRIPE_EVENT_MAX_ATTEMPTS', default=5, cast=int)
+
 # Email Configuration
 EMAIL_BACKEND = config('EMAIL_BACKEND', default='django.core.mail.backends.smtp.EmailBackend')
 EMAIL_HOST = config('EMAIL_HOST', default='smtp.gmail.com')
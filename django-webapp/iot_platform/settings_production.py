@@ -80,8 +80,8 @@ STATIC_ROOT.mkdir(exist_ok=True)
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
 # Add WhiteNoise middleware (after SecurityMiddleware, before other middleware)
-if 'whitenoise.middleware.WhiteNoiseMiddleware' not in MIDDLEWARE:
-    MIDDLEWARE.insert(1, 'whitenoise.middleware.WhiteNoiseMiddleware')
+if 'iot_platform.middleware.AsyncWhiteNoiseMiddleware' not in MIDDLEWARE:
+    MIDDLEWARE.insert(1, 'iot_platform.middleware.AsyncWhiteNoiseMiddleware')
 
 # Media files (served by Nginx in production)
 MEDIA_URL = '/media/'
@@ -20,10 +20,15 @@ from django.conf import settings
 from django.conf.urls.static import static
 
 urlpatterns = [
-    path('admin/', admin.site.urls),
     path('api/device/', include('devices.urls')),
     path('api/firmware/', include('firmware.urls')),
+    # The staff pages in web.urls live under /admin/ (admin/dashboard/,
+    # admin/bulk-update/, ...). admin.site.urls ends in a catch-all view that
+    # matches any /admin/ path (404 or login redirect), so web.urls must be
+    # resolved first. Only those explicit paths are shadowed; every other
+    # /admin/ URL still reaches the Django admin.
     path('', include('web.urls')),
+    path('admin/', admin.site.urls),
 ]
 
 # Serve static and media files in development
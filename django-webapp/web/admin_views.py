@@ -5,10 +5,17 @@ from django.http import JsonResponse
 from django.utils import timezone
 from django.db.models import Count, Sum, Avg, Q, F
 from django.db.models.functions import TruncDate, TruncHour
+from django.conf import settings
 from datetime import timedelta
 import logging
-from devices.models import Device, DeviceCapture, SIM, PushSubscription
-from firmware.models import FirmwareVersion
+from devices.caching import NAMESPACE_DASHBOARD, get_or_load, get_cache_stats
+from devices.models import Device, DeviceCapture, Capture, SIM, PushSubscription
+from devices.rate_limit import get_throttle_stats
+from firmware.models import FirmwareVersion, FirmwareRollout
+from firmware.rollout import (
+    create_rollout, rollout_progress, rollouts_with_progress,
+    pause_rollout, resume_rollout, cancel_rollout
+)
 
 logger = logging.getLogger(__name__)
 
@@ -22,22 +29,31 @@ def is_staff_or_superuser(user):
 @user_passes_test(is_staff_or_superuser)
 def admin_dashboard(request):
     """Admin analytics dashboard"""
+    context = get_or_load(
+        NAMESPACE_DASHBOARD, ('admin_stats',), _load_dashboard_stats,
+        timeout=getattr(settings, 'ADMIN_DASHBOARD_CACHE_SECONDS', 60)
+    )
+    return render(request, 'web/admin/dashboard.html', context)
+
+
+def _load_dashboard_stats():
+    """Fleet-wide statistics for the admin dashboard (cached by admin_dashboard)"""
     # Device statistics
-    total_devices = Device.objects.count()
-    online_devices = Device.objects.filter(status='online').count()
-    offline_devices = Device.objects.filter(status='offline').count()
-    
-    # Connection type breakdown
-    wifi_devices = Device.objects.filter(connection_type='wifi').count()
-    cellular_devices = Device.objects.filter(connection_type='cellular').count()
+    device_stats = Device.objects.aggregate(
+        total_devices=Count('id'),
+        online_devices=Count('id', filter=Q(status='online')),
+        offline_devices=Count('id', filter=Q(status='offline')),
+        # Connection type breakdown
+        wifi_devices=Count('id', filter=Q(connection_type='wifi')),
+        cellular_devices=Count('id', filter=Q(connection_type='cellular')),
+    )
     
     # Recent activity (last 24 hours)
     last_24h = timezone.now() - timedelta(hours=24)
     recent_captures = DeviceCapture.objects.filter(captured_at__gte=last_24h).count()
-    motion_detections = DeviceCapture.objects.filter(
-        captured_at__gte=last_24h,
-        device__ir_sensor_status='motion_detected'
-    ).count()
+    # Device has no IR sensor field; device-initiated (automatic) captures are its
+    # wakes, manual ones are user requests and not motion
+    motion_detections = Capture.objects.filter(timestamp__gte=last_24h, trigger_type='automatic').count()
     
     # Data usage statistics
     sim_stats = SIM.objects.aggregate(
@@ -66,24 +82,19 @@ def admin_dashboard(request):
     ).order_by('hour')
     
     # Top devices by capture count
-    top_devices = Device.objects.annotate(
+    top_devices = Device.objects.select_related('owner').annotate(
         capture_count=Count('captures')
     ).order_by('-capture_count')[:10]
     
-    context = {
-        'total_devices': total_devices,
-        'online_devices': online_devices,
-        'offline_devices': offline_devices,
-        'wifi_devices': wifi_devices,
-        'cellular_devices': cellular_devices,
+    return {
+        **device_stats,
         'recent_captures': recent_captures,
         'motion_detections': motion_detections,
         'sim_stats': sim_stats,
         'daily_captures': list(daily_captures),
         'hourly_captures': list(hourly_captures),
-        'top_devices': top_devices,
+        'top_devices': list(top_devices),
     }
-    return render(request, 'web/admin/dashboard.html', context)
 
 
 @login_required
@@ -179,7 +190,7 @@ def device_diagnostics(request, serial):
 @login_required
 @user_passes_test(is_staff_or_superuser)
 def bulk_firmware_update(request):
-    """Bulk firmware update interface"""
+    """Bulk firmware update interface: start paced rollouts and follow their progress"""
     if request.method == 'POST':
         firmware_version_id = request.POST.get('firmware_version')
         device_serials = request.POST.getlist('devices')
@@ -190,34 +201,71 @@ def bulk_firmware_update(request):
         
         try:
             firmware = FirmwareVersion.objects.get(id=firmware_version_id, is_active=True)
-            devices = Device.objects.filter(serial_number__in=device_serials)
+            devices = Device.objects.filter(serial_number__in=device_serials).exclude(
+                firmware_version=firmware.version
+            ).only('id')
             
-            # In a real implementation, you would queue firmware updates here
-            # For now, we'll just mark them for update
-            updated_count = devices.count()
+            pacing = {}
+            for field in ('wave_size', 'max_concurrent', 'wave_interval_minutes', 'failure_threshold_percent'):
+                value = request.POST.get(field)
+                if value:
+                    pacing[field] = max(1, int(value))
             
-            messages.success(request, f'Firmware update queued for {updated_count} device(s).')
-            logger.info(f"Bulk firmware update initiated: {firmware.version} for {updated_count} devices")
+            rollout = create_rollout(firmware, devices, user=request.user, **pacing)
+            progress = rollout_progress(rollout)
+            
+            messages.success(
+                request,
+                f'Rollout of {firmware.version} started for {progress["total"]} device(s); '
+                f'{progress["in_flight"]} offered in the first wave.'
+            )
+            logger.info(f"Bulk firmware update initiated: {firmware.version} for {progress['total']} devices")
             
         except FirmwareVersion.DoesNotExist:
             messages.error(request, 'Selected firmware version not found or inactive.')
+        except ValueError:
+            messages.error(request, 'Pacing values must be whole numbers.')
         except Exception as e:
             messages.error(request, f'Error queuing firmware updates: {str(e)}')
             logger.error(f"Bulk firmware update error: {str(e)}")
         
         return redirect('web:bulk_firmware_update')
     
-    # GET request - show form
+    # GET request - show form and rollout progress
     active_firmware = FirmwareVersion.objects.filter(is_active=True).order_by('-release_date')
-    all_devices = Device.objects.all().order_by('serial_number')
+    all_devices = Device.objects.select_related('owner').order_by('serial_number')
+    rollouts = rollouts_with_progress()[:20]
     
     context = {
         'firmware_versions': active_firmware,
         'devices': all_devices,
+        'rollouts': rollouts,
     }
     return render(request, 'web/admin/bulk_update.html', context)
 
 
+@login_required
+@user_passes_test(is_staff_or_superuser)
+def firmware_rollout_action(request, rollout_id, action):
+    """Pause, resume or cancel a firmware rollout"""
+    if request.method != 'POST':
+        return redirect('web:bulk_firmware_update')
+    
+    rollout = get_object_or_404(FirmwareRollout.objects.select_related('firmware'), id=rollout_id)
+    if action == 'pause':
+        pause_rollout(rollout, reason=f'Paused by {request.user.username}')
+    elif action == 'resume':
+        resume_rollout(rollout)
+    elif action == 'cancel':
+        cancel_rollout(rollout)
+    else:
+        messages.error(request, f'Unknown rollout action: {action}')
+        return redirect('web:bulk_firmware_update')
+    
+    messages.success(request, f'{rollout}')
+    return redirect('web:bulk_firmware_update')
+
+
 @login_required
 @user_passes_test(is_staff_or_superuser)
 def api_device_diagnostics(request, serial):
@@ -240,8 +288,26 @@ def api_device_diagnostics(request, serial):
     return JsonResponse(diagnostics)
 
 
-
-
-
-
-
+@login_required
+@user_passes_test(is_staff_or_superuser)
+def api_cache_stats(request):
+    """API endpoint for cache hit/miss counters per namespace and device API throttling (JSON)"""
+    stats = {'namespaces': get_cache_stats(), 'throttled': get_throttle_stats()}
+    
+    # Server-wide numbers when the cache is Redis
+    try:
+        from django_redis import get_redis_connection
+        info = get_redis_connection('default').info()
+        stats['redis'] = {
+            'keyspace_hits': info.get('keyspace_hits'),
+            'keyspace_misses': info.get('keyspace_misses'),
+            'used_memory_human': info.get('used_memory_human'),
+            'evicted_keys': info.get('evicted_keys'),
+        }
+    except NotImplementedError:
+        stats['redis'] = None  # Not a Redis cache backend
+    except Exception as e:
+        logger.warning(f"Could not read Redis info: {str(e)}")
+        stats['redis'] = None
+    
+    return JsonResponse(stats)
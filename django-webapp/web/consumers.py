@@ -1,17 +1,183 @@
+import asyncio
+import itertools
 import json
 import logging
+from collections import OrderedDict
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
-from devices.models import Device
+from devices import metrics
+from devices.event_log import events_since
+from devices.ownership import get_owned_device_id, get_user_device_serials
+from devices.realtime import (
+    device_group_name, user_group_name, group_size_metric, GROUP_SIZE_TTL,
+    METRIC_CONNECTIONS, METRIC_MESSAGES_SENT, METRIC_MESSAGES_DROPPED, METRIC_MESSAGES_COALESCED,
+)
 
 logger = logging.getLogger(__name__)
 
+# Flush per-connection message counters to the shared metrics this often
+METRICS_FLUSH_EVERY = 100
 
-class DeviceFeedConsumer(AsyncWebsocketConsumer):
+
+class BoundedFeedConsumer(AsyncWebsocketConsumer):
+    """
+    WebSocket consumer with a bounded outbound queue.
+
+    Group handlers only enqueue; a per-connection sender task serializes and
+    sends. A slow browser therefore never stalls the consumer's channel
+    (which would fill channel layer capacity). When the queue is full the
+    oldest message is dropped, and messages with a coalesce key replace a
+    still-queued message with the same key.
+    """
+    
     async def connect(self):
+        self.feed_groups = []
+        self._pending = OrderedDict()
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._sender_task = None
+        self._flush_task = None
+        self._counters = {METRIC_MESSAGES_SENT: 0, METRIC_MESSAGES_DROPPED: 0, METRIC_MESSAGES_COALESCED: 0}
+        self.send_queue_size = getattr(settings, 'WEBSOCKET_SEND_QUEUE_SIZE', 50)
+    
+    async def join_feed_group(self, group_name):
+        await self.channel_layer.group_add(group_name, self.channel_name)
+        self.feed_groups.append(group_name)
+        await metrics.aadjust_gauge(group_size_metric(group_name), 1, GROUP_SIZE_TTL)
+    
+    async def start_sending(self):
+        """Accept the socket and start the sender task"""
+        await self.accept()
+        await metrics.aincrement(METRIC_CONNECTIONS)
+        self._sender_task = asyncio.ensure_future(self._sender())
+    
+    async def disconnect(self, close_code):
+        if self._sender_task:
+            self._sender_task.cancel()
+            await metrics.aincrement(METRIC_CONNECTIONS, -1)
+        for group_name in getattr(self, 'feed_groups', []):
+            await self.channel_layer.group_discard(group_name, self.channel_name)
+            await metrics.aadjust_gauge(group_size_metric(group_name), -1, GROUP_SIZE_TTL)
+        self.feed_groups = []
+        if hasattr(self, '_counters'):
+            await self._flush_counters()
+    
+    def enqueue(self, payload, coalesce_key=None):
+        """Queue a message for the client (drop-oldest when full)"""
+        if coalesce_key is not None and coalesce_key in self._pending:
+            self._pending[coalesce_key] = payload
+            self._count(METRIC_MESSAGES_COALESCED)
+        else:
+            if len(self._pending) >= self.send_queue_size:
+                self._pending.popitem(last=False)
+                self._count(METRIC_MESSAGES_DROPPED)
+            key = coalesce_key if coalesce_key is not None else ('message', next(self._sequence))
+            self._pending[key] = payload
+        self._wakeup.set()
+    
+    async def _sender(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self._pending:
+                    _, payload = self._pending.popitem(last=False)
+                    await self.send(text_data=json.dumps(payload))
+                    self._count(METRIC_MESSAGES_SENT)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"WebSocket sender stopped (channel: {self.channel_name}): {str(e)}")
+    
+    def _count(self, name):
+        self._counters[name] += 1
+        flushing = self._flush_task is not None and not self._flush_task.done()
+        if sum(self._counters.values()) >= METRICS_FLUSH_EVERY and not flushing:
+            # Cache round trips; flushed in the background, off the event loop
+            self._flush_task = asyncio.ensure_future(self._flush_counters())
+    
+    async def _flush_counters(self):
+        counts = {name: value for name, value in self._counters.items() if value}
+        for name in counts:
+            self._counters[name] -= counts[name]
+        if counts:
+            await metrics.aincrement_many(counts)
+    
+    async def replay_events(self, serial_number, last_event_id):
+        """
+        Replay a device's events logged after last_event_id through the group
+        handlers. Call after joining the groups, so nothing falls in between
+        (clients ignore event_ids they already have).
+        """
+        events, complete = await sync_to_async(events_since)(serial_number, last_event_id)
+        if not complete:
+            self.enqueue({'type': 'resync_required', 'serial_number': serial_number})
+            return
+        for event in events:
+            handler = getattr(self, event.get('type', ''), None)
+            if handler:
+                await handler(event)
+        self.enqueue({
+            'type': 'replay_complete',
+            'serial_number': serial_number,
+            'replayed': len(events),
+        })
+    
+    def query_params(self):
+        return parse_qs(self.scope.get('query_string', b'').decode())
+    
+    # Receive message from group
+    async def new_capture(self, event):
+        self.enqueue({
+            'type': 'new_capture',
+            'capture_id': event.get('capture_id'),
+            'image': event.get('image', ''),
+            'captured_at': event.get('captured_at', ''),
+            'trigger_type': event.get('trigger_type', 'automatic'),
+            'image_url': event.get('image_url'),
+            'device_status': event.get('device_status', 'online'),
+            'serial_number': event.get('serial_number'),
+            'event_id': event.get('event_id'),
+        })
+    
+    async def test_message(self, event):
+        """Handle test messages from debug page"""
+        self.enqueue({
+            'type': 'test_message',
+            'message': event.get('message', 'Test message'),
+            'timestamp': event.get('timestamp', ''),
+            'serial_number': event.get('serial_number'),
+        })
+    
+    async def analysis_complete(self, event):
+        """Handle analysis completion events from Firebase Vision API"""
+        self.enqueue({
+            'type': 'analysis_complete',
+            'capture_id': event.get('capture_id'),
+            'analysis_summary': event.get('analysis_summary', ''),
+            'analysis_id': event.get('analysis_id'),
+            'serial_number': event.get('serial_number'),
+            'event_id': event.get('event_id'),
+        }, coalesce_key=('analysis_complete', event.get('capture_id')))
+    
+    async def firmware_update(self, event):
+        """Firmware update notices sent to device groups; only the latest matters"""
+        self.enqueue({
+            'type': 'firmware_update',
+            'version': event.get('version'),
+            'serial_number': event.get('serial_number'),
+        }, coalesce_key=('firmware_update', event.get('serial_number')))
+
+
+class DeviceFeedConsumer(BoundedFeedConsumer):
+    async def connect(self):
+        await super().connect()
         self.serial_number = self.scope['url_route']['kwargs']['serial']
-        self.room_group_name = f'device_{self.serial_number}'
+        self.room_group_name = device_group_name(self.serial_number)
         
         # Check if user is authenticated
         user = self.scope.get('user')
@@ -21,35 +187,32 @@ class DeviceFeedConsumer(AsyncWebsocketConsumer):
             return
         
         # Verify user owns the device
-        device = await self.get_device(self.serial_number, user.id)
-        if not device:
+        if not await self.owns_device(self.serial_number, user.id):
             logger.warning(f"WebSocket connection rejected: user {user.username} does not own device {self.serial_number}")
             await self.close()
             return
         
         # Join room group (allows multiple clients per device)
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        await self.join_feed_group(self.room_group_name)
         
-        await self.accept()
+        await self.start_sending()
         logger.info(f"WebSocket connected: user {user.username} to device {self.serial_number} (channel: {self.channel_name})")
         
         # Send connection confirmation
-        await self.send(text_data=json.dumps({
+        self.enqueue({
             'type': 'connection',
             'message': f'Connected to device feed: {self.serial_number}',
             'serial_number': self.serial_number
-        }))
+        })
+        
+        # Replay what the client missed since the page rendered or it disconnected
+        last_event_id = self.query_params().get('last_event_id', [None])[0]
+        if last_event_id:
+            await self.replay_events(self.serial_number, last_event_id)
     
     async def disconnect(self, close_code):
         logger.info(f"WebSocket disconnected: device {self.serial_number}, code: {close_code}, channel: {self.channel_name}")
-        # Leave room group
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+        await super().disconnect(close_code)
     
     # Receive message from WebSocket
     async def receive(self, text_data):
@@ -57,56 +220,48 @@ class DeviceFeedConsumer(AsyncWebsocketConsumer):
         message = text_data_json.get('message', '')
         
         # Echo message back (for testing)
-        await self.send(text_data=json.dumps({
+        self.enqueue({
             'type': 'echo',
             'message': message
-        }))
+        })
     
-    # Receive message from room group
-    async def new_capture(self, event):
-        # Send message to WebSocket (broadcasts to all connected clients for this device)
-        logger.debug(f"Sending new_capture event to WebSocket for device {self.serial_number} (channel: {self.channel_name})")
-        try:
-            await self.send(text_data=json.dumps({
-                'type': 'new_capture',
-                'capture_id': event.get('capture_id'),
-                'image': event.get('image', ''),
-                'captured_at': event.get('captured_at', ''),
-                'trigger_type': event.get('trigger_type', 'automatic'),
-                'device_status': event.get('device_status', 'online'),
-                'serial_number': self.serial_number
-            }))
-        except Exception as e:
-            logger.error(f"Error sending new_capture to WebSocket for device {self.serial_number}: {str(e)}")
+    async def owns_device(self, serial_number, user_id):
+        """Check if device exists and user owns it (cache first, DB only on a miss; one thread hop for both)."""
+        return await database_sync_to_async(get_owned_device_id)(serial_number, user_id) is not None
+
+
+class UserFeedConsumer(BoundedFeedConsumer):
+    """Multiplexed feed: one socket receives events for every device the user owns"""
     
-    async def test_message(self, event):
-        """Handle test messages from debug page"""
-        logger.info(f"Test message received for device {self.serial_number}: {event.get('message', '')}")
-        await self.send(text_data=json.dumps({
-            'type': 'test_message',
-            'message': event.get('message', 'Test message'),
-            'timestamp': event.get('timestamp', ''),
-        }))
+    async def connect(self):
+        await super().connect()
+        user = self.scope.get('user')
+        if user is None or isinstance(user, AnonymousUser):
+            logger.warning("WebSocket connection rejected: unauthenticated user for user feed")
+            await self.close()
+            return
+        
+        self.user_id = user.id
+        await self.join_feed_group(user_group_name(user.id))
+        await self.start_sending()
+        
+        serial_numbers = await self.get_serial_numbers(user.id)
+        logger.info(f"WebSocket connected: user {user.username} to feed for {len(serial_numbers)} device(s)")
+        self.enqueue({
+            'type': 'connection',
+            'message': 'Connected to user feed',
+            'serial_numbers': serial_numbers,
+        })
+        
+        # Resume each device the client passes as ?since=<serial>:<last_event_id>
+        for resume_point in self.query_params().get('since', []):
+            serial_number, _, last_event_id = resume_point.rpartition(':')
+            if serial_number in serial_numbers and last_event_id:
+                await self.replay_events(serial_number, last_event_id)
     
-    async def analysis_complete(self, event):
-        """Handle analysis completion events from Firebase Vision API"""
-        logger.debug(f"Sending analysis_complete event to WebSocket for device {self.serial_number}")
-        try:
-            await self.send(text_data=json.dumps({
-                'type': 'analysis_complete',
-                'capture_id': event.get('capture_id'),
-                'analysis_summary': event.get('analysis_summary', ''),
-                'analysis_id': event.get('analysis_id'),
-                'serial_number': self.serial_number
-            }))
-        except Exception as e:
-            logger.error(f"Error sending analysis_complete to WebSocket for device {self.serial_number}: {str(e)}")
+    async def disconnect(self, close_code):
+        logger.info(f"WebSocket disconnected: user feed {getattr(self, 'user_id', None)}, code: {close_code}")
+        await super().disconnect(close_code)
     
-    @database_sync_to_async
-    def get_device(self, serial_number, user_id):
-        """Check if device exists and user owns it."""
-        try:
-            return Device.objects.get(serial_number=serial_number, owner_id=user_id)
-        except Device.DoesNotExist:
-            return None
-
+    async def get_serial_numbers(self, user_id):
+        return await database_sync_to_async(get_user_device_serials)(user_id)
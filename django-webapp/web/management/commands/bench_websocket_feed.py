@@ -0,0 +1,168 @@
+"""
+Management command to load-test the WebSocket feed fan-out.
+Connects thousands of simulated browser clients (device feeds and
+multiplexed user feeds) in-process through the configured channel layer,
+publishes a burst of device events and reports delivery, drops and
+coalescing. A fraction of clients are slow so the bounded send queues are
+exercised. No database rows are created.
+
+Run against the local Redis channel layer:
+    python manage.py bench_websocket_feed --clients 2000 --devices 500
+Without Redis:
+    python manage.py bench_websocket_feed --in-memory
+(the in-memory layer scans every channel on each receive, so it understates
+throughput at high client counts)
+"""
+import asyncio
+import random
+import time
+from types import SimpleNamespace
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from django.urls import re_path
+from devices import metrics
+from devices.realtime import (
+    FEED_METRICS, device_group_name, user_group_name, group_size_metric,
+    METRIC_MESSAGES_SENT, METRIC_MESSAGES_DROPPED, METRIC_MESSAGES_COALESCED,
+)
+from web.consumers import DeviceFeedConsumer, UserFeedConsumer
+
+IN_MEMORY_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 1000}}}
+
+
+class BenchDeviceFeedConsumer(DeviceFeedConsumer):
+    """Device feed with ownership taken from the simulated scope"""
+    slow_delay = 0
+
+    async def owns_device(self, serial_number, user_id):
+        return serial_number in self.scope['user'].serial_numbers
+
+    async def send(self, *args, **kwargs):
+        if self.scope.get('slow'):
+            await asyncio.sleep(self.slow_delay)
+        await super().send(*args, **kwargs)
+
+
+class BenchUserFeedConsumer(UserFeedConsumer):
+    """User feed with the device list taken from the simulated scope"""
+    slow_delay = 0
+
+    async def get_serial_numbers(self, user_id):
+        return list(self.scope['user'].serial_numbers)
+
+    async def send(self, *args, **kwargs):
+        if self.scope.get('slow'):
+            await asyncio.sleep(self.slow_delay)
+        await super().send(*args, **kwargs)
+
+
+class Command(BaseCommand):
+    help = 'Load-test WebSocket feed fan-out with simulated clients'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=2000, help='Simulated WebSocket clients (default: 2000)')
+        parser.add_argument('--users', type=int, default=200, help='Simulated users owning the devices (default: 200)')
+        parser.add_argument('--devices', type=int, default=500, help='Simulated devices (default: 500)')
+        parser.add_argument('--user-feed-fraction', type=float, default=0.5, help='Share of clients on the multiplexed user feed (default: 0.5)')
+        parser.add_argument('--events', type=int, default=2000, help='Device events to publish (default: 2000)')
+        parser.add_argument('--slow-fraction', type=float, default=0.1, help='Share of slow clients (default: 0.1)')
+        parser.add_argument('--slow-delay-ms', type=int, default=50, help='Per-message send delay of slow clients (default: 50)')
+        parser.add_argument('--in-memory', action='store_true', help='Use the in-memory channel layer instead of Redis')
+
+    def handle(self, *args, **options):
+        if options['in_memory']:
+            with override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS):
+                asyncio.run(self._run(options))
+        else:
+            asyncio.run(self._run(options))
+
+    async def _run(self, options):
+        random.seed(42)
+        BenchDeviceFeedConsumer.slow_delay = BenchUserFeedConsumer.slow_delay = options['slow_delay_ms'] / 1000
+        application = URLRouter([
+            re_path(r'ws/device/(?P<serial>[^/]+)/$', BenchDeviceFeedConsumer.as_asgi()),
+            re_path(r'ws/feed/$', BenchUserFeedConsumer.as_asgi()),
+        ])
+
+        # Devices are spread across users
+        devices = [(f'BENCH-{i:05d}', i % options['users'] + 1) for i in range(options['devices'])]
+        users = {}
+        for serial, user_id in devices:
+            users.setdefault(user_id, SimpleNamespace(id=user_id, username=f'bench{user_id}', serial_numbers=set()))
+            users[user_id].serial_numbers.add(serial)
+
+        metrics.reset_counters(FEED_METRICS)
+        communicators = []
+        start = time.perf_counter()
+        for i in range(options['clients']):
+            if random.random() < options['user_feed_fraction']:
+                user = users[random.choice(list(users))]
+                communicator = WebsocketCommunicator(application, 'ws/feed/')
+            else:
+                serial, user_id = random.choice(devices)
+                user = users[user_id]
+                communicator = WebsocketCommunicator(application, f'ws/device/{serial}/')
+            communicator.scope['user'] = user
+            communicator.scope['slow'] = random.random() < options['slow_fraction']
+            connected, _ = await communicator.connect(timeout=10)
+            if not connected:
+                self.stdout.write(self.style.ERROR(f'Client {i} failed to connect'))
+                continue
+            await communicator.receive_json_from(timeout=10)  # connection message
+            communicators.append(communicator)
+        connect_seconds = time.perf_counter() - start
+        self.stdout.write(f'Connected {len(communicators)} clients in {connect_seconds:.1f}s')
+
+        from channels.layers import get_channel_layer
+        channel_layer = get_channel_layer()
+        start = time.perf_counter()
+        for n in range(options['events']):
+            serial, user_id = random.choice(devices)
+            event = {
+                'type': 'analysis_complete' if n % 2 else 'new_capture',
+                'capture_id': n // 2,
+                'analysis_summary': 'bench',
+                'serial_number': serial,
+            }
+            await channel_layer.group_send(device_group_name(serial), event)
+            await channel_layer.group_send(user_group_name(user_id), event)
+        publish_seconds = time.perf_counter() - start
+
+        delivered = await self._wait_for_drain(communicators)
+        drain_seconds = time.perf_counter() - start
+
+        for communicator in communicators:
+            await communicator.disconnect()
+
+        group_sizes = metrics.get_counters(
+            [group_size_metric(device_group_name(serial)) for serial, _ in devices[:3]]
+        )
+        counters = metrics.get_counters(FEED_METRICS)
+        self.stdout.write(
+            f'Published {options["events"]} events ({options["events"] * 2} group sends) '
+            f'in {publish_seconds:.2f}s ({options["events"] * 2 / max(publish_seconds, 1e-6):.0f} sends/s)'
+        )
+        self.stdout.write(f'All clients drained after {drain_seconds:.2f}s')
+        self.stdout.write(
+            f'Messages delivered: {delivered} '
+            f'(sent {counters[METRIC_MESSAGES_SENT]}, dropped {counters[METRIC_MESSAGES_DROPPED]}, '
+            f'coalesced {counters[METRIC_MESSAGES_COALESCED]})'
+        )
+        self.stdout.write(f'Group sizes after disconnect (should be 0): {group_sizes}')
+        self.stdout.write(self.style.SUCCESS('\nBenchmark complete'))
+
+    async def _wait_for_drain(self, communicators, settle_seconds=1.0):
+        """
+        Wait until no client receives anything new for settle_seconds.
+        Messages stay in each communicator's output queue, so delivery is
+        counted without polling thousands of sockets.
+        """
+        delivered = -1
+        while True:
+            await asyncio.sleep(settle_seconds)
+            total = sum(c.output_queue.qsize() for c in communicators)
+            if total == delivered:
+                return total
+            delivered = total
@@ -3,6 +3,7 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/device/(?P<serial>[^/]+)/$', consumers.DeviceFeedConsumer.as_asgi()),
+    re_path(r'ws/feed/$', consumers.UserFeedConsumer.as_asgi()),
 ]
 
 
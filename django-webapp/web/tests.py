@@ -1,3 +1,262 @@
-from django.test import TestCase
+"""
+Query budget tests for the hot dashboard views.
+Each view is rendered against a fleet of thousands of devices, captures and
+SIM cards and must stay within a fixed number of queries and bytes fetched
+from the database. The budgets don't grow with the data, so an N+1 loop in a
+view or template, or a query that loads the whole fleet, fails here.
 
-# Create your tests here.
+Caches are cleared before every request: budgets are for the cold path.
+Bytes fetched are approximate (string and binary values by length, other
+values 8 bytes each).
+"""
+from contextlib import contextmanager
+from types import SimpleNamespace
+from unittest import mock
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.db.backends.utils import CursorWrapper
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from devices.models import Device, DeviceCapture, Capture, CaptureAnalysis, SIM
+from .consumers import UserFeedConsumer
+
+FLEET_USERS = 100
+FLEET_DEVICES = 2000
+CUSTOMER_DEVICES = 20
+CUSTOMER_CAPTURES_PER_DEVICE = 50
+FLEET_CAPTURES = 2000
+DEVICE_CAPTURES = 2000
+SIM_CARDS = 1500
+
+# Stored images are base64 JPEGs; 8KB keeps seeding fast while making
+# image columns dominate the bytes fetched, as they do in production
+IMAGE_BASE64 = '/9j/' + 'A' * (8 * 1024 - 4)
+IMAGE_BYTES = len(IMAGE_BASE64)
+
+# Everything except images: sessions, users, rows of a page
+ROW_BYTES_ALLOWANCE = 64 * 1024
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+IN_MEMORY_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+def _value_bytes(value):
+    if isinstance(value, (str, bytes, bytearray, memoryview)):
+        return len(value)
+    return 8
+
+
+def _row_bytes(row):
+    return sum(_value_bytes(value) for value in row) if row else 0
+
+
+class FetchedBytes:
+    total = 0
+
+
+@contextmanager
+def count_fetched_bytes():
+    """Count the bytes of every row fetched through Django's cursor wrapper"""
+    fetched = FetchedBytes()
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        fetched.total += _row_bytes(row)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self.cursor.fetchmany(*args, **kwargs)
+        fetched.total += sum(_row_bytes(row) for row in rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        fetched.total += sum(_row_bytes(row) for row in rows)
+        return rows
+
+    with mock.patch.object(CursorWrapper, 'fetchone', fetchone, create=True), \
+            mock.patch.object(CursorWrapper, 'fetchmany', fetchmany, create=True), \
+            mock.patch.object(CursorWrapper, 'fetchall', fetchall, create=True):
+        yield fetched
+
+
+@override_settings(CACHES=LOCMEM_CACHES, DEVICE_RATE_LIMITS={})
+class QueryBudgetTestCase(TestCase):
+    """Seeds a fleet; self.customer owns CUSTOMER_DEVICES of its devices"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user(username='staff', is_staff=True)
+        users = User.objects.bulk_create([
+            User(username=f'customer{index}', password='!') for index in range(FLEET_USERS)
+        ])
+        cls.customer = users[0]
+
+        devices = []
+        for index in range(FLEET_DEVICES):
+            owner = cls.customer if index < CUSTOMER_DEVICES else users[1 + index % (FLEET_USERS - 1)]
+            devices.append(Device(
+                serial_number=f'ESP-{index:05d}', owner=owner,
+                status='online' if index % 3 else 'offline',
+                connection_type='cellular' if index % 4 == 0 else 'wifi',
+                lifecycle_state='active_subscription',
+            ))
+        devices = Device.objects.bulk_create(devices)
+        cls.customer_devices = devices[:CUSTOMER_DEVICES]
+
+        captures = [
+            Capture(device=device, image_base64=IMAGE_BASE64, battery_voltage=3.9)
+            for device in cls.customer_devices for _ in range(CUSTOMER_CAPTURES_PER_DEVICE)
+        ]
+        captures += [
+            Capture(device=devices[CUSTOMER_DEVICES + index % (FLEET_DEVICES - CUSTOMER_DEVICES)], image_base64=IMAGE_BASE64)
+            for index in range(FLEET_CAPTURES)
+        ]
+        captures = Capture.objects.bulk_create(captures)
+        CaptureAnalysis.objects.bulk_create([
+            CaptureAnalysis(
+                capture=capture, summary='Small letter detected', letter_detected=True,
+                package_detected=index % 4 == 0, logos_detected=['USPS'], estimated_size='small',
+            )
+            for index, capture in enumerate(captures) if index % 2 == 0
+        ])
+
+        DeviceCapture.objects.bulk_create([
+            DeviceCapture(device=devices[index % FLEET_DEVICES], image=IMAGE_BASE64, data_size_bytes=IMAGE_BYTES)
+            for index in range(DEVICE_CAPTURES)
+        ])
+        SIM.objects.bulk_create([
+            SIM(iccid=f'8901{index:016d}', device=devices[index], plan_mb=500, data_used_mb=index % 600)
+            for index in range(SIM_CARDS)
+        ])
+
+    def assertWithinBudget(self, url, max_queries, max_bytes, user=None):
+        """GET url as user (default: the customer) with a cold cache and check its budget"""
+        self.client.force_login(user or self.customer)
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries, count_fetched_bytes() as fetched:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(
+            len(queries), max_queries,
+            f'{url} ran {len(queries)} queries (budget {max_queries}):\n' +
+            '\n'.join(query['sql'] for query in queries.captured_queries)
+        )
+        self.assertLessEqual(
+            fetched.total, max_bytes,
+            f'{url} fetched {fetched.total} bytes (budget {max_bytes})'
+        )
+        return response
+
+
+class CustomerViewBudgetTests(QueryBudgetTestCase):
+
+    def test_dashboard(self):
+        # Up to 20 recent captures with their images
+        self.assertWithinBudget(reverse('web:dashboard'), 6, 20 * IMAGE_BYTES + ROW_BYTES_ALLOWANCE)
+
+    def test_photo_gallery(self):
+        # One page of 20 captures
+        self.assertWithinBudget(reverse('web:photo_gallery'), 5, 20 * IMAGE_BYTES + ROW_BYTES_ALLOWANCE)
+
+    def test_photo_gallery_filtered_for_device(self):
+        serial_number = self.customer_devices[0].serial_number
+        url = reverse('web:photo_gallery_device', args=[serial_number]) + '?type=letter&page=2'
+        self.assertWithinBudget(url, 6, 20 * IMAGE_BYTES + ROW_BYTES_ALLOWANCE)
+
+    def test_device_detail(self):
+        # 20 recent captures, plus the latest again for the battery reading
+        serial_number = self.customer_devices[0].serial_number
+        self.assertWithinBudget(
+            reverse('web:device_detail', args=[serial_number]), 8, 21 * IMAGE_BYTES + ROW_BYTES_ALLOWANCE
+        )
+
+    def test_customer_portal_dashboard(self):
+        # The portal page template isn't in the tree yet; render the view's
+        # context the way a page would
+        template = (
+            '{% for device in devices %}{{ device.serial_number }} {{ device.status }}{% endfor %}'
+            '{% for capture in recent_captures %}{{ capture.device.serial_number }} '
+            '{{ capture.analysis.summary }}{% endfor %}'
+            '{{ subscription.plan.name }} {{ total_notifications }} {{ online_devices }} {{ offline_devices }}'
+        )
+        templates = [{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'OPTIONS': {
+                'context_processors': settings.TEMPLATES[0]['OPTIONS']['context_processors'],
+                'loaders': [('django.template.loaders.locmem.Loader', {'devices/customer/dashboard.html': template})],
+            },
+        }]
+        with override_settings(TEMPLATES=templates):
+            # 10 recent captures
+            self.assertWithinBudget(reverse('devices:dashboard'), 10, 10 * IMAGE_BYTES + ROW_BYTES_ALLOWANCE)
+
+
+class StaffViewBudgetTests(QueryBudgetTestCase):
+
+    def test_admin_dashboard(self):
+        self.assertWithinBudget(reverse('web:admin_dashboard'), 10, ROW_BYTES_ALLOWANCE, user=self.staff)
+
+    def test_debug_page(self):
+        # Aggregated statistics and capped tables; no images
+        self.assertWithinBudget(reverse('web:debug'), 8, ROW_BYTES_ALLOWANCE, user=self.staff)
+
+
+class StaffRouteTests(SimpleTestCase):
+    """Staff pages under /admin/ resolve ahead of the Django admin's catch-all"""
+
+    def test_staff_pages_resolve_to_web_views(self):
+        for name in ('admin_dashboard', 'support_panel', 'bulk_firmware_update'):
+            url = reverse(f'web:{name}')
+            self.assertTrue(url.startswith('/admin/'))
+            self.assertEqual(resolve(url).url_name, name)
+
+    def test_django_admin_still_reachable(self):
+        self.assertEqual(resolve('/admin/').app_name, 'admin')
+        self.assertEqual(resolve('/admin/devices/device/').app_name, 'admin')
+        self.assertEqual(resolve('/admin/login/').url_name, 'login')
+
+
+@override_settings(CACHES=LOCMEM_CACHES, CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class UserFeedReplayTests(SimpleTestCase):
+    """The multiplexed feed resumes each device the client passes in ?since="""
+
+    def test_replays_owned_devices_and_resyncs_gaps(self):
+        logged = {
+            'ESP-A': ([{'type': 'analysis_complete', 'capture_id': 7, 'serial_number': 'ESP-A', 'event_id': '12-0'}], True),
+            'ESP-B': ([], False),
+        }
+        with mock.patch('web.consumers.get_user_device_serials', return_value=['ESP-A', 'ESP-B']), \
+                mock.patch('web.consumers.events_since', side_effect=lambda serial, _: logged[serial]) as events_since:
+            messages = async_to_sync(self.connect)('ws/feed/?since=ESP-A:11-0&since=ESP-B:3-0&since=ESP-X:1-0')
+
+        self.assertEqual(events_since.call_args_list, [mock.call('ESP-A', '11-0'), mock.call('ESP-B', '3-0')])
+        self.assertEqual(
+            [(message['type'], message.get('serial_number'), message.get('event_id')) for message in messages],
+            [('connection', None, None), ('analysis_complete', 'ESP-A', '12-0'),
+             ('replay_complete', 'ESP-A', None), ('resync_required', 'ESP-B', None)]
+        )
+
+    async def connect(self, path):
+        communicator = WebsocketCommunicator(UserFeedConsumer.as_asgi(), path)
+        communicator.scope['user'] = SimpleNamespace(id=1, username='feed')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        messages = [await communicator.receive_json_from() for _ in range(4)]
+        await communicator.disconnect()
+        return messages
+
+
+class AdminDashboardStatsTests(TestCase):
+
+    def test_motion_detections_count_automatic_captures_only(self):
+        from .admin_views import _load_dashboard_stats
+        device = Device.objects.create(serial_number='ESP-MOTION')
+        for trigger_type in ('automatic', 'automatic', 'manual'):
+            Capture.objects.create(device=device, image_base64=IMAGE_BASE64, trigger_type=trigger_type)
+        self.assertEqual(_load_dashboard_stats()['motion_detections'], 2)
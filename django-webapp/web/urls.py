@@ -28,6 +28,8 @@ urlpatterns = [
     path('admin/support/', admin_views.support_panel, name='support_panel'),
     path('admin/diagnostics/<str:serial>/', admin_views.device_diagnostics, name='device_diagnostics'),
     path('admin/bulk-update/', admin_views.bulk_firmware_update, name='bulk_firmware_update'),
+    path('admin/rollouts/<int:rollout_id>/<str:action>/', admin_views.firmware_rollout_action, name='firmware_rollout_action'),
     path('admin/api/diagnostics/<str:serial>/', admin_views.api_device_diagnostics, name='api_device_diagnostics'),
+    path('admin/api/cache-stats/', admin_views.api_cache_stats, name='api_cache_stats'),
 ]
 
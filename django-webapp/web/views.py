@@ -4,20 +4,24 @@ from django.contrib.auth import login, logout
 from django.contrib.auth.views import LoginView
 from django.contrib import messages
 from django.views.decorators.http import require_http_methods
-from django.http import HttpResponse, FileResponse, JsonResponse
+from django.http import HttpResponse, FileResponse, JsonResponse, Http404
 from django.template.loader import render_to_string
 from django.utils import timezone
-from django.db.models import Count, Sum
+from django.db.models import Count, Sum, Q, F
 from django.core.paginator import Paginator
 from django.urls import reverse_lazy
 from django.conf import settings
 import logging
 from devices.models import Device, DeviceCapture, Capture, CaptureAnalysis, SIM, PushSubscription
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from devices.event_log import latest_event_id
+from devices.realtime import broadcast_device_event
+from devices.ownership import get_owned_device_id, get_user_device_list
 
 logger = logging.getLogger(__name__)
 
+# Rows shown in each table of the debug page
+DEBUG_PAGE_ROWS = 100
+
 
 @login_required
 def dashboard(request):
@@ -25,7 +29,7 @@ def dashboard(request):
     Customer dashboard showing recent mail with AI tags and device overview.
     """
     logger.info(f"Dashboard accessed by user: {request.user.username}")
-    devices = Device.objects.filter(owner=request.user).order_by('-last_seen')
+    devices = get_user_device_list(request.user.id)
     
     # Get recent mail (captures with analysis) from all user's devices
     recent_mail = Capture.objects.filter(
@@ -33,8 +37,8 @@ def dashboard(request):
     ).select_related('device', 'analysis').prefetch_related('analysis').order_by('-timestamp')[:20]
     
     # Get statistics
-    total_devices = devices.count()
-    online_devices = devices.filter(status='online').count()
+    total_devices = len(devices)
+    online_devices = sum(1 for device in devices if device['status'] == 'online')
     recent_mail_count = recent_mail.count()
     
     context = {
@@ -55,6 +59,8 @@ def device_detail(request, serial):
     """
     logger.info(f"Device detail accessed: {serial} by user: {request.user.username}")
     device = get_object_or_404(Device, serial_number=serial, owner=request.user)
+    # Read before the captures, so the feed replays anything logged while rendering
+    last_event_id = latest_event_id(serial)
     
     # Get recent captures with analysis
     recent_captures = Capture.objects.filter(device=device).select_related('analysis').order_by('-timestamp')[:20]
@@ -71,6 +77,7 @@ def device_detail(request, serial):
         'solar_charging': solar_charging,
         'user': request.user,
         'device_serial': serial,
+        'last_event_id': last_event_id,
     }
     return render(request, 'web/device_detail.html', context)
 
@@ -113,8 +120,10 @@ def photo_gallery(request, serial=None):
     logger.info(f"Photo gallery accessed by user: {request.user.username}")
     
     if serial:
-        device = get_object_or_404(Device, serial_number=serial, owner=request.user)
-        captures = Capture.objects.filter(device=device).select_related('analysis').order_by('-timestamp')
+        device_id = get_owned_device_id(serial, request.user.id)
+        if device_id is None:
+            raise Http404('Device not found')
+        captures = Capture.objects.filter(device_id=device_id).select_related('device', 'analysis').order_by('-timestamp')
     else:
         # All devices
         captures = Capture.objects.filter(device__owner=request.user).select_related('device', 'analysis').order_by('-timestamp')
@@ -135,7 +144,7 @@ def photo_gallery(request, serial=None):
     
     context = {
         'captures': page_obj,
-        'device': device if serial else None,
+        'device': {'serial_number': serial} if serial else None,
         'filter_type': filter_type,
         'user': request.user,
     }
@@ -344,40 +353,45 @@ def is_staff_or_superuser(user):
 def debug_page(request):
     """
     Debug page showing system status, devices, and recent activity.
+    Statistics are aggregated in the database; the device and SIM tables
+    show the DEBUG_PAGE_ROWS most recent rows.
     """
     logger.info(f"Debug page accessed by user: {request.user.username}")
     
-    # Get all devices with statistics
-    all_devices = Device.objects.all().order_by('-last_seen')
-    
     # Device statistics
-    device_stats = {
-        'total': all_devices.count(),
-        'online': all_devices.filter(status='online').count(),
-        'offline': all_devices.filter(status='offline').count(),
-        'wifi': all_devices.filter(connection_type='wifi').count(),
-        'cellular': all_devices.filter(connection_type='cellular').count(),
-    }
+    device_stats = Device.objects.aggregate(
+        total=Count('id'),
+        online=Count('id', filter=Q(status='online')),
+        offline=Count('id', filter=Q(status='offline')),
+        wifi=Count('id', filter=Q(connection_type='wifi')),
+        cellular=Count('id', filter=Q(connection_type='cellular')),
+    )
     
-    # Recent captures (last 50)
-    recent_captures = DeviceCapture.objects.all().order_by('-captured_at')[:50]
+    # Most recently seen devices, with owner and capture count in the same query
+    devices = Device.objects.select_related('owner').annotate(
+        capture_count=Count('captures')
+    ).order_by('-last_seen')[:DEBUG_PAGE_ROWS]
     
-    # SIM card statistics
-    sim_cards = SIM.objects.all()
-    sim_stats = {
-        'total': sim_cards.count(),
-        'near_limit': sum(1 for sim in sim_cards if sim.is_near_limit),
-        'over_limit': sum(1 for sim in sim_cards if sim.is_over_limit),
-        'total_data_used': sum(sim.data_used_mb for sim in sim_cards),
-    }
+    # Recent captures (last 50; the table doesn't show images)
+    recent_captures = DeviceCapture.objects.select_related('device').defer('image').order_by('-captured_at')[:50]
+    
+    # SIM card statistics (same rules as SIM.is_near_limit and SIM.is_over_limit)
+    sim_stats = SIM.objects.aggregate(
+        total=Count('id'),
+        near_limit=Count('id', filter=Q(plan_mb__gt=0, data_used_mb__gte=F('plan_mb') * 0.8)),
+        over_limit=Count('id', filter=Q(data_used_mb__gte=F('plan_mb'))),
+        total_data_used=Sum('data_used_mb'),
+    )
+    sim_stats['total_data_used'] = sim_stats['total_data_used'] or 0
+    sim_cards = SIM.objects.select_related('device')[:DEBUG_PAGE_ROWS]
     
     # Connection type breakdown
-    connection_breakdown = all_devices.values('connection_type').annotate(
+    connection_breakdown = Device.objects.values('connection_type').annotate(
         count=Count('id')
-    )
+    ).order_by('connection_type')
     
     context = {
-        'devices': all_devices,
+        'devices': devices,
         'device_stats': device_stats,
         'recent_captures': recent_captures,
         'sim_cards': sim_cards,
@@ -402,15 +416,11 @@ def test_websocket(request, serial):
         
         # Try to send a test message via WebSocket
         try:
-            channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)(
-                group_name,
-                {
-                    'type': 'test_message',
-                    'message': 'Test message from debug page',
-                    'timestamp': timezone.now().isoformat(),
-                }
-            )
+            broadcast_device_event(serial, device.owner_id, {
+                'type': 'test_message',
+                'message': 'Test message from debug page',
+                'timestamp': timezone.now().isoformat(),
+            })
             return JsonResponse({
                 'status': 'success',
                 'message': f'Test message sent to device {serial}',
@@ -22,6 +22,10 @@ const char* API_ENDPOINT = "/api/device/capture/";
 // Device serial number - will be auto-generated from MAC if empty
 const char* DEVICE_SERIAL = "";
 
+// Device API key (python manage.py issue_device_keys <serial>) - overridden
+// by a key stored in flash (Preferences "device"/"api_key")
+const char* DEVICE_API_KEY = "";
+
 // SSL/TLS Configuration
 const char* rootCACertificate = nullptr;
 bool validateSSL = false;
@@ -29,6 +33,11 @@ bool validateSSL = false;
 // Deep sleep duration: 2 hours = 7200 seconds = 7200000000 microseconds
 const unsigned long DEEP_SLEEP_DURATION_US = 7200000000ULL; // 2 hours
 
+// The server spreads the fleet across the 2-hour interval and returns
+// next_wake_seconds with each upload; values outside this range are ignored
+const unsigned long MIN_SERVER_SLEEP_SECONDS = 60;
+const unsigned long MAX_SERVER_SLEEP_SECONDS = 3 * 7200;
+
 // ============================================================================
 // PIN DEFINITIONS
 // ============================================================================
@@ -63,6 +72,7 @@ const unsigned long DEEP_SLEEP_DURATION_US = 7200000000ULL; // 2 hours
 
 Preferences preferences;
 String serialNumber = "";
+String deviceApiKey = "";
 String wifiSSID = "";
 String wifiPassword = "";
 
@@ -74,6 +84,7 @@ bool apMode = false;
 
 bool cameraInitialized = false;
 float batteryVoltage = 0.0;
+uint64_t sleepDurationUs = DEEP_SLEEP_DURATION_US;
 const float BATTERY_LOW_THRESHOLD = 3.3;
 
 // ============================================================================
@@ -92,6 +103,20 @@ String getDeviceSerial() {
   return String(serial);
 }
 
+String loadDeviceApiKey() {
+  preferences.begin("device", true);
+  String apiKey = preferences.getString("api_key", "");
+  preferences.end();
+  
+  return apiKey.length() > 0 ? apiKey : String(DEVICE_API_KEY);
+}
+
+void addAuthHeader(HTTPClient& http) {
+  if (deviceApiKey.length() > 0) {
+    http.addHeader("Authorization", "Device " + serialNumber + ":" + deviceApiKey);
+  }
+}
+
 String buildApiUrl(const char* endpoint) {
   String url;
   bool isIP = true;
@@ -323,6 +348,7 @@ bool uploadPhoto(String base64Image, String triggerType) {
   }
   
   http.addHeader("Content-Type", "application/json");
+  addAuthHeader(http);
   http.setTimeout(30000);
   
   // Create JSON payload with trigger_type
@@ -345,6 +371,15 @@ bool uploadPhoto(String base64Image, String triggerType) {
     Serial.print("Response: ");
     Serial.println(response);
     success = true;
+    
+    // Sleep until this device's wake slot (flattens fleet-wide upload peaks)
+    DynamicJsonDocument responseDoc(512);
+    if (!deserializeJson(responseDoc, response)) {
+      unsigned long nextWakeSeconds = responseDoc["next_wake_seconds"] | 0UL;
+      if (nextWakeSeconds >= MIN_SERVER_SLEEP_SECONDS && nextWakeSeconds <= MAX_SERVER_SLEEP_SECONDS) {
+        sleepDurationUs = (uint64_t)nextWakeSeconds * 1000000ULL;
+      }
+    }
   } else {
     Serial.println("Upload: Failed");
     Serial.print("HTTP Error code: ");
@@ -377,10 +412,10 @@ void enterDeepSleep() {
   // Turn off LED
   digitalWrite(LED_STATUS_PIN, LOW);
   
-  // Configure wake-up source: Timer (2 hours)
-  esp_sleep_enable_timer_wakeup(DEEP_SLEEP_DURATION_US);
+  // Configure wake-up source: Timer (server-assigned wake slot, or 2 hours)
+  esp_sleep_enable_timer_wakeup(sleepDurationUs);
   
-  Serial.println("Entering deep sleep for 2 hours...");
+  Serial.printf("Entering deep sleep for %lu minutes...\n", (unsigned long)(sleepDurationUs / 60000000ULL));
   Serial.flush();
   delay(100);
   
@@ -621,6 +656,10 @@ void setup() {
   serialNumber = getDeviceSerial();
   Serial.print("Device Serial: ");
   Serial.println(serialNumber);
+  deviceApiKey = loadDeviceApiKey();
+  if (deviceApiKey.length() == 0) {
+    Serial.println("Warning: No device API key configured");
+  }
   
   // Initialize LED
   pinMode(LED_STATUS_PIN, OUTPUT);